@@ -0,0 +1,270 @@
+"""
+Benchmark suite for the correlation pipeline on synthetic data.
+
+    python -m benchmarks.run --scale medium
+    python -m benchmarks.run --features 2000 --asvs 20000 --samples 150 --sparsity 0.9 --taxonomy-depth 7
+    python -m benchmarks.run --scale medium --levels
+    python -m benchmarks.run --compare benchmarks/results.jsonl
+
+Every stage is timed (wall and CPU time of this process) and, in a separate traced run, its peak
+Python/NumPy allocation in this process is measured with tracemalloc (the correlation workers
+are separate processes and not included). One JSON record per run is appended to the output
+file, together with the commit and the machine, so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from src.correlation import (ASV_LEVEL, calculate_correlations_parallel, calculate_level_correlations,
+                             calculate_permutation_histograms, check_precision, combine_dataframes,
+                             melt_correlation_results)
+from src.cost_model import CostModel
+from src.executor import CorrelationExecutor
+from src.fdr import calculate_fdr
+from src.histogram import PermutationHistograms, ScoreHistogram
+from src.preprocessing import bin_all_taxonomic_levels, filter_feature_tables
+from src.profiling import max_rss_mb
+from src.results import CorrelationResults
+
+from .synthetic import TAXONOMIC_LEVELS, synthetic_asv_table, synthetic_metabolome
+
+SCALES = {
+    "small": {"features": 300, "asvs": 1000, "samples": 40},
+    "medium": {"features": 1000, "asvs": 5000, "samples": 80},
+    "production": {"features": 3000, "asvs": 20000, "samples": 150},
+}
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "results.jsonl")
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def _rows(result):
+    """
+    Rows produced by a stage: table rows (summed over the tables of every taxonomic level),
+    correlation pairs or histogram counts.
+    """
+    if isinstance(result, dict):
+        return sum(_rows(table) for table in result.values())
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, CorrelationResults):
+        return int(np.prod(result.shape))
+    if isinstance(result, (ScoreHistogram, PermutationHistograms)):
+        return int(result.counts.sum())
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    return None
+
+
+def measure(func, repeats=1, memory=True):
+    """
+    Time func over `repeats` runs, then run it once more under tracemalloc if memory is set.
+
+    Returns:
+    tuple: (result of the last run, stage record with wall_s (best), wall_s_all, cpu_s, peak_mb, rows)
+    """
+    record = {"wall_s_all": [], "cpu_s_all": []}
+    for _ in range(repeats):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func()
+        record["wall_s_all"].append(time.perf_counter() - wall)
+        record["cpu_s_all"].append(time.process_time() - cpu)
+    record["wall_s"] = min(record["wall_s_all"])
+    record["cpu_s"] = min(record["cpu_s_all"])
+
+    if memory:
+        tracemalloc.start()
+        try:
+            result = func()
+            record["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+
+    record["rows"] = _rows(result)
+    return result, record
+
+
+def run_benchmark(features, asvs, samples, sparsity=0.8, metabolome_sparsity=0.1, taxonomy_depth=6,
+                  n_permutations=20, method="pearson", n_workers=None, repeats=1, memory=True, seed=0,
+                  precision="float64", asv_storage="auto", levels=False):
+    """
+    Generate a synthetic dataset and benchmark every stage of the correlation workflow on it.
+    With levels, the correlations of every taxonomic level and the ASVs from one ASV-level run
+    (calculate_level_correlations) are benchmarked as well.
+
+    Returns:
+    dict: The benchmark record (parameters, machine, commit and one entry per stage, and for
+    float32 the deviation from float64).
+    """
+    params = {"features": features, "asvs": asvs, "samples": samples, "sparsity": sparsity,
+              "metabolome_sparsity": metabolome_sparsity, "taxonomy_depth": taxonomy_depth,
+              "n_permutations": n_permutations, "method": method, "precision": precision,
+              "asv_storage": asv_storage, "levels": levels, "repeats": repeats, "seed": seed}
+    # "auto" keeps zero-inflated ASV tables sparse (see SPARSE_ASV_MIN_ZEROS)
+    sparse_asvs = {"auto": None, "dense": False, "sparse": True}[asv_storage]
+    stages = {}
+
+    def stage(name, func):
+        print(f"  {name} ...", end="", flush=True)
+        result, stages[name] = measure(func, repeats, memory)
+        print(f" {stages[name]['wall_s']:.3f} s" + (f", peak {stages[name]['peak_mb']:.1f} MB" if memory else ""))
+        return result
+
+    met_ft = stage("generate_metabolome", lambda: synthetic_metabolome(features, samples, metabolome_sparsity, seed))
+    asv_table = stage("generate_asvs", lambda: synthetic_asv_table(asvs, samples, sparsity, taxonomy_depth,
+                                                                  seed=seed + 1))
+    taxonomic_levels = list(TAXONOMIC_LEVELS[:taxonomy_depth])
+    # every level is binned in one pass, as on the load page
+    stage("bin_all_taxonomic_levels", lambda: bin_all_taxonomic_levels(asv_table, taxonomic_levels))
+
+    met_ft, gen_ft, _ = stage("filter_feature_tables",
+                              lambda: filter_feature_tables(met_ft, asv_table.drop(columns=taxonomic_levels)))
+    target_df = combine_dataframes(met_ft, gen_ft)
+
+    with CorrelationExecutor(n_workers) as executor:
+        params["n_workers"] = executor.n_workers
+        # the cost model's prediction, to check it against the measured stages
+        predicted = CostModel.load().predict(len(met_ft), len(gen_ft), samples, executor.n_workers, n_permutations,
+                                             precision=precision)
+        stage("start_workers", executor.ensure_healthy)
+        results = stage("calculate_correlations_parallel",
+                        lambda: calculate_correlations_parallel(target_df, met_ft, gen_ft, method=method,
+                                                                executor=executor, precision=precision,
+                                                                sparse_asvs=sparse_asvs))
+        stage("melt_correlation_results", lambda: melt_correlation_results(results))
+        if levels:
+            taxonomy = asv_table.loc[gen_ft.index, taxonomic_levels]
+            stage("calculate_level_correlations",
+                  lambda: calculate_level_correlations(target_df, met_ft, gen_ft, taxonomy,
+                                                       taxonomic_levels + [ASV_LEVEL], method=method,
+                                                       executor=executor, precision=precision,
+                                                       sparse_asvs=sparse_asvs))
+        decoy = stage("calculate_permutation_histograms",
+                      lambda: calculate_permutation_histograms(target_df, met_ft, gen_ft, n_permutations,
+                                                               method=method, executor=executor,
+                                                               precision=precision, sparse_asvs=sparse_asvs))
+    stage("calculate_fdr", lambda: calculate_fdr(results, decoy))
+
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "machine": machine_info(),
+        "params": params,
+        "stages": stages,
+        "predicted": predicted.to_dict(),
+        "max_rss_mb": max_rss_mb(),
+    }
+    if precision != "float64":
+        record["precision_check"] = check_precision(target_df, met_ft, gen_ft, method, precision, results)
+        print(f"  max deviation from float64: {record['precision_check']['max_estimate_deviation']:.1e} (Estimate), "
+              f"{record['precision_check']['max_p_value_deviation']:.1e} (P-value)")
+    return record
+
+
+def _dataset(record):
+    # the parameters that define the workload; repeats and memory tracing do not change it,
+    # and records from before the precision and storage options ran with their defaults
+    return {"precision": "float64", "asv_storage": "auto", "levels": False,
+            **{name: value for name, value in record["params"].items() if name != "repeats"}}
+
+
+def compare(path, baseline=None):
+    """
+    Print the wall time of every stage of the latest record next to an earlier record with the
+    same parameters (the previous one by default, or the one of the given commit).
+    """
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    if not records:
+        print(f"No records in {path}.")
+        return
+
+    latest = records[-1]
+    candidates = [record for record in records[:-1] if _dataset(record) == _dataset(latest)
+                  and (baseline is None or record["commit"] == baseline)]
+    if not candidates:
+        print("No earlier record with the same parameters to compare with.")
+        return
+    earlier = candidates[-1]
+
+    print(f"{'stage':<36}{earlier['commit'] or '?':>12}{latest['commit'] or '?':>12}{'ratio':>8}")
+    for name, stage in latest["stages"].items():
+        if name in earlier["stages"]:
+            before, after = earlier["stages"][name]["wall_s"], stage["wall_s"]
+            ratio = after / before if before else float("nan")
+            print(f"{name:<36}{before:>11.3f}s{after:>11.3f}s{ratio:>8.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.split("\n\n")[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="small", help="preset sizes (default: small)")
+    parser.add_argument("--features", type=int, help="metabolite features")
+    parser.add_argument("--asvs", type=int, help="ASVs")
+    parser.add_argument("--samples", type=int, help="samples")
+    parser.add_argument("--sparsity", type=float, default=0.8, help="fraction of zero ASV counts")
+    parser.add_argument("--metabolome-sparsity", type=float, default=0.1, help="fraction of zero peak areas")
+    parser.add_argument("--taxonomy-depth", type=int, default=6, help="taxonomic levels, 1 (Domain) to 7 (Species)")
+    parser.add_argument("--permutations", type=int, default=20, help="decoy permutations")
+    parser.add_argument("--method", choices=("pearson", "spearman"), default="pearson")
+    parser.add_argument("--precision", choices=("float64", "float32"), default="float64",
+                        help="precision of the correlation run")
+    parser.add_argument("--asv-storage", choices=("auto", "dense", "sparse"), default="auto",
+                        help="keep the ASV matrix sparse (default: if it is mostly zeros)")
+    parser.add_argument("--levels", action="store_true",
+                        help="also correlate every taxonomic level from one ASV-level run")
+    parser.add_argument("--workers", type=int, help="correlation worker processes (default: all CPUs)")
+    parser.add_argument("--repeats", type=int, default=1, help="timed runs per stage; the best one is reported")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run for the peak memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON lines file the record is appended to")
+    parser.add_argument("--compare", metavar="RESULTS", help="compare the latest record of RESULTS and exit")
+    parser.add_argument("--baseline", help="commit to compare with (default: the previous matching record)")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare, args.baseline)
+        return
+
+    sizes = dict(SCALES[args.scale])
+    sizes.update({name: getattr(args, name) for name in sizes if getattr(args, name) is not None})
+    print(f"Benchmark: {sizes['features']} features x {sizes['asvs']} ASVs, {sizes['samples']} samples")
+
+    record = run_benchmark(sizes["features"], sizes["asvs"], sizes["samples"], args.sparsity,
+                           args.metabolome_sparsity, args.taxonomy_depth, args.permutations, args.method,
+                           args.workers, args.repeats, not args.no_memory, args.seed, args.precision,
+                           args.asv_storage, args.levels)
+
+    with open(args.output, "a") as file:
+        file.write(json.dumps(record) + "\n")
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
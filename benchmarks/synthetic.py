@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+TAXONOMIC_LEVELS = ("Domain", "Phylum", "Class", "Order", "Family", "Genus", "Species")
+
+
+def sample_names(n_samples):
+    return [f"S{i:05d}" for i in range(n_samples)]
+
+
+def synthetic_metabolome(n_features, n_samples, sparsity=0.1, seed=0):
+    """
+    Metabolomics feature table (features x samples) with log-normal peak areas.
+
+    Parameters:
+    n_features (int): Number of metabolite features (rows).
+    n_samples (int): Number of samples (columns).
+    sparsity (float): Fraction of peak areas that are zero (not detected).
+    seed (int): Seed of the random generator.
+
+    Returns:
+    pd.DataFrame: Feature table indexed by feature ID.
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(mean=10, sigma=2, size=(n_features, n_samples))
+    values[rng.random(values.shape) < sparsity] = 0
+    return pd.DataFrame(values, index=pd.RangeIndex(1, n_features + 1, name="row ID"),
+                        columns=sample_names(n_samples))
+
+
+def synthetic_asv_table(n_asvs, n_samples, sparsity=0.8, taxonomy_depth=6, branching=4, unassigned=0.1, seed=0):
+    """
+    ASV count table (ASVs x samples) with taxonomic columns in front, like the example 16S table.
+
+    The taxonomy is a tree with `branching` children per taxon, so level k has up to branching**k
+    taxa; a fraction `unassigned` of the ASVs has no assignment (NaN) below a random level.
+
+    Parameters:
+    n_asvs (int): Number of ASVs (rows).
+    n_samples (int): Number of samples (columns).
+    sparsity (float): Fraction of zero counts, as in zero-inflated amplicon data.
+    taxonomy_depth (int): Number of taxonomic levels (1 to 7, Domain to Species).
+    branching (int): Children per taxon.
+    unassigned (float): Fraction of ASVs with an incomplete taxonomy.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    pd.DataFrame: Table indexed by feature ID with the taxonomic columns followed by the sample columns.
+    """
+    if not 1 <= taxonomy_depth <= len(TAXONOMIC_LEVELS):
+        raise ValueError(f"taxonomy_depth must be between 1 and {len(TAXONOMIC_LEVELS)}.")
+    rng = np.random.default_rng(seed)
+
+    counts = rng.negative_binomial(n=2, p=0.05, size=(n_asvs, n_samples)).astype(np.float64)
+    counts[rng.random(counts.shape) < sparsity] = 0
+    table = pd.DataFrame(counts, index=pd.Index([f"ASV_{i}" for i in range(n_asvs)], name="feature_ID"),
+                         columns=sample_names(n_samples))
+
+    # taxon of every ASV at the deepest level; the parents follow by integer division
+    levels = TAXONOMIC_LEVELS[:taxonomy_depth]
+    leaves = rng.integers(0, branching ** taxonomy_depth, size=n_asvs)
+    assigned_depth = np.where(rng.random(n_asvs) < unassigned, rng.integers(1, taxonomy_depth + 1, n_asvs),
+                              taxonomy_depth)
+
+    taxonomy = {}
+    for depth, level in enumerate(levels, start=1):
+        codes = leaves // branching ** (taxonomy_depth - depth)
+        labels = pd.Series([f"{level}_{code}" for code in codes], index=table.index, dtype=object)
+        labels[assigned_depth < depth] = np.nan
+        taxonomy[level] = labels
+
+    return pd.concat([pd.DataFrame(taxonomy), table], axis=1)
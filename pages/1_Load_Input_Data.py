@@ -4,6 +4,8 @@ import pandas as pd
 from src.common import *        # Importing common functionalities
 from src.fileselection import * # Importing file selection functionalities
 
+start_profiling("Load Input Data")
+
 # Introduction Section
 st.markdown("### Please select your method for data input below.")
 
@@ -30,7 +32,9 @@ elif input_method == "Use Example Dataset":
         # Update the last input method
         st.session_state['last_input_method'] = input_method
     
-    load_example()  # Load data into session state
+    with profiled("load example data") as record:
+        load_example()  # Load data into session state
+        record["rows"] = sum(len(st.session_state[key]) for key in ['ft', 'md', 'omics_ft', 'omics_md'])
 
     for file_name, key in zip(["Metabolomics Feature Table", 
                                "Metabolomics MetaData", 
@@ -48,29 +52,34 @@ elif input_method == "Manual Input":
         # Update the last input method
         st.session_state['last_input_method'] = input_method
 
-    st.info("💡 Upload tables in txt (tab separated), tsv, csv or xlsx (Excel) format.")
+    st.info("💡 Upload tables in txt (tab separated), tsv, csv, xlsx (Excel), Parquet or Feather/Arrow format. "
+            "Parquet and Feather load fastest for large tables.")
 
     # Create 2 columns for the ft, md file uploaders
     col1, col2 = st.columns(2)
     with col1:
         ft_file = st.file_uploader("Upload Metabolomics Feature Table", 
-                                   type=["csv", "xlsx", "txt", "tsv"],
+                                   type=list(TABLE_FORMATS),
                                    help = "This table is a key output of LC-MS/MS metabolomics studies. The table presents a list of mass spectral features along with their relative intensities (represented by its integrated peak area) observed across various samples.")
         if ft_file:
-            st.session_state['ft'] = load_ft(ft_file).set_index("row ID")
+            with profiled("load metabolomics feature table") as record:
+                st.session_state['ft'] = load_ft(ft_file, index_column="row ID").set_index("row ID")
+                record["rows"] = len(st.session_state['ft'])
 
     with col2:
         md_file = st.file_uploader("Upload Metabolomics Metadata", 
-                                   type=["csv", "xlsx", "txt", "tsv"],
+                                   type=list(TABLE_FORMATS),
                                    help = "The metadata table is created by the user, providing additional context for the measured samples, such as sample type, species, and tissue type, etc.")
         if md_file:
-            st.session_state['md'] = load_md(md_file).set_index("filename")
+            with profiled("load metabolomics metadata") as record:
+                st.session_state['md'] = load_md(md_file).set_index("filename")
+                record["rows"] = len(st.session_state['md'])
     
     # Create 2 columns for the nw, annotation file uploaders
     col3, col4 = st.columns(2)
     with col3:
         omics_ft_file = st.file_uploader("Upload Proteomics/Genomics Feature Table", 
-                                        type=["csv", "xlsx", "txt", "tsv"],
+                                        type=list(TABLE_FORMATS),
                                         help = ("This table represents the key output of proteomics or genomics studies, "
                                                 "providing a list of proteins, genes, or other molecular entities along with their "
                                                 "quantification (e.g., expression levels or abundances) across various samples. "
@@ -78,16 +87,20 @@ elif input_method == "Manual Input":
                                                 )
                                                 )
         if omics_ft_file:
-            st.session_state['omics_ft'] = load_omics_ft(omics_ft_file)
+            with profiled("load omics feature table") as record:
+                st.session_state['omics_ft'] = load_nw(omics_ft_file).set_index("feature_ID")
+                record["rows"] = len(st.session_state['omics_ft'])
     
     with col4:
         omics_md_file = st.file_uploader("Upload Proteomics/Genomics MetaData", 
-                                           type=["csv", "xlsx", "txt", "tsv"],
+                                           type=list(TABLE_FORMATS),
                                            help = "The metadata table is created by the user, providing additional context for the measured samples, such as sample type, species, and tissue type, etc."
                                            )
         
         if omics_md_file:
-            st.session_state['omics_md'] = load_omics_md(omics_md_file)
+            with profiled("load omics metadata") as record:
+                st.session_state['omics_md'] = load_annotation(omics_md_file).set_index("filename")
+                record["rows"] = len(st.session_state['omics_md'])
 
     # Display headers and 'View all' buttons for each file
     for file_name, key in zip(["Metabolomics Feature Table", 
@@ -117,11 +130,13 @@ if (
     md = st.session_state['md'].copy()
 
     # If data is available, proceed with cleanup and checks
-    cleaned_ft = clean_up_ft(ft)
-    cleaned_md = clean_up_md(md)
+    with profiled("clean metabolomics tables") as record:
+        cleaned_ft = clean_up_ft(ft)
+        cleaned_md = clean_up_md(md)
 
-    # Check if ft column names and md row names are the same
-    cleaned_md, cleaned_ft = check_columns(cleaned_md, cleaned_ft)
+        # Check if ft column names and md row names are the same
+        cleaned_md, cleaned_ft = check_columns(cleaned_md, cleaned_ft)
+        record["rows"] = len(cleaned_ft)
     
     st.markdown("#### Metabolomics Metadata overview")
     df = inside_levels(cleaned_md)
@@ -160,7 +175,7 @@ if (
 
             # Display the final filtered data
             with st.expander(f"Filtered Group {final_ft.shape}"):
-                st.dataframe(final_ft)
+                result_browser(final_ft, "final_ft")
                 st.dataframe(final_md)
 
             # Update session state with the final filtered tables
@@ -206,35 +221,48 @@ if (
 
             st.write("#### Rearranged Omics Quant Table:")
             rearranged_table = omics_ft[taxonomic_order + [col for col in omics_ft.columns if col not in relevant_columns]]
-            st.dataframe(rearranged_table)
+            result_browser(rearranged_table, "rearranged_table")
 
             # Allow the user to select the taxonomic level from the available options
             selected_level = st.selectbox("Select a taxonomic level to bin the data:", taxonomic_order)
 
             # Perform binning based on the selected level
-            binned_by_level = bin_by_taxonomic_level(rearranged_table, selected_level)
-            binned_level_filtered = binned_by_level[binned_by_level['Overall_sum'] > 0]
+            with profiled("bin by taxonomic level") as record:
+                binned_by_level = bin_by_taxonomic_level(rearranged_table, selected_level)
+                binned_level_filtered = binned_by_level[binned_by_level['Overall_sum'] > 0]
+                record["rows"] = len(binned_level_filtered)
             st.session_state['binned_omics_table'] = binned_level_filtered
+            # the ASVs and their taxonomy, for correlating several levels at once on the next page
+            st.session_state['asv_table'] = clean_up_omics_ft(rearranged_table)
+            st.session_state['taxonomy'] = rearranged_table[taxonomic_order]
 
             with st.expander(f"Binned Data at Level: {selected_level} , Original Dimension: {binned_by_level.shape}"):
-                st.dataframe(binned_by_level)
+                result_browser(binned_by_level, "binned_by_level")
 
             # Display the binned table
             with st.expander(f"Binned Data at Level: {selected_level} , Filtered Dimension: {binned_level_filtered.shape}"):
-                st.dataframe(binned_level_filtered)
+                result_browser(binned_level_filtered, "binned_level_filtered")
 
             
+        else:
+            st.session_state.pop('asv_table', None)
+            st.session_state.pop('taxonomy', None)
+
     else:
         st.session_state['binned_omics_table'] = omics_ft
+        st.session_state.pop('asv_table', None)
+        st.session_state.pop('taxonomy', None)
 
 
     # If data is available, proceed with cleanup and checks
-    cleaned_omics_ft = clean_up_omics_ft(st.session_state['binned_omics_table'])
-    #st.dataframe(cleaned_omics_ft)
-    cleaned_omics_md = clean_up_omics_md(omics_md)
-
-    # Check if ft column names and md row names are the same
-    cleaned_omics_md, cleaned_omics_ft = check_columns(cleaned_omics_md, cleaned_omics_ft)
+    with profiled("clean omics tables") as record:
+        cleaned_omics_ft = clean_up_omics_ft(st.session_state['binned_omics_table'])
+        #st.dataframe(cleaned_omics_ft)
+        cleaned_omics_md = clean_up_omics_md(omics_md)
+
+        # Check if ft column names and md row names are the same
+        cleaned_omics_md, cleaned_omics_ft = check_columns(cleaned_omics_md, cleaned_omics_ft)
+        record["rows"] = len(cleaned_omics_ft)
     st.markdown("#### Metagenomics Metadata overview")
     df = inside_levels(cleaned_omics_md)
     st.dataframe(df)
@@ -272,7 +300,7 @@ if (
 
             # Display the final filtered data
             with st.expander(f"Filtered Group {final_omics_ft.shape}"):
-                st.dataframe(final_omics_ft)
+                result_browser(final_omics_ft, "final_omics_ft")
                 st.dataframe(final_omics_md)
 
             # Update session state with the final filtered tables
@@ -292,4 +320,6 @@ if (
 
 else:
     # If data is not available, display a message
-    st.warning("Data not loaded. Please load the data first.")
\ No newline at end of file
+    st.warning("Data not loaded. Please load the data first.")
+
+profiling_panel()
@@ -5,9 +5,10 @@ from src.common import *        # Importing common functionalities
 from src.fileselection import * # Importing file selection functionalities
 from src.correlation import *
 from src.fdr import *
-import random
-from multiprocessing import Pool
-from datetime import datetime
+from src.cache import *
+from src.multiple_testing import *
+
+start_profiling("Correlation Analysis")
 
 st.markdown("### Metabolomics-Metagenomics Data Combined")
 
@@ -17,55 +18,221 @@ st.markdown("### Metabolomics-Metagenomics Data Combined")
 if 'metabolome_ft' in st.session_state and 'genomics_ft' in st.session_state:
     met_ft = st.session_state['metabolome_ft']
     gen_ft = st.session_state['genomics_ft']
-    gen_ft = gen_ft[~(gen_ft.eq(0).all(axis=1))]
 
-    # Combine the DataFrames
-    target_df = combine_dataframes(met_ft, gen_ft)
+    # With the ASVs and their taxonomy from the first page, several taxonomic levels can be
+    # correlated from one ASV-level run instead of the binned table
+    levels = []
+    if st.session_state.get('taxonomy') is not None:
+        taxonomy = st.session_state['taxonomy']
+        levels = st.multiselect("Correlate several taxonomic levels from one ASV-level run",
+                                [*taxonomy.columns, ASV_LEVEL],
+                                help=("Every level is binned from all ASVs of the selected samples; the omics feature "
+                                      "filters are applied to every level after binning. All pairs are kept."))
+    if levels:
+        gen_ft = st.session_state['asv_table'][gen_ft.columns]
 
-    #Create a Decoy set
-    random.seed(42)
+    # Features that cannot give informative correlations are removed before any pair is computed
+    with st.expander("Feature filters"):
+        st.write("Constant features (e.g. ASVs that are zero in all samples) are always removed.")
+        c1, c2 = st.columns(2)
+        metabolome_filters = feature_filter_inputs(c1, "Metabolomics", "metabolome")
+        genome_filters = feature_filter_inputs(c2, "Omics", "genome")
+    with profiled("feature filters") as record:
+        # the bins of the levels are sums of all ASVs, so their filters are applied after binning
+        met_ft, gen_ft, filter_report = filter_feature_tables(met_ft, gen_ft, metabolome_filters,
+                                                              {} if levels else genome_filters)
+        record["rows"] = len(met_ft) + len(gen_ft)
 
-    # Permute the values of genomics_ft
-    decoy_gen_df = gen_ft.apply(np.random.permutation)
-    decoy_gen_df += np.random.normal(0, 0.1, decoy_gen_df.shape)  # Add noise
-    decoy_df = combine_dataframes(met_ft, decoy_gen_df)
+    st.info(f"Kept {filter_report['metabolome']['kept']:,} of {filter_report['metabolome']['features']:,} "
+            f"metabolomics features and {filter_report['genome']['kept']:,} of "
+            f"{filter_report['genome']['features']:,} omics features: "
+            f"{filter_report['pairs_removed']:,} of {filter_report['pairs_before']:,} pairs removed.")
+    if filter_report["pairs_removed"]:
+        with st.expander("Removed features per filter"):
+            st.dataframe(filter_report_table(filter_report))
+    if met_ft.empty or gen_ft.empty:
+        st.warning("No features are left to correlate; relax the feature filters.")
+        st.stop()
+
+    # Combine the DataFrames
+    with profiled("combine tables") as record:
+        target_df = combine_dataframes(met_ft, gen_ft)
+        record["rows"] = len(target_df)
 
-    # Shuffle rows and columns of genomics_ft
-    #shuffled_columns = random.sample(list(gen_ft.columns), len(gen_ft.columns))
-    #shuffled_rows = random.sample(list(gen_ft.index), len(gen_ft.index))
+    #Create the Decoy sets
+    # Seeded permutations of the ASV samples: only their score histograms are computed, from the
+    # standardized target data, and reruns with the same seed are served from the result cache
+    decoy_seed = st.number_input("Decoy seed", min_value=0, value=42, step=1)
+    n_permutations = st.number_input("Decoy permutations", min_value=1, max_value=1000, value=100, step=10,
+                                     help="The FDR curve is averaged over the permutations, with a 95% confidence band.")
+    permutations = sample_permutations(target_df.shape[1], n_permutations, decoy_seed)
 
-    #gen_ft_decoy = gen_ft.loc[shuffled_rows, shuffled_columns]
-    #decoy_df = combine_dataframes(met_ft, gen_ft_decoy)
+    # First decoy for display: the ASV samples in the order of the first permutation
+    decoy_gen_df = pd.DataFrame(gen_ft[target_df.columns].values[:, permutations[0]], index=gen_ft.index,
+                                columns=target_df.columns)
+    decoy_df = combine_dataframes(met_ft, decoy_gen_df)
 
     # Display the combined DataFrame in Streamlit
     with st.expander(f"Target Dataframe {target_df.shape}"):
-                st.dataframe(target_df)
-    with st.expander(f"Decoy Dataframe {decoy_df.shape}"):
-                st.dataframe(decoy_df)
+                result_browser(target_df, "target_df")
+    with st.expander(f"Decoy Dataframe {decoy_df.shape} (first of {n_permutations} permutations)"):
+                result_browser(decoy_df, "decoy_df")
 
     # Perform Correlation ########################################################
-    # Record the start time
-    # start_time = datetime.now()
-    # st.write(f"Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    # the stages of every run are timed, see the Profiling panel in the sidebar
 
-    #Give the time message to the user
-    estimate_run_time(met_ft, gen_ft)
-    
-    with st.spinner("Calculating correlations..."):
-        target_results = calculate_correlations_parallel(target_df, met_ft, gen_ft)
-        decoy_results = calculate_correlations_parallel(decoy_df, met_ft, gen_ft)
-        #merged_list = merge_asv_correlation_results(results, target_df, gen_ft
+    correlation_method = st.selectbox("Correlation method", ["Pearson", "Spearman"],
+                                      help="Spearman correlates the ranks of the abundances and is robust to skewed data.")
+    method = correlation_method.lower()
+
+    bh_scope = st.selectbox("Benjamini-Hochberg correction", ["Across all pairs", "Per ASV"],
+                            help="Correct the p-values over all metabolite-ASV pairs of the experiment, or within each ASV.")
+    correction = "global" if bh_scope == "Across all pairs" else "per_asv"
+
+    precision_label = st.radio("Precision", ["Double (float64)", "Single (float32)"], horizontal=True,
+                               help=("Single precision halves the memory of the correlation results and speeds up "
+                                     "the run. It is checked against double precision on a sample of pairs."))
+    precision = "float32" if precision_label == "Single (float32)" else "float64"
+
+    # the multi-level mode keeps all pairs of every level in memory
+    output_mode = "All pairs"
+    if not levels:
+        output_mode = st.radio("Correlation output", ["All pairs", "Only pairs beyond a cutoff"], horizontal=True,
+                               help=("Keeping only the strong pairs makes memory and run time scale with the number "
+                                     "of hits; the FDR curve is still built from all pairs."))
+    if output_mode == "Only pairs beyond a cutoff":
+        c1, c2 = st.columns(2)
+        min_abs_estimate = c1.number_input("Minimum absolute correlation", min_value=0.0, max_value=1.0,
+                                           value=0.5, step=0.05)
+        top_k = c2.number_input("Keep only the strongest partners per feature (0 = all)", min_value=0, value=0)
+
+    # Runs whose results don't fit the memory budget are computed tile by tile
+    tiled_run = False
+    if not levels:
+        memory_budget_mb = st.number_input("Memory budget for the correlation results (MB)",
+                                           min_value=64, value=4096, step=256,
+                                           help=("Larger runs are computed tile by tile: the scores are written to "
+                                                 "disk on the server and only the FDR histograms are kept in memory."))
+        tiled_run = estimate_result_size_mb(met_ft, gen_ft, precision) > memory_budget_mb
+
+    # long-lived worker pool shared by the target and decoy runs and by all reruns
+    with profiled("start workers"):
+        executor = get_correlation_executor()
+
+    # predicted run time and peak memory on this server; runs above its memory limit are refused
+    if output_mode == "Only pairs beyond a cutoff":
+        run_options = dict(mode="sparse", min_abs_estimate=min_abs_estimate, top_k=top_k or None)
+    elif tiled_run:
+        run_options = dict(mode="tiled", memory_budget_mb=memory_budget_mb)
+    else:
+        run_options = dict(mode="dense")
+    check_run_cost(met_ft, gen_ft, executor.n_workers, n_permutations, correction=correction, precision=precision,
+                   **run_options)
+    # runs with the same inputs and options are served from disk
+    result_cache = get_result_cache()
+    # the decoy is run on the table that is shown (the binned table of the level in the multi-level mode)
+    decoy_inputs = (target_df, met_ft, gen_ft)
+
+    if levels:
+        with st.spinner("Calculating correlations of every level..."), \
+                profiled("target correlations (levels)") as record:
+            level_results = cached_level_correlations(result_cache, target_df, met_ft, gen_ft, taxonomy, levels,
+                                                      method=method, correction=correction, executor=executor,
+                                                      precision=precision, level_filters=genome_filters)
+            record["rows"] = sum(results.histogram.total for results in level_results.values())
+        st.info("Features per level: " + ", ".join(f"{level} {len(results.asv_names):,}"
+                                                    for level, results in level_results.items()))
+
+        shown_level = st.selectbox("Taxonomic level for the FDR curve and the scores", levels)
+        level_ft = level_feature_tables(target_df, met_ft, gen_ft, taxonomy, [shown_level], genome_filters)[shown_level]
+        decoy_inputs = (combine_dataframes(met_ft, level_ft), met_ft, level_ft)
+
+        with profiled("melt results") as record:
+            melted_target = melt_correlation_results(level_results[shown_level])
+            record["rows"] = len(melted_target)
 
-    melted_target = melt_correlation_results(target_results)
-    melted_decoy = melt_correlation_results(decoy_results)
+        st.session_state['Target_scores'] = level_results[shown_level].histogram
+        st.session_state['Target_table'] = melted_target
 
-    st.session_state['Target_scores'] = melted_target
-    st.session_state['Decoy_scores'] = melted_decoy
+        with st.expander(f"Correlation Scores of {shown_level} {melted_target.shape}"):
+                    result_browser(melted_target, "melted_target")
 
-    with st.expander(f"Correlation Scores of Target Dataframe {melted_target.shape}"):
-                st.dataframe(melted_target)
-    with st.expander(f"Correlation Scores of Decoy Dataframe {melted_decoy.shape}"):
-                st.dataframe(melted_decoy)
+    elif output_mode == "Only pairs beyond a cutoff":
+        with st.spinner("Calculating correlations..."), profiled("target correlations") as record:
+            sparse_options = dict(min_abs_estimate=min_abs_estimate, top_k=top_k or None, method=method,
+                                  correction=correction, executor=executor, precision=precision)
+            target_hits, target_histogram = cached_sparse_correlations(result_cache, target_df, met_ft, gen_ft,
+                                                                       **sparse_options)
+            record["rows"] = len(target_hits)
+
+        st.session_state['Target_scores'] = target_histogram
+        st.session_state['Target_table'] = target_hits
+
+        with st.expander(f"Correlation Scores of Target Dataframe {target_hits.shape}"):
+                    result_browser(target_hits, "target_hits")
+                    if correction == "global":
+                        # only the p-values a hit can have are kept for the correction over all pairs
+                        bh_exact_up_to = sparse_bh_keep_below(min_abs_estimate, None, len(target_df.columns))
+                        st.caption(f"BH-Corrected P-Values are exact up to {bh_exact_up_to:.3g}; larger ones are "
+                                   f"conservative upper bounds.")
+
+    elif not tiled_run:
+        with st.spinner("Calculating correlations..."), profiled("target correlations") as record:
+            target_results = cached_correlations(result_cache, target_df, met_ft, gen_ft, method=method,
+                                                 correction=correction, executor=executor, precision=precision)
+            record["rows"] = target_results.histogram.total
+            #merged_list = merge_asv_correlation_results(results, target_df, gen_ft
+
+        with profiled("melt results") as record:
+            melted_target = melt_correlation_results(target_results)
+            record["rows"] = len(melted_target)
+
+        st.session_state['Target_scores'] = target_results.histogram
+        st.session_state['Target_table'] = melted_target
+
+        with st.expander(f"Correlation Scores of Target Dataframe {melted_target.shape}"):
+                    result_browser(melted_target, "melted_target")
+
+    else:
+        # the scores are written into the result cache entry of the run, so identical reruns reuse
+        # them and old runs are evicted under the size cap of the cache
+        with st.spinner("Calculating correlations tile by tile..."), \
+                profiled("target correlations (tiled)") as record:
+            target_histogram, target_path = cached_tiled_correlations(result_cache, target_df, met_ft, gen_ft,
+                                                                      memory_budget_mb=memory_budget_mb,
+                                                                      method=method, correction=correction,
+                                                                      executor=executor, precision=precision)
+            record["rows"] = target_histogram.total
+
+        st.session_state['Target_scores'] = target_histogram
+        # the scores are on disk only
+        st.session_state.pop('Target_table', None)
+
+        st.info(f"The results exceed the memory budget and were written to the server:\n\n"
+                f"- Target scores ({target_histogram.total} pairs): `{target_path}`")
+
+    # single precision results are compared with double precision on a sample of pairs
+    if precision == "float32":
+        with profiled("precision check") as record:
+            precision_report = check_precision(target_df, met_ft, gen_ft, method, precision,
+                                               target_results if output_mode == "All pairs" and not tiled_run
+                                               and not levels else None)
+            record["rows"] = precision_report["pairs"]
+        message = (f"Single precision: the largest deviation from double precision on {precision_report['pairs']:,} "
+                   f"sampled pairs is {precision_report['max_estimate_deviation']:.1e} for the estimates and "
+                   f"{precision_report['max_p_value_deviation']:.1e} for the p-values.")
+        if precision_report["passed"]:
+            st.info(message)
+        else:
+            st.warning(f"{message}\n\nThis is more than {PRECISION_TOLERANCE:g}; use double precision for this dataset.")
+
+    # all decoy permutations in one batched run; only their histograms are kept
+    with st.spinner(f"Calculating {n_permutations} decoy permutations..."), profiled("decoy permutations") as record:
+        st.session_state['Decoy_scores'] = cached_permutation_histograms(result_cache, *decoy_inputs,
+                                                                         n_permutations=n_permutations,
+                                                                         seed=decoy_seed, method=method,
+                                                                         executor=executor, precision=precision)
+        record["rows"] = int(st.session_state['Decoy_scores'].counts.sum())
     
     st.markdown('### False Discovery Rate')
 
@@ -75,17 +242,27 @@ if 'metabolome_ft' in st.session_state and 'genomics_ft' in st.session_state:
         decoy_scores = st.session_state['Decoy_scores']
 
         st.write('Select the positive and negative cutoffs for the correlation scores based on your FDR-curve')
-        overall_fdr_table, fig_histogram, fig_fdr = calculate_fdr(target_scores, decoy_scores, score_range=(-1, 1), bin_size=0.001)
+        with profiled("FDR curve and figures") as record:
+            overall_fdr_table = calculate_fdr_table(target_scores, decoy_scores, score_range=(-1, 1), bin_size=0.001)
+            fig_histogram, fig_fdr = cached_fdr_figures(overall_fdr_table, target_scores, decoy_scores)
+            record["rows"] = len(overall_fdr_table)
 
         st.plotly_chart(fig_histogram)
         st.plotly_chart(fig_fdr)
 
-        # # Record the start time
-        # end_time = datetime.now()
-        # st.write(f"Start Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-
-
-
+        # q-value of every target pair: the lowest FDR of a cutoff that accepts it
+        if 'Target_table' in st.session_state:
+            target_table = st.session_state['Target_table']
+            # kept next to the table, so the (possibly very long) table is not copied for one column
+            with profiled("target-decoy q-values") as record:
+                target_qvalues = target_decoy_qvalues(target_table['Estimate'], overall_fdr_table)
+                record["rows"] = len(target_qvalues)
+            with st.expander(f"Correlation Scores with Target-Decoy q-values "
+                             f"{(target_table.shape[0], target_table.shape[1] + 1)}"):
+                        result_browser(target_table, "target_table",
+                                       extra_columns={'Target-Decoy q-value': target_qvalues})
 
 else:
     st.warning("Please input the data in the first page to continue the analysis here")
+
+profiling_panel()
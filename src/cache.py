@@ -0,0 +1,418 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .correlation import (ASV_LEVEL, calculate_correlations_parallel, calculate_level_correlations,
+                          calculate_permutation_histograms, calculate_score_histogram, calculate_sparse_correlations,
+                          TileWriter)
+from .histogram import PermutationHistograms, ScoreHistogram
+from .results import CorrelationResults, RESULT_COLUMNS
+
+# bump when the stored layout changes, so old entries are never read
+CACHE_VERSION = 3
+
+DEFAULT_CACHE_DIR = os.environ.get("CORROMICS_CACHE_DIR",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "corromics"))
+DEFAULT_CACHE_SIZE_MB = float(os.environ.get("CORROMICS_CACHE_SIZE_MB", 4096))
+DEFAULT_TABLE_CACHE_SIZE_MB = float(os.environ.get("CORROMICS_TABLE_CACHE_SIZE_MB", 1024))
+# temporary entries not written to for this long were left behind by an interrupted run
+STALE_TEMP_ENTRY_SECONDS = 24 * 3600
+
+
+def fingerprint(*parts):
+    """
+    Content hash of DataFrames, Series, Index objects, arrays, bytes and JSON-serializable parameters.
+    Equal inputs give the same key in every session and after server restarts.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"corromics-cache-v{CACHE_VERSION}".encode())
+
+    for part in parts:
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            digest.update(b"frame")
+            digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+            if isinstance(part, pd.DataFrame):
+                digest.update(pd.util.hash_pandas_object(part.columns.to_series(), index=False).to_numpy().tobytes())
+        elif isinstance(part, pd.Index):
+            digest.update(b"index")
+            digest.update(pd.util.hash_pandas_object(part.to_series(), index=False).to_numpy().tobytes())
+        elif isinstance(part, np.ndarray):
+            digest.update(f"array{part.dtype.str}{part.shape}".encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(b"bytes")
+            digest.update(part)
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of correlation runs.
+
+    Every entry is a directory named by its key with one .npy file per array, so large results
+    are memory-mapped on load instead of being read and parsed. The total size is capped; when
+    it is exceeded, the least recently used entries are evicted (the access time is kept as the
+    modification time of the entry directory). Temporary entries of interrupted runs are removed
+    once they are older than STALE_TEMP_ENTRY_SECONDS.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size_mb=DEFAULT_CACHE_SIZE_MB):
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 ** 2
+        os.makedirs(directory, exist_ok=True)
+        self.remove_stale_temp_entries()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self._entry(key))
+
+    def load(self, key):
+        """
+        The arrays stored under key (memory-mapped), or None if there is no such entry.
+        """
+        entry = self._entry(key)
+        try:
+            arrays = {
+                file_name[:-len(".npy")]: np.load(os.path.join(entry, file_name), mmap_mode="r", allow_pickle=False)
+                for file_name in os.listdir(entry) if file_name.endswith(".npy")
+            }
+            os.utime(entry)
+        except (FileNotFoundError, ValueError):
+            # missing, evicted meanwhile or only partially readable
+            return None
+        return arrays
+
+    def entry_path(self, key):
+        """
+        Directory of the entry stored under key (it may not exist).
+        """
+        return self._entry(key)
+
+    def temp_entry(self):
+        """
+        New temporary directory inside the cache, for files that are written before they are stored
+        with save(key, arrays, temp_entry=...). It is not an entry until then.
+        """
+        temp_entry = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(temp_entry)
+        return temp_entry
+
+    def save(self, key, arrays, temp_entry=None):
+        """
+        Store a dictionary of arrays under key and evict old entries if the cache is too large.
+
+        Files already written to a temp_entry directory are stored with the arrays. Such an entry
+        is stored even if it alone exceeds the size cap (the files could not be recomputed
+        otherwise); it is then the first one evicted by the next save.
+        """
+        if key in self:
+            os.utime(self._entry(key))
+            if temp_entry is not None:
+                shutil.rmtree(temp_entry, ignore_errors=True)
+            return
+
+        size = sum(np.asarray(array).nbytes for array in arrays.values())
+        if size > self.max_size and temp_entry is None:
+            return
+
+        # write to a temporary directory first, so readers never see half-written entries
+        if temp_entry is None:
+            temp_entry = self.temp_entry()
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_entry, f"{name}.npy"), np.asarray(array), allow_pickle=False)
+        try:
+            os.rename(temp_entry, self._entry(key))
+        except OSError:
+            # another session stored the same run meanwhile
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        (key, size in bytes, last access time) of all entries, least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((key, size, os.path.getmtime(entry)))
+            except FileNotFoundError:
+                continue
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def remove_stale_temp_entries(self, max_age=STALE_TEMP_ENTRY_SECONDS):
+        """
+        Remove the temporary entries (see temp_entry) that nothing was written to for max_age seconds.
+        """
+        now = time.time()
+        for name in os.listdir(self.directory):
+            temp_entry = os.path.join(self.directory, name)
+            if not name.startswith(".tmp-") or not os.path.isdir(temp_entry):
+                continue
+            try:
+                # files that are still being written (e.g. tiles) keep the entry fresh
+                last_write = max([os.path.getmtime(temp_entry)] +
+                                 [os.path.getmtime(os.path.join(temp_entry, file_name))
+                                  for file_name in os.listdir(temp_entry)])
+            except FileNotFoundError:
+                continue
+            if now - last_write > max_age:
+                shutil.rmtree(temp_entry, ignore_errors=True)
+
+    def evict(self, keep=None):
+        self.remove_stale_temp_entries()
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        for key, _, _ in self.entries():
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+
+
+def file_digest(file, chunk_size=16 * 1024 ** 2):
+    """
+    Content hash of a file given by its path, or of an uploaded (in-memory) file without copying it.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(file, str):
+        with open(file, "rb") as handle:
+            for chunk in iter(lambda: handle.read(chunk_size), b""):
+                digest.update(chunk)
+    elif hasattr(file, "getbuffer"):
+        with file.getbuffer() as buffer:
+            digest.update(buffer)
+    else:
+        file.seek(0)
+        digest.update(file.read())
+    return digest.hexdigest()
+
+
+class TableCache:
+    """
+    In-memory cache of parsed input tables, shared by all sessions of a server process.
+
+    Tables are keyed by the content hash of the file and the loader with its options, so a rerun
+    with an unchanged upload (or the same file uploaded in another session) is served without
+    parsing it again, while a changed file or option is parsed anew. The memory of the cached tables
+    is capped; when it is exceeded, the least recently used tables are evicted. Tables larger than
+    the cap are not cached.
+    """
+
+    def __init__(self, max_size_mb=DEFAULT_TABLE_CACHE_SIZE_MB):
+        self.max_size = max_size_mb * 1024 ** 2
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def load(self, loader, file, **options):
+        """
+        loader(file, **options), served from the cache if this file content was parsed with the same
+        loader and options before. Every call gets its own (shallow) copy of the cached table.
+        """
+        key = fingerprint("table", f"{loader.__module__}.{loader.__qualname__}", file_digest(file), options)
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return self._tables[key][0].copy(deep=False)
+
+        if not isinstance(file, str):
+            file.seek(0)
+        table = loader(file, **options)
+
+        size = int(table.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            self.misses += 1
+            # unreadable files give an empty table, which is not cached so a retry parses again
+            if not table.empty and size <= self.max_size and key not in self._tables:
+                self._tables[key] = (table, size)
+                self.size += size
+                self.evict()
+        return table.copy(deep=False)
+
+    def evict(self):
+        # called with the lock held
+        while self.size > self.max_size and self._tables:
+            _, (_, size) = self._tables.popitem(last=False)
+            self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.size = 0
+
+
+def _saveable(values):
+    # names are stored without pickling: numeric labels keep their dtype, everything else becomes str
+    values = np.asarray(values)
+    return values.astype(str) if values.dtype.kind == "O" else values
+
+
+def _run_key(kind, df, metabolome_ft, genome_ft, options):
+    # the worker pool does not change the results
+    options = {name: value for name, value in options.items() if name != "executor"}
+    return fingerprint(kind, df, metabolome_ft.index, genome_ft.index, options)
+
+
+def _histogram_options(options):
+    return options.get("score_range", (-1, 1)), options.get("bin_size", 0.001)
+
+
+def cached_correlations(cache, df, metabolome_ft, genome_ft, **options):
+    """
+    calculate_correlations_parallel with the results served from the cache when the same
+    aligned inputs and options have been run before. Decoy runs are keyed by the decoy
+    matrix itself, so a fixed decoy seed gives cache hits as well.
+    """
+    key = _run_key("correlations", df, metabolome_ft, genome_ft, options)
+    arrays = cache.load(key)
+    if arrays is not None:
+        histogram = ScoreHistogram.from_counts(arrays["histogram"], *_histogram_options(options))
+        return CorrelationResults(arrays["feature_names"], arrays["asv_names"], arrays["values"], histogram)
+
+    results = calculate_correlations_parallel(df, metabolome_ft, genome_ft, **options)
+    cache.save(key, {
+        "feature_names": _saveable(results.feature_names),
+        "asv_names": _saveable(results.asv_names),
+        "values": results.values,
+        "histogram": results.histogram.counts,
+    })
+    return results
+
+
+def cached_level_correlations(cache, df, metabolome_ft, genome_ft, taxonomy, levels, **options):
+    """
+    calculate_level_correlations with the results of every level served from the cache, keyed by
+    the taxonomy and the levels as well.
+    """
+    levels = list(levels)
+    key = _run_key("level_correlations", df, metabolome_ft, genome_ft, dict(options, levels=levels))
+    key = fingerprint(key, taxonomy.loc[genome_ft.index])
+    arrays = cache.load(key)
+    if arrays is not None:
+        results = {}
+        for position, level in enumerate(levels):
+            histogram = ScoreHistogram.from_counts(arrays[f"histogram_{position}"], *_histogram_options(options))
+            names = pd.Index(arrays[f"asv_names_{position}"],
+                             name=genome_ft.index.name if level == ASV_LEVEL else level)
+            results[level] = CorrelationResults(arrays["feature_names"], names, arrays[f"values_{position}"],
+                                                histogram)
+        return results
+
+    results = calculate_level_correlations(df, metabolome_ft, genome_ft, taxonomy, levels, **options)
+    arrays = {"feature_names": _saveable(metabolome_ft.index)}
+    for position, level_results in enumerate(results.values()):
+        arrays[f"asv_names_{position}"] = _saveable(level_results.asv_names)
+        arrays[f"values_{position}"] = level_results.values
+        arrays[f"histogram_{position}"] = level_results.histogram.counts
+    cache.save(key, arrays)
+    return results
+
+
+def cached_score_histogram(cache, df, metabolome_ft, genome_ft, **options):
+    """
+    calculate_score_histogram with the counts served from the cache.
+    """
+    key = _run_key("score_histogram", df, metabolome_ft, genome_ft, options)
+    arrays = cache.load(key)
+    if arrays is not None:
+        return ScoreHistogram.from_counts(arrays["histogram"], *_histogram_options(options))
+
+    histogram = calculate_score_histogram(df, metabolome_ft, genome_ft, **options)
+    cache.save(key, {"histogram": histogram.counts})
+    return histogram
+
+
+def cached_permutation_histograms(cache, df, metabolome_ft, genome_ft, **options):
+    """
+    calculate_permutation_histograms with the per-permutation counts served from the cache.
+    The permutations are seeded, so the same seed and number of permutations give cache hits.
+    """
+    key = _run_key("permutation_histograms", df, metabolome_ft, genome_ft, options)
+    arrays = cache.load(key)
+    if arrays is not None:
+        return PermutationHistograms.from_counts(arrays["histograms"], *_histogram_options(options))
+
+    histograms = calculate_permutation_histograms(df, metabolome_ft, genome_ft, **options)
+    cache.save(key, {"histograms": histograms.counts})
+    return histograms
+
+
+def cached_sparse_correlations(cache, df, metabolome_ft, genome_ft, **options):
+    """
+    calculate_sparse_correlations with the hits and histogram served from the cache.
+    """
+    key = _run_key("sparse_correlations", df, metabolome_ft, genome_ft, options)
+    arrays = cache.load(key)
+    if arrays is not None:
+        histogram = ScoreHistogram.from_counts(arrays["histogram"], *_histogram_options(options))
+        hits = pd.DataFrame({"Feature": arrays["Feature"], "Variable": arrays["Variable"]})
+        for column in RESULT_COLUMNS:
+            hits[column] = arrays[column]
+        return hits, histogram
+
+    hits, histogram = calculate_sparse_correlations(df, metabolome_ft, genome_ft, **options)
+    arrays = {column: hits[column].to_numpy() for column in RESULT_COLUMNS}
+    arrays["Feature"] = _saveable(hits["Feature"])
+    arrays["Variable"] = _saveable(hits["Variable"])
+    arrays["histogram"] = histogram.counts
+    cache.save(key, arrays)
+    return hits, histogram
+
+
+def cached_tiled_correlations(cache, df, metabolome_ft, genome_ft, file_format="csv", **options):
+    """
+    calculate_correlations_parallel in the tiled mode (memory_budget_mb), with the scores written
+    by a TileWriter into the cache entry of the run. Identical reruns reuse the file and the
+    histogram, and the files are evicted with the other entries under the size cap of the cache.
+
+    Returns:
+    tuple: (ScoreHistogram, path of the scores file)
+    """
+    key = _run_key("tiled_correlations", df, metabolome_ft, genome_ft, dict(options, file_format=file_format))
+    file_name = f"target_scores.{file_format}"
+    path = os.path.join(cache.entry_path(key), file_name)
+    arrays = cache.load(key)
+    if arrays is not None and os.path.exists(path):
+        return ScoreHistogram.from_counts(arrays["histogram"], *_histogram_options(options)), path
+
+    temp_entry = cache.temp_entry()
+    try:
+        histogram = calculate_correlations_parallel(df, metabolome_ft, genome_ft,
+                                                    tile_consumers=[TileWriter(os.path.join(temp_entry, file_name),
+                                                                               file_format)],
+                                                    **options)
+    except BaseException:
+        shutil.rmtree(temp_entry, ignore_errors=True)
+        raise
+    cache.save(key, {"histogram": histogram.counts}, temp_entry=temp_entry)
+    return histogram, path
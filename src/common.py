@@ -1,7 +1,17 @@
 import streamlit as st
 import pandas as pd
 import io
+import os
 import uuid
+import contextlib
+from .executor import CorrelationExecutor, default_worker_count
+from .cache import ResultCache, TableCache
+from .cost_model import CostModel, default_memory_limit_mb, format_duration
+from .fdr import fdr_figures
+from .histogram import PermutationHistograms, ScoreHistogram
+from .preprocessing import open_df
+from .profiling import Profiler
+from .results import query_results, result_page
 
 def clear_cache_button():
    if st.button("Clear Cache"):
@@ -9,6 +19,8 @@ def clear_cache_button():
         if hasattr(st, "cache_data"):
             st.cache_data.clear()
         if hasattr(st, "cache_resource"):
+            # stop the worker pool before the resource that holds it is dropped
+            _correlation_executor().shutdown()
             st.cache_resource.clear()
         st.success("Cache cleared!")
 
@@ -44,6 +56,8 @@ def page_setup():
                 ["svg", "png", "jpeg", "webp"],
                 key="image_format",
             )
+            st.caption(f"correlation workers: {_correlation_executor().n_workers}, shared by all sessions on this "
+                       f"server (set with CORROMICS_N_WORKERS)")
         v_space(1)
         # Add the clear cache button
         clear_cache_button()
@@ -63,35 +77,47 @@ dataframe_names = ("md",
                    "an_analog")
 
 
+# worker processes of the correlation pool; a server setting, since the pool is shared by all sessions
+N_WORKERS = int(os.environ.get("CORROMICS_N_WORKERS") or default_worker_count())
+
+
+@st.cache_resource
+def _correlation_executor():
+    return CorrelationExecutor(N_WORKERS)
+
+
+def get_correlation_executor():
+    """
+    The correlation worker pool of this server process, shared by all sessions and reruns.
+    Its size is set with CORROMICS_N_WORKERS; it is restarted if a health check fails.
+    """
+    return _correlation_executor().ensure_healthy()
+
+
+@st.cache_resource
+def get_result_cache():
+    """
+    On-disk cache of correlation runs, shared by all sessions and kept across server restarts.
+    Its location and size cap are set with CORROMICS_CACHE_DIR and CORROMICS_CACHE_SIZE_MB.
+    """
+    return ResultCache()
+
+
+@st.cache_resource
+def get_table_cache():
+    """
+    In-memory cache of parsed input tables, shared by all sessions of this server process.
+    Its size cap is set with CORROMICS_TABLE_CACHE_SIZE_MB.
+    """
+    return TableCache()
+
+
 def reset_dataframes():
     for key in dataframe_names:
         st.session_state[key] = pd.DataFrame()
 
 
 
-def open_df(file):
-    separators = {"txt": "\t", "tsv": "\t", "csv": ","}
-    try:
-        if type(file) == str:
-            ext = file.split(".")[-1]
-            if ext != "xlsx":
-                df = pd.read_csv(file, sep=separators[ext])
-            else:
-                df = pd.read_excel(file)
-        else:
-            ext = file.name.split(".")[-1]
-            if ext != "xlsx":
-                df = pd.read_csv(file, sep=separators[ext])
-            else:
-                df = pd.read_excel(file)
-        
-        # sometimes dataframes get saved with unnamed index, that needs to be removed
-        if "Unnamed: 0" in df.columns:
-            df.drop("Unnamed: 0", inplace=True, axis=1)
-        return df
-    except:
-        return pd.DataFrame()
-
 def show_table(df, title="", col="", download=True):
     if col:
         col = col
@@ -107,6 +133,82 @@ def show_table(df, title="", col="", download=True):
     col.dataframe(df, use_container_width=True)
 
 
+def result_browser(table, key, page_sizes=(25, 50, 100, 500), extra_columns=None):
+    """
+    Paginated view of a table: filtering, sorting and pagination run on the server (query_results,
+    result_page) and only the rows of the visible page are sent to the browser. Result tables with
+    Feature, Variable, Estimate and p-value columns get query inputs for them; other tables (like
+    the feature tables) are paginated only.
+
+    Parameters:
+    table (pd.DataFrame): The table to browse.
+    key (str): Prefix of the widget keys, unique on the page.
+    page_sizes (tuple): Rows per page to choose from.
+    extra_columns (dict): Columns shown after those of the table without adding them to it, as
+                    {name: array with one value per table row} (like the target-decoy q-values).
+    """
+    predicates, sort_by, descending, absolute = {}, None, False, False
+    if "Estimate" in table.columns:
+        c1, c2, c3, c4 = st.columns(4)
+        if "Feature" in table.columns:
+            predicates["feature"] = c1.text_input("Feature contains", key=f"{key}_feature")
+        if "Variable" in table.columns:
+            predicates["variable"] = c2.text_input("Variable contains", key=f"{key}_variable")
+        min_abs_estimate = c3.number_input("Minimum |Estimate|", min_value=0.0, max_value=1.0, value=0.0,
+                                           step=0.05, key=f"{key}_min_abs_estimate")
+        p_value_columns = [column for column in table.columns if "p-value" in column.lower()]
+        max_p_value = c4.number_input(f"Maximum {p_value_columns[0]}" if p_value_columns else "Maximum p-value",
+                                      min_value=0.0, max_value=1.0, value=1.0, format="%g",
+                                      key=f"{key}_max_p_value", disabled=not p_value_columns)
+        # predicates left at their defaults are off, so rows with NaN statistics are kept
+        if min_abs_estimate > 0:
+            predicates["min_abs_estimate"] = min_abs_estimate
+        if p_value_columns and max_p_value < 1:
+            predicates.update(max_p_value=max_p_value, p_value_column=p_value_columns[0])
+
+        numeric_columns = [column for column in table.columns if pd.api.types.is_numeric_dtype(table[column])]
+        numeric_columns += list(extra_columns or {})
+        c1, c2 = st.columns(2)
+        sort_option = c1.selectbox("Sort by", ["Table order", "|Estimate|"] + numeric_columns, key=f"{key}_sort_by")
+        descending = c2.radio("Order", ["Descending", "Ascending"], horizontal=True,
+                              key=f"{key}_order") == "Descending"
+        if sort_option == "|Estimate|":
+            sort_by, absolute = "Estimate", True
+        elif sort_option != "Table order":
+            sort_by = sort_option
+
+    rows = query_results(table, **{name: value for name, value in predicates.items() if value})
+    n_rows = len(table) if rows is None else len(rows)
+
+    c1, c2, c3 = st.columns([0.2, 0.2, 0.6])
+    page_size = c1.selectbox("Rows per page", page_sizes, index=min(1, len(page_sizes) - 1), key=f"{key}_page_size")
+    n_pages = max(1, -(-n_rows // page_size))
+    # a narrower query can leave the current page beyond the last one
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = c2.number_input(f"Page (of {n_pages:,})", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+    start = (page - 1) * page_size
+    stop = min(start + page_size, n_rows)
+
+    v_space(1, c3)
+    c3.caption(f"Rows {min(start + 1, stop):,} to {stop:,} of {n_rows:,}"
+               + (f" matching rows ({len(table):,} in total)" if rows is not None else ""))
+    st.dataframe(result_page(table, rows, start, stop, sort_by, descending, absolute, extra_columns))
+
+
+def _histogram_key(histogram):
+    return histogram.score_range, histogram.bin_size, histogram.counts
+
+
+@st.cache_data(show_spinner=False, hash_funcs={ScoreHistogram: _histogram_key, PermutationHistograms: _histogram_key})
+def cached_fdr_figures(fdr_table, target_scores, decoy_scores):
+    """
+    The figures of an FDR table (fdr_figures), kept per FDR table and score histograms, so reruns
+    of the page (like paging through the results) do not build them again.
+    """
+    return fdr_figures(fdr_table, target_scores, decoy_scores)
+
+
 def show_fig(fig, download_name, container_width=True):
 
     # Set default image format to 'svg' if not specified in session state
@@ -153,3 +255,129 @@ def download_plotly_figure(fig, filename="", col=""):
             file_name=filename,
             mime="application/png",
         )
+
+
+@st.cache_resource
+def get_cost_model():
+    """
+    Cost model of this machine. It is calibrated on first use and the calibration is kept next
+    to the result cache, so later server starts load it instead.
+    """
+    return CostModel.load()
+
+
+def check_run_cost(metabolome_df, genome_df, n_workers, n_permutations, mode="dense", **options):
+    """
+    Show the predicted run time and peak memory of a correlation run. Runs that would exceed the
+    memory limit of the server (CORROMICS_MEMORY_LIMIT_MB, by default 80% of the physical memory)
+    are refused: the message is shown and the page stops.
+
+    Parameters:
+    metabolome_df, genome_df (pd.DataFrame): The feature tables to correlate (features x samples).
+    n_workers (int): Correlation worker processes.
+    n_permutations (int): Decoy permutations.
+    mode (str): "dense", "sparse" or "tiled", with the options of CostModel.predict.
+
+    Returns:
+    RunCost: The prediction.
+    """
+    cost = get_cost_model().predict(metabolome_df.shape[0], genome_df.shape[0], metabolome_df.shape[1], n_workers,
+                                    n_permutations, mode, **options)
+    memory_limit_mb = default_memory_limit_mb()
+    message = (f"Estimated run time: about {format_duration(cost.total_seconds)} "
+               f"(target {format_duration(cost.target_seconds)}, {n_permutations} decoys "
+               f"{format_duration(cost.decoy_seconds)}, output {format_duration(cost.output_seconds)}). "
+               f"Estimated peak memory: {cost.peak_mb:,.0f} MB.")
+
+    if memory_limit_mb is not None and cost.peak_mb > memory_limit_mb:
+        st.error(f"{message}\n\nThis exceeds the memory limit of the server ({memory_limit_mb:,.0f} MB). "
+                 "Keep only the pairs beyond a cutoff, lower the memory budget for the results so the run is "
+                 "computed tile by tile, use fewer decoy permutations or filter the feature tables.")
+        st.stop()
+    elif memory_limit_mb is not None and cost.peak_mb > 0.5 * memory_limit_mb:
+        st.warning(f"{message}\n\nThis is more than half of the memory limit of the server "
+                   f"({memory_limit_mb:,.0f} MB).")
+    elif cost.total_seconds > 600:
+        st.warning(message)
+    else:
+        st.info(message)
+    return cost
+
+
+def feature_filter_inputs(container, label, key):
+    """
+    Inputs for the pre-correlation feature filters of one feature table; filters left at 0 are off.
+
+    Returns:
+    dict: Keyword arguments for filter_features.
+    """
+    container.markdown(f"**{label}**")
+    min_prevalence = container.number_input("Minimum prevalence (% of samples with a nonzero value)",
+                                            min_value=0.0, max_value=100.0, value=0.0, step=5.0,
+                                            key=f"{key}_min_prevalence")
+    min_mean = container.number_input("Minimum mean abundance", min_value=0.0, value=0.0, key=f"{key}_min_mean")
+    min_variance = container.number_input("Minimum variance", min_value=0.0, value=0.0, format="%g",
+                                          key=f"{key}_min_variance")
+    min_cv = container.number_input("Minimum coefficient of variation", min_value=0.0, value=0.0, step=0.1,
+                                    key=f"{key}_min_cv")
+    top_n_variable = container.number_input("Keep only the most variable features (0 = all)", min_value=0,
+                                            value=0, step=100, key=f"{key}_top_n_variable")
+
+    filters = {"min_prevalence": min_prevalence / 100, "min_mean": min_mean, "min_variance": min_variance,
+               "min_cv": min_cv, "top_n_variable": top_n_variable}
+    return {name: value for name, value in filters.items() if value}
+
+
+def start_profiling(page):
+    """
+    Start a new profile for this run of the page; profiled stages are recorded in it and shown by
+    profiling_panel. If "Capture the next run with cProfile" was ticked, this run is also captured
+    with cProfile and the box is unticked again.
+    """
+    cprofile = st.session_state.get("cprofile_next_run", False)
+    st.session_state["cprofile_next_run"] = False
+    st.session_state["profiler"] = Profiler(page, cprofile=cprofile)
+    return st.session_state["profiler"]
+
+
+def profiled(stage, rows=None):
+    """
+    Context manager that records the enclosed block as a stage of the page's profile. It yields
+    the stage record, so the number of output rows can be set with record["rows"] = len(table).
+    """
+    profiler = st.session_state.get("profiler")
+    if profiler is None:
+        return contextlib.nullcontext({})
+    return profiler.stage(stage, rows)
+
+
+def profiling_panel():
+    """
+    Sidebar panel with the profile of the last run of the page: wall time, CPU time, peak RSS and
+    rows per stage, the correlation workers, a JSON export and the optional cProfile capture.
+    """
+    profiler = st.session_state.get("profiler")
+    with st.sidebar.expander("⏱️ Profiling"):
+        st.checkbox("Capture the next run with cProfile", key="cprofile_next_run",
+                    help="Profiles every function call of the next run of this page (slower while it runs).")
+        if profiler is None or not profiler.stages:
+            st.caption("No stages were recorded in this run.")
+            return
+
+        st.caption(f"{profiler.name}: {profiler.total_seconds:.2f} s in {len(profiler.stages)} stages")
+        st.dataframe(profiler.table(), hide_index=True)
+
+        workers = pd.DataFrame([dict(worker, stage=record["stage"]) for record in profiler.stages
+                                for worker in record["workers"].values()])
+        if not workers.empty:
+            st.caption("Correlation workers")
+            st.dataframe(workers[["stage", "pid", "tasks", "wall_s", "cpu_s", "peak_rss_mb", "rss_delta_mb"]], hide_index=True)
+
+        st.download_button("Download profile (JSON)", profiler.to_json(indent=2),
+                           file_name=f"profile_{profiler.started}.json", mime="application/json")
+
+        stats = profiler.cprofile_stats()
+        if stats:
+            st.download_button("Download cProfile statistics", stats, file_name=f"cprofile_{profiler.started}.txt",
+                               mime="text/plain")
+            st.code(stats, language=None)
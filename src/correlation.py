@@ -1,208 +1,1337 @@
-import streamlit as st
-from .common import *  # Importing common functionalities from the 'common' module
-import pandas as pd
-import numpy as np
-from scipy.stats import pearsonr
-from statsmodels.stats.multitest import multipletests
-from multiprocessing import Pool
-#import cupy as cp
-
-def combine_dataframes(df1, df2):
-
-    # Align columns by names
-    common_columns = df1.columns.intersection(df2.columns)
-
-    # Subset DataFrames to common columns
-    df1_aligned = df1[common_columns]
-    df2_aligned = df2[common_columns]
-
-    # Combine the DataFrames
-    combined = pd.concat([df1_aligned, df2_aligned], axis=0)
-
-    # Reset index and add 'ID' column
-    combined.reset_index(inplace=True)
-    combined.rename(columns={"index": "ID"}, inplace=True)
-    combined.set_index("ID", inplace=True)
-
-    return combined
-
-
-# def calculate_correlations_gpu(df, metabolome_ft, genome_ft):
-#     """
-#     Faster correlation calculation using GPUs.
-#     """
-#     transposed_df = df.T
-#     length_metabolome = metabolome_ft.shape[0]
-#     length_genome = genome_ft.shape[0]
-
-#     # Convert data to CuPy arrays
-#     metabolomics = cp.asarray(transposed_df.iloc[:, :length_metabolome].values)
-#     asvs = cp.asarray(transposed_df.iloc[:, length_metabolome:length_metabolome + length_genome].values)
-
-#     # Standardize data
-#     metabolomics = (metabolomics - cp.mean(metabolomics, axis=0)) / cp.std(metabolomics, axis=0)
-#     asvs = (asvs - cp.mean(asvs, axis=0)) / cp.std(asvs, axis=0)
-
-#     # Calculate correlation matrix
-#     correlation_matrix = cp.dot(asvs.T, metabolomics) / (asvs.shape[0] - 1)
-#     return cp.asnumpy(correlation_matrix)  # Convert back to NumPy
-
-
-# def calculate_metabolite_asv_correlations(df, metabolome_ft, genome_ft):
-
-#     transposed_df = df.T
-#     length_metabolome = metabolome_ft.shape[0]
-#     length_genome = genome_ft.shape[0]
-
-#     # Initialize an empty list to store results
-#     correlation_results = []
-
-#     # Define ranges for metabolites and ASVs
-#     metabolite_columns = range(length_metabolome)
-#     asv_columns = range(length_genome, length_metabolome + length_genome)
-
-#     # Loop over each ASV column
-#     for asv_index in asv_columns:
-#         asv_column = transposed_df.iloc[:, asv_index]
-
-#         # Calculate correlations for the current ASV column with all metabolite columns
-#         correlations = np.array([
-#             pearsonr(asv_column, transposed_df.iloc[:, metabolite_index])
-#             for metabolite_index in metabolite_columns
-#         ])
-
-#         # Extract estimates and p-values into a matrix
-#         estimates = correlations[:, 0]  # Correlation coefficients
-#         p_values = correlations[:, 1]  # P-values
-#         result_matrix = np.column_stack((estimates, p_values))
-
-#         # Append the matrix to the list
-#         correlation_results.append(result_matrix)
-
-
-#     return transposed_df, correlation_results
-
-
-def calculate_single_asv(asv_index, metabolomics, asvs):
-    """
-    Compute correlations for a single ASV column.
-    """
-    correlations = np.array([pearsonr(asvs[:, asv_index], metabolomics[:, j]) 
-                     for j in range(metabolomics.shape[1])
-                     ])
-    
-    # Extract correlation coefficients and p-values
-    correlation_coefficients = correlations[:, 0]
-    p_values = correlations[:, 1]
-
-    # Calculate R^2 values
-    r_squared = correlation_coefficients ** 2
-    
-    # Apply FDR correction to p-values
-    _, fdr_corrected_p_values, _, _ = multipletests(p_values, method='fdr_bh')
-    
-    # Combine results into a single array
-    result = np.column_stack((correlation_coefficients, p_values, fdr_corrected_p_values, r_squared))
-
-    return result
-    
-
-def calculate_correlations_parallel(df, metabolome_ft, genome_ft):
-    """
-    Faster correlation calculation using parallel processing.
-    """
-
-    transposed_df = df.T
-    length_metabolome = metabolome_ft.shape[0]
-    length_genome = genome_ft.shape[0]
-
-    metabolome_names = metabolome_ft.index
-    asv_names = genome_ft.index
-
-    # Extract metabolomics and ASV columns
-    metabolomics = transposed_df.iloc[:, :length_metabolome].values
-    asvs = transposed_df.iloc[:, length_metabolome:length_metabolome + length_genome].values
-
-    # Use multiprocessing to calculate correlations in parallel
-    with Pool() as pool:
-        results = pool.starmap(calculate_single_asv, 
-                               [(i, metabolomics, asvs) for i in range(asvs.shape[1])])
-        
-    results_with_indices = {
-        asv_names[i]: pd.DataFrame(
-            results[i],
-            index=metabolome_names,
-            columns=["Estimate", "P-value", "BH-Corrected P-Value", "R2"]
-        )
-        for i in range(len(asv_names))
-    }
-
-    return results_with_indices
-
-def merge_asv_correlation_results(results, target_df, genome_ft):
-    """
-    Merge ASV correlation results into a dictionary with dataframes having the same rows as target_df.
-
-    Parameters:
-    results (dict): Dictionary of correlation results for each ASV.
-    target_df (pd.DataFrame): The combined metabolomics and genomics dataframe.
-    gen_ft (pd.DataFrame): Genomics feature table.
-
-    Returns:
-    dict: A dictionary of merged dataframes for each ASV.
-    """
-    merged_list = {}
-
-    empty_asv_df = pd.DataFrame(
-            0,
-            index=genome_ft.index,
-            columns=["Estimate", "P-value", "BH-Corrected P-Value", "R2"]
-        )
-
-    # Loop through each ASV and merge with target_df
-    for asv_name in genome_ft.index:
-        #get each df in the results dictionary
-        df = results[asv_name]
-        
-        #combine the empty_asv_df to that
-        merged_pscores_df = empty_asv_df.combine_first(df)
-        
-        # Merge with target_df to include all sample columns
-        merged_final_df = pd.concat([merged_pscores_df, target_df], axis=1)
-
-        # Add the merged dataframe to the dictionary
-        merged_list[asv_name] = merged_final_df
-
-    return merged_list
-
-
-def melt_correlation_results(results):
-    """
-    Melt a dictionary of correlation dataframes into a single dataframe.
-
-    Parameters:
-    results (dict): Dictionary where keys are ASV names, and values are dataframes 
-                    with correlation results.
-
-    Returns:
-    pd.DataFrame: A single dataframe with all correlation results.
-    """
-    melted_results = []
-
-    for asv_name, df in results.items():
-        # Add Feature and Variable columns
-        df = df.copy()
-        df["Feature"] = df.index  # Index as Feature
-        df["Variable"] = asv_name  # ASV name as Variable
-
-        # Rearrange columns so Feature and Variable are first
-        df = df[["Feature", "Variable"] + list(df.columns[:-2])]  # Reorder columns
-
-        # Append to list
-        melted_results.append(df)
-
-    # Concatenate all dataframes
-    final_df = pd.concat(melted_results, axis=0, ignore_index=True)
-
-    return final_df
-
+import pandas as pd
+import numpy as np
+import os
+import contextlib
+import tempfile
+from collections import namedtuple
+from scipy.sparse import csc_matrix
+from scipy.special import stdtr
+from scipy.stats import rankdata
+from .executor import CorrelationExecutor
+from .histogram import PermutationHistograms, ScoreHistogram
+from .multiple_testing import StreamingBH, partial_sort
+from .preprocessing import _feature_mask, taxonomic_bins
+from .results import CorrelationResults, RESULT_COLUMNS
+from multiprocessing.shared_memory import SharedMemory
+#import cupy as cp
+
+def combine_dataframes(df1, df2):
+
+    # Align columns by names
+    common_columns = df1.columns.intersection(df2.columns)
+
+    # Subset DataFrames to common columns
+    df1_aligned = df1[common_columns]
+    df2_aligned = df2[common_columns]
+
+    # Combine the DataFrames
+    combined = pd.concat([df1_aligned, df2_aligned], axis=0)
+
+    # Reset index and add 'ID' column
+    combined.reset_index(inplace=True)
+    combined.rename(columns={"index": "ID"}, inplace=True)
+    combined.set_index("ID", inplace=True)
+
+    return combined
+
+
+# def calculate_correlations_gpu(df, metabolome_ft, genome_ft):
+#     """
+#     Faster correlation calculation using GPUs.
+#     """
+#     transposed_df = df.T
+#     length_metabolome = metabolome_ft.shape[0]
+#     length_genome = genome_ft.shape[0]
+
+#     # Convert data to CuPy arrays
+#     metabolomics = cp.asarray(transposed_df.iloc[:, :length_metabolome].values)
+#     asvs = cp.asarray(transposed_df.iloc[:, length_metabolome:length_metabolome + length_genome].values)
+
+#     # Standardize data
+#     metabolomics = (metabolomics - cp.mean(metabolomics, axis=0)) / cp.std(metabolomics, axis=0)
+#     asvs = (asvs - cp.mean(asvs, axis=0)) / cp.std(asvs, axis=0)
+
+#     # Calculate correlation matrix
+#     correlation_matrix = cp.dot(asvs.T, metabolomics) / (asvs.shape[0] - 1)
+#     return cp.asnumpy(correlation_matrix)  # Convert back to NumPy
+
+
+# def calculate_metabolite_asv_correlations(df, metabolome_ft, genome_ft):
+
+#     transposed_df = df.T
+#     length_metabolome = metabolome_ft.shape[0]
+#     length_genome = genome_ft.shape[0]
+
+#     # Initialize an empty list to store results
+#     correlation_results = []
+
+#     # Define ranges for metabolites and ASVs
+#     metabolite_columns = range(length_metabolome)
+#     asv_columns = range(length_genome, length_metabolome + length_genome)
+
+#     # Loop over each ASV column
+#     for asv_index in asv_columns:
+#         asv_column = transposed_df.iloc[:, asv_index]
+
+#         # Calculate correlations for the current ASV column with all metabolite columns
+#         correlations = np.array([
+#             pearsonr(asv_column, transposed_df.iloc[:, metabolite_index])
+#             for metabolite_index in metabolite_columns
+#         ])
+
+#         # Extract estimates and p-values into a matrix
+#         estimates = correlations[:, 0]  # Correlation coefficients
+#         p_values = correlations[:, 1]  # P-values
+#         result_matrix = np.column_stack((estimates, p_values))
+
+#         # Append the matrix to the list
+#         correlation_results.append(result_matrix)
+
+
+#     return transposed_df, correlation_results
+
+
+def standardize(matrix, dtype=np.float64):
+    """
+    Z-score every column of a samples x variables matrix (mean 0, sample standard deviation 1).
+
+    Constant columns have no defined correlation, so they are set to NaN instead of
+    raising a division warning; their estimates and p-values then come out as NaN.
+
+    Parameters:
+    matrix (np.ndarray): 2D array with samples as rows and variables as columns.
+    dtype (np.dtype): Type of the standardized matrix. The means and standard deviations are
+                      computed in float64 either way, as raw peak areas can be large.
+
+    Returns:
+    np.ndarray: The standardized matrix.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    centered = matrix - matrix.mean(axis=0)
+    std = centered.std(axis=0, ddof=1)
+    std[std == 0] = np.nan
+
+    return np.divide(centered, std, out=centered).astype(dtype, copy=False)
+
+
+def rank_transform(matrix):
+    """
+    Rank every column of a samples x variables matrix; ties get their average rank.
+    Correlating the ranks with the Pearson engine gives Spearman's rank correlation.
+    """
+    return rankdata(np.asarray(matrix, dtype=np.float64), method="average", axis=0)
+
+
+def correlation_pvalues(estimates, n_samples):
+    """
+    Two-sided p-values for correlation coefficients from the Student t-distribution
+    with n_samples - 2 degrees of freedom (the same test scipy's pearsonr performs).
+    """
+    dof = n_samples - 2
+    if dof < 1:
+        return np.full_like(estimates, np.nan)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_stat = np.abs(estimates) * np.sqrt(dof / (1 - estimates ** 2))
+
+    return 2 * stdtr(dof, -t_stat)
+
+
+def benjamini_hochberg(p_values, axis=0):
+    """
+    Vectorized Benjamini-Hochberg correction along one axis of a p-value matrix.
+    NaN p-values are ignored and stay NaN, so each column is corrected over its tested pairs only.
+
+    Parameters:
+    p_values (np.ndarray): 2D array of p-values.
+    axis (int): Axis holding the p-values of one test family; None corrects all p-values as one family.
+
+    Returns:
+    np.ndarray: BH-adjusted p-values with the same shape as the input.
+    """
+    if axis is None:
+        return benjamini_hochberg(np.ravel(p_values), axis=0).reshape(np.shape(p_values))
+
+    p_values = np.asarray(p_values)
+    # float32 p-values (see PRECISIONS) are corrected in float32
+    dtype = p_values.dtype if p_values.dtype in (np.float32, np.float64) else np.float64
+    p_values = np.moveaxis(p_values.astype(dtype, copy=False), axis, 0)
+
+    order = np.argsort(p_values, axis=0)  # NaNs are sorted to the end
+    sorted_p = np.take_along_axis(p_values, order, axis=0)
+
+    n_tests = np.sum(~np.isnan(p_values), axis=0).astype(dtype)
+    ranks = np.arange(1, p_values.shape[0] + 1, dtype=dtype).reshape(-1, *([1] * (p_values.ndim - 1)))
+
+    # step-up: running minimum of p * m / rank from the largest p-value downwards
+    adjusted = sorted_p * n_tests / ranks
+    adjusted = np.fmin.accumulate(adjusted[::-1], axis=0)[::-1]
+    adjusted = np.minimum(adjusted, 1)
+    adjusted[np.isnan(sorted_p)] = np.nan
+
+    corrected = np.empty_like(adjusted)
+    np.put_along_axis(corrected, order, adjusted, axis=0)
+
+    return np.moveaxis(corrected, 0, axis)
+
+
+def calculate_asv_chunk(metabolomics_z, asvs_z):
+    """
+    Compute correlations of a block of standardized ASV columns against all standardized metabolites
+    with a single matrix product.
+
+    Returns:
+    tuple: (estimates, p_values), both of shape (metabolites, ASVs in the block).
+    """
+    estimates = _chunk_estimates(metabolomics_z, asvs_z)
+    p_values = correlation_pvalues(estimates, metabolomics_z.shape[0])
+
+    return estimates, p_values
+
+
+def _chunk_estimates(metabolomics_z, asvs_z):
+    if isinstance(asvs_z, SparseColumns):
+        # the scale of the sparse columns already includes 1 / (n - 1)
+        return np.clip(metabolomics_z.T @ asvs_z.matrix * asvs_z.scale, -1, 1)
+    return np.clip(metabolomics_z.T @ asvs_z / (metabolomics_z.shape[0] - 1), -1, 1)
+
+
+# ASV matrices with at least this fraction of zeros are kept sparse unless sparse_asvs says otherwise
+SPARSE_ASV_MIN_ZEROS = 0.9
+
+
+class SparseColumns:
+    """
+    Standardized ASV columns of a zero-inflated table, kept in compressed sparse column format.
+
+    Only the nonzero values are stored, uncentered, together with the factor
+    1 / ((n_samples - 1) * standard deviation) of every column. The standardized metabolite
+    columns sum to zero, so their products with the raw columns equal those with the centered
+    columns: metabolomics_z.T @ matrix * scale gives the estimates of the dense path, and a
+    matrix product costs time in proportion to the nonzero values.
+
+    Slicing supports the column blocks the workers use (asvs[:, start:stop]).
+    """
+
+    def __init__(self, data, indices, indptr, scale, n_samples):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.scale = scale
+        self.shape = (n_samples, len(indptr) - 1)
+
+    @classmethod
+    def from_dense(cls, matrix, method="pearson", dtype=np.float64):
+        """
+        Parameters:
+        matrix (np.ndarray): 2D array with samples as rows and ASVs as columns.
+        method (str): "pearson", or "spearman" to store the ranks of every column, shifted so that
+                      the zeros keep rank 0 (correlations do not change under a shift).
+        dtype (np.dtype): Type of the values and scales.
+        """
+        matrix = csc_matrix(np.asarray(matrix, dtype=np.float64))
+        n_samples, n_columns = matrix.shape
+        data, indptr = matrix.data, matrix.indptr
+        columns = np.repeat(np.arange(n_columns), np.diff(indptr))
+        missing = np.bincount(columns[np.isnan(data)], minlength=n_columns) > 0
+        if method == "spearman":
+            data = _shifted_sparse_ranks(data, indptr, n_samples)
+
+        # mean and sum of squared deviations including the implicit zeros
+        means = np.bincount(columns, weights=data, minlength=n_columns) / n_samples
+        squares = (np.bincount(columns, weights=(data - means[columns]) ** 2, minlength=n_columns)
+                   + (n_samples - np.diff(indptr)) * means ** 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = 1 / ((n_samples - 1) * np.sqrt(squares / (n_samples - 1)))
+        # constant columns, as in standardize, and columns with missing values
+        scale[~np.isfinite(scale) | missing] = np.nan
+
+        return cls(data.astype(dtype, copy=False), matrix.indices, indptr, scale.astype(dtype), n_samples)
+
+    @property
+    def matrix(self):
+        return csc_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+    @property
+    def itemsize(self):
+        return self.data.itemsize
+
+    def __getitem__(self, key):
+        rows, columns = key
+        if rows != slice(None) or not isinstance(columns, slice) or columns.step not in (None, 1):
+            raise TypeError("SparseColumns only supports column blocks, e.g. asvs[:, start:stop].")
+        start, stop, _ = columns.indices(self.shape[1])
+        stop = max(start, stop)
+        first, last = self.indptr[start], self.indptr[stop]
+        return SparseColumns(self.data[first:last], self.indices[first:last], self.indptr[start:stop + 1] - first,
+                             self.scale[start:stop], self.shape[0])
+
+    def permuted(self, permutations):
+        """
+        The columns with their samples reordered by every permutation, side by side (the sparse
+        counterpart of matrix[permutations].transpose(1, 0, 2).reshape(n_samples, -1)).
+        """
+        n_permutations = len(permutations)
+        n_values = len(self.data)
+        # sample i moves to the row k with permutation[k] == i
+        inverse = np.argsort(permutations, axis=1).astype(self.indices.dtype)
+        indptr = (self.indptr[:-1] + n_values * np.arange(n_permutations)[:, None]).ravel()
+        return SparseColumns(np.tile(self.data, n_permutations), inverse[:, self.indices].ravel(),
+                             np.append(indptr, n_values * n_permutations), np.tile(self.scale, n_permutations),
+                             self.shape[0])
+
+
+def _shifted_sparse_ranks(data, indptr, n_rows):
+    """
+    Average rank of every stored value of a CSC matrix among all n_rows values of its column
+    (the implicit zeros included), minus the rank of the zeros, so the zeros stay implicit.
+    """
+    n_columns = len(indptr) - 1
+    counts = np.diff(indptr)
+    columns = np.repeat(np.arange(n_columns), counts)
+    order = np.lexsort((data, columns))
+    values, value_columns = data[order], columns[order]
+
+    # runs of equal values within a column share the average of their positions
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (value_columns[1:] != value_columns[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(values)))
+    run_positions = run_starts - indptr[value_columns[run_starts]] + (run_lengths - 1) / 2
+    positions = np.repeat(run_positions, run_lengths)
+
+    # the zeros rank after the negative values and before the positive ones
+    zeros = (n_rows - counts)[value_columns]
+    negatives = np.bincount(columns[data < 0], minlength=n_columns)[value_columns]
+    ranks = positions + 1 + np.where(values > 0, zeros, 0) - (negatives + (zeros + 1) / 2)
+
+    shifted = np.empty_like(ranks)
+    shifted[order] = ranks
+    return shifted
+
+
+class SharedArrays:
+    """
+    Shared-memory segments for the worker pool.
+
+    Workers receive only small (name, shape, dtype) references to the segments, so the
+    volume sent to the pool does not depend on the size of the matrices or the number of ASVs.
+    The owner never keeps views on the segments; arrays are copied in and out.
+    """
+
+    def __init__(self):
+        self._segments = {}
+
+    def empty(self, shape, dtype=np.float64):
+        dtype = np.dtype(dtype)
+        segment = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self._segments[segment.name] = segment
+        return segment.name, tuple(shape), dtype.str
+
+    def share(self, array):
+        if isinstance(array, SparseColumns):
+            # the parts are shared one by one and put together again by the workers
+            return SparseRef(array.shape[0], tuple(self.share(part) for part in
+                                                   (array.data, array.indices, array.indptr, array.scale)))
+        array = np.ascontiguousarray(array)
+        ref = self.empty(array.shape, array.dtype)
+        _shared_view(ref, self._segments[ref[0]])[...] = array
+        return ref
+
+    def to_array(self, ref):
+        return _shared_view(ref, self._segments[ref[0]]).copy()
+
+    def close(self):
+        for segment in self._segments.values():
+            _close_segment(segment)
+            segment.unlink()
+        self._segments = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# reference to SparseColumns in shared memory: the number of samples and the refs of its arrays
+SparseRef = namedtuple("SparseRef", ["n_samples", "parts"])
+
+
+def _shared_view(ref, segment):
+    name, shape, dtype = ref
+    return np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def _close_segment(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # a view is still referenced (e.g. by a traceback); the mapping is released with it
+        pass
+
+
+def _correlate_into(metabolomics, asvs, estimates, p_values, asv_start, asv_stop, out_start, score_range, bin_size):
+    chunk_estimates, chunk_p_values = calculate_asv_chunk(metabolomics, asvs[:, asv_start:asv_stop])
+    out_stop = out_start + (asv_stop - asv_start)
+    estimates[:, out_start:out_stop] = chunk_estimates
+    p_values[:, out_start:out_stop] = chunk_p_values
+
+    # the FDR histogram is built while the chunk is still at hand
+    return ScoreHistogram.from_estimates(chunk_estimates, score_range, bin_size)
+
+
+def _histogram_chunk(metabolomics, asvs, asv_start, asv_stop, score_range, bin_size):
+    return ScoreHistogram.from_estimates(_chunk_estimates(metabolomics, asvs[:, asv_start:asv_stop]),
+                                         score_range, bin_size)
+
+
+def _run_shared_task(task):
+    """
+    Worker entry point: attach to the shared segments referenced by the task, call its function
+    with views on them followed by its remaining arguments, and detach again.
+    """
+    func, refs, args = task
+    segments = []
+
+    def attach(ref):
+        if isinstance(ref, SparseRef):
+            return SparseColumns(*[attach(part) for part in ref.parts], ref.n_samples)
+        segments.append(SharedMemory(name=ref[0]))
+        return _shared_view(ref, segments[-1])
+
+    try:
+        return func(*[attach(ref) for ref in refs], *args)
+    finally:
+        for segment in segments:
+            _close_segment(segment)
+
+
+# ASV chunks per worker and block, so that faster workers can pick up more chunks
+CHUNKS_PER_WORKER = 4
+
+
+def _chunk_edges(n_asvs, n_workers):
+    n_chunks = max(1, min(n_asvs, n_workers * CHUNKS_PER_WORKER))
+    return np.linspace(0, n_asvs, n_chunks + 1).astype(int)
+
+
+def _correlate_asv_block(executor, metabolomics_ref, asvs_ref, asv_start, asv_stop, score_range=(-1, 1),
+                         bin_size=0.001):
+    """
+    Correlate the shared standardized ASV columns asv_start:asv_stop against all shared
+    metabolites. The block is split into ASV chunks; the workers write their chunk straight
+    into shared output arrays, so neither inputs nor results are pickled, and return only
+    a histogram of their estimates.
+
+    Returns:
+    tuple: (estimates, p_values, histogram); the arrays have the shape (metabolites, asv_stop - asv_start).
+    """
+    _, (_, n_metabolites), dtype = metabolomics_ref
+    width = asv_stop - asv_start
+    edges = _chunk_edges(width, executor.n_workers)
+
+    with SharedArrays() as outputs:
+        # the results have the precision of the standardized inputs
+        estimates_ref = outputs.empty((n_metabolites, width), dtype)
+        p_values_ref = outputs.empty((n_metabolites, width), dtype)
+
+        refs = (metabolomics_ref, asvs_ref, estimates_ref, p_values_ref)
+        tasks = [(_correlate_into, refs, (asv_start + start, asv_start + stop, start, score_range, bin_size))
+                 for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+        histogram = ScoreHistogram.merged(executor.map(_run_shared_task, tasks), score_range, bin_size)
+
+        return outputs.to_array(estimates_ref), outputs.to_array(p_values_ref), histogram
+
+
+CORRELATION_METHODS = ("pearson", "spearman")
+
+# "global": one Benjamini-Hochberg family over all pairs; "per_asv": one family per ASV
+BH_CORRECTIONS = ("global", "per_asv")
+
+
+def _check_correction(correction):
+    if correction not in BH_CORRECTIONS:
+        raise ValueError(f"Invalid correction: {correction}. Must be one of {BH_CORRECTIONS}.")
+
+
+# "float32" halves the memory of the standardized matrices, the shared outputs and the stored
+# results and speeds up the matrix products; check_precision measures what it costs in accuracy
+PRECISIONS = ("float64", "float32")
+
+
+def _check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision: {precision}. Must be one of {PRECISIONS}.")
+
+
+def _split_standardized(df, metabolome_ft, genome_ft, method="pearson", precision="float64", sparse_asvs=None):
+    """
+    The standardized metabolite and ASV matrices (samples x features) of the combined dataframe.
+    The ASVs are returned as SparseColumns if sparse_asvs is set, or if it is None and at least
+    SPARSE_ASV_MIN_ZEROS of their values are zero.
+    """
+    if method not in CORRELATION_METHODS:
+        raise ValueError(f"Invalid correlation method: {method}. Must be one of {CORRELATION_METHODS}.")
+    _check_precision(precision)
+
+    transposed_df = df.T
+    length_metabolome = metabolome_ft.shape[0]
+    length_genome = genome_ft.shape[0]
+
+    # Extract metabolomics and ASV columns
+    metabolomics = transposed_df.iloc[:, :length_metabolome].values
+    asvs = transposed_df.iloc[:, length_metabolome:length_metabolome + length_genome].values
+
+    if sparse_asvs is None:
+        sparse_asvs = asvs.size > 0 and 1 - np.count_nonzero(asvs) / asvs.size >= SPARSE_ASV_MIN_ZEROS
+
+    # Spearman: rank each matrix once, then take the same path as Pearson
+    if method == "spearman":
+        metabolomics = rank_transform(metabolomics)
+        if not sparse_asvs:
+            asvs = rank_transform(asvs)
+
+    if sparse_asvs:
+        return standardize(metabolomics, precision), SparseColumns.from_dense(asvs, method, precision)
+    return standardize(metabolomics, precision), standardize(asvs, precision)
+
+
+# Bytes per metabolite-ASV pair while an ASV block is open (shared estimates and p-values
+# written by the workers, their copies and the BH-corrected p-values) and while a tile is
+# handed to consumers (R2 plus a long-format table for export).
+BLOCK_BYTES_PER_PAIR = 5 * 8
+TILE_BYTES_PER_PAIR = 8 * 8
+
+
+def plan_tiles(n_metabolites, n_asvs, n_samples, memory_budget_mb, precision="float64"):
+    """
+    Choose tile sizes for the tiled correlation mode.
+
+    The BH correction is done per ASV, so the statistics of an ASV block are kept for all
+    metabolites until the block is finished; half of the budget goes to this block, the other
+    half to the tile (a metabolite x ASV sub-block) that is passed on to the consumers.
+
+    Parameters:
+    n_metabolites (int): Number of metabolite features.
+    n_asvs (int): Number of ASVs.
+    n_samples (int): Number of samples.
+    memory_budget_mb (float): Memory budget for the run in MB.
+    precision (str): "float64" or "float32", the type of the inputs and results (see PRECISIONS).
+
+    Returns:
+    tuple: (asv_block_size, feature_tile_size)
+    """
+    itemsize = np.dtype(precision).itemsize
+    budget = memory_budget_mb * 1024 ** 2
+    # the standardized input matrices are always kept in memory
+    budget -= n_samples * (n_metabolites + n_asvs) * itemsize
+    if budget <= 0:
+        raise ValueError(f"A memory budget of {memory_budget_mb} MB does not fit the input matrices.")
+
+    block_bytes_per_pair = BLOCK_BYTES_PER_PAIR * itemsize / 8
+    asv_block_size = int(min(n_asvs, max(1, budget / 2 // (max(n_metabolites, 1) * block_bytes_per_pair))))
+    feature_tile_size = int(min(n_metabolites, max(1, budget / 2 // (asv_block_size * TILE_BYTES_PER_PAIR))))
+
+    return asv_block_size, feature_tile_size
+
+
+class CorrelationTile:
+    """
+    One finished block of the metabolite x ASV correlation matrix.
+    All statistic arrays have the shape (number of features, number of ASVs) of the tile.
+    """
+
+    def __init__(self, feature_names, asv_names, estimates, p_values, bh_corrected_p_values):
+        self.feature_names = feature_names
+        self.asv_names = asv_names
+        self.estimates = estimates
+        self.p_values = p_values
+        self.bh_corrected_p_values = bh_corrected_p_values
+        self.r_squared = estimates ** 2
+
+    @property
+    def shape(self):
+        return self.estimates.shape
+
+    def to_frame(self):
+        """
+        Long-format table of the tile with the same columns as melt_correlation_results.
+        """
+        n_features, n_asvs = self.shape
+        frame = pd.DataFrame({
+            "Feature": np.tile(np.asarray(self.feature_names), n_asvs),
+            "Variable": np.repeat(np.asarray(self.asv_names), n_features),
+        })
+        for column, values in zip(RESULT_COLUMNS,
+                                  (self.estimates, self.p_values, self.bh_corrected_p_values, self.r_squared)):
+            frame[column] = values.T.ravel()
+
+        return frame
+
+
+def _executor_scope(executor):
+    """
+    Use the given long-lived executor, or a temporary one that is shut down after the run.
+    """
+    return contextlib.nullcontext(executor) if executor is not None else CorrelationExecutor()
+
+
+def iter_correlation_tiles(df, metabolome_ft, genome_ft, memory_budget_mb, method="pearson", executor=None,
+                           histogram=None, correction="global", bh_keep_below=1.0, precision="float64",
+                           sparse_asvs=None):
+    """
+    Compute the metabolite x ASV correlations tile by tile within a memory budget.
+
+    Parameters:
+    df (pd.DataFrame): The combined metabolomics and genomics dataframe.
+    metabolome_ft (pd.DataFrame): Metabolomics feature table.
+    genome_ft (pd.DataFrame): Genomics feature table.
+    memory_budget_mb (float): Memory budget for the run in MB.
+    method (str): "pearson" or "spearman".
+    executor (CorrelationExecutor): Worker pool to run on; a temporary one is used if None.
+    histogram (ScoreHistogram): If given, the histograms built by the workers are merged into it.
+    correction (str): "global" or "per_asv" (see BH_CORRECTIONS). The global correction needs all
+        p-values before the first tile, so it takes a first pass in which the workers return only
+        their sorted p-values up to bh_keep_below; they are spilled to a temporary directory in
+        runs of a quarter of the memory budget and merged there (see StreamingBH), so the
+        correction is exact over all pairs without holding their p-values in memory.
+    bh_keep_below (float): p-values kept for the global correction; adjusted p-values above it
+        are conservative (or NaN for p-values above it), in exchange for less disk space.
+    precision (str): "float64" or "float32" (see PRECISIONS).
+    sparse_asvs (bool): Keep the ASVs as SparseColumns; None decides by their fraction of zeros.
+
+    Yields:
+    CorrelationTile: The finished tiles, ASV block by ASV block.
+    """
+    metabolomics, asvs = _split_standardized(df, metabolome_ft, genome_ft, method, precision, sparse_asvs)
+    metabolome_names = metabolome_ft.index
+    asv_names = genome_ft.index
+
+    _check_correction(correction)
+    asv_block_size, feature_tile_size = plan_tiles(metabolomics.shape[1], asvs.shape[1],
+                                                   metabolomics.shape[0], memory_budget_mb, precision)
+
+    with SharedArrays() as inputs, _executor_scope(executor) as executor, \
+            tempfile.TemporaryDirectory(prefix="bh-", ignore_cleanup_errors=True) as spill_dir:
+        metabolomics_ref = inputs.share(metabolomics)
+        asvs_ref = inputs.share(asvs)
+
+        global_bh = None
+        if correction == "global":
+            global_bh = StreamingBH(bh_keep_below, spill_dir, memory_budget_mb / 4)
+            for asv_start in range(0, asvs.shape[1], asv_block_size):
+                asv_stop = min(asv_start + asv_block_size, asvs.shape[1])
+                for sorted_p_values, n_tests in _p_value_runs(executor, (metabolomics_ref, asvs_ref), asv_start,
+                                                              asv_stop, bh_keep_below):
+                    global_bh.add_sorted(sorted_p_values, n_tests)
+            global_bh.finalize()
+
+        yield from _iter_block_tiles(executor, metabolomics_ref, asvs_ref, metabolome_names, asv_names,
+                                     asv_block_size, feature_tile_size, histogram, global_bh)
+
+
+def _sorted_p_value_chunk(metabolomics, asvs, asv_start, asv_stop, keep_below):
+    _, p_values = calculate_asv_chunk(metabolomics, asvs[:, asv_start:asv_stop])
+    return partial_sort(p_values, keep_below)
+
+
+def _p_value_runs(executor, refs, asv_start, asv_stop, keep_below):
+    """
+    Sorted p-values up to keep_below and the number of tests of every chunk of an ASV block.
+    """
+    edges = _chunk_edges(asv_stop - asv_start, executor.n_workers) + asv_start
+    tasks = [(_sorted_p_value_chunk, refs, (start, stop, keep_below))
+             for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+    return executor.map(_run_shared_task, tasks)
+
+
+def _iter_block_tiles(executor, metabolomics_ref, asvs_ref, metabolome_names, asv_names, asv_block_size,
+                      feature_tile_size, histogram, global_bh=None):
+    n_metabolites = len(metabolome_names)
+    n_asvs = len(asv_names)
+
+    for asv_start in range(0, n_asvs, asv_block_size):
+        asv_stop = min(asv_start + asv_block_size, n_asvs)
+        if histogram is None:
+            estimates, p_values, _ = _correlate_asv_block(executor, metabolomics_ref, asvs_ref, asv_start, asv_stop)
+        else:
+            estimates, p_values, block_histogram = _correlate_asv_block(
+                executor, metabolomics_ref, asvs_ref, asv_start, asv_stop, histogram.score_range, histogram.bin_size
+            )
+            histogram.merge(block_histogram)
+        if global_bh is None:
+            # a block holds complete ASV columns, so the per-ASV correction is exact
+            fdr_corrected_p_values = benjamini_hochberg(p_values, axis=0)
+        else:
+            fdr_corrected_p_values = global_bh.adjust(p_values)
+
+        for feature_start in range(0, n_metabolites, feature_tile_size):
+            feature_stop = min(feature_start + feature_tile_size, n_metabolites)
+            yield CorrelationTile(
+                metabolome_names[feature_start:feature_stop],
+                asv_names[asv_start:asv_stop],
+                estimates[feature_start:feature_stop],
+                p_values[feature_start:feature_stop],
+                fdr_corrected_p_values[feature_start:feature_stop],
+            )
+
+        # release the block before the next one is allocated
+        del estimates, p_values, fdr_corrected_p_values
+
+
+class TileWriter:
+    """
+    Tile consumer that writes every finished tile to disk, either as one compressed
+    NumPy archive per tile ("npz", readable with read_tiles) or appended to a single
+    long-format table ("csv" or "tsv").
+    """
+
+    def __init__(self, path, file_format="npz"):
+        if file_format not in ("npz", "csv", "tsv"):
+            raise ValueError(f"Unsupported tile format: {file_format}. Must be one of npz, csv, tsv.")
+        self.path = path
+        self.file_format = file_format
+        self.n_tiles = 0
+
+        if file_format == "npz":
+            os.makedirs(path, exist_ok=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def __call__(self, tile):
+        if self.file_format == "npz":
+            np.savez_compressed(
+                os.path.join(self.path, f"tile_{self.n_tiles:06d}.npz"),
+                feature_names=np.asarray(tile.feature_names, dtype=str),
+                asv_names=np.asarray(tile.asv_names, dtype=str),
+                estimates=tile.estimates,
+                p_values=tile.p_values,
+                bh_corrected_p_values=tile.bh_corrected_p_values,
+            )
+        else:
+            tile.to_frame().to_csv(self.path, sep="," if self.file_format == "csv" else "\t",
+                                   mode="a", header=self.n_tiles == 0, index=False)
+        self.n_tiles += 1
+
+
+def read_tiles(directory):
+    """
+    Read back the tiles written by a TileWriter in npz format, in the order they were written.
+    """
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.startswith("tile_") and file_name.endswith(".npz"):
+            with np.load(os.path.join(directory, file_name)) as tile:
+                yield CorrelationTile(tile["feature_names"], tile["asv_names"], tile["estimates"],
+                                      tile["p_values"], tile["bh_corrected_p_values"])
+
+
+def calculate_correlations_parallel(df, metabolome_ft, genome_ft, memory_budget_mb=None, tile_consumers=None,
+                                    method="pearson", executor=None, score_range=(-1, 1), bin_size=0.001,
+                                    correction="global", bh_keep_below=1.0, precision="float64", sparse_asvs=None):
+    """
+    Faster correlation calculation using parallel processing.
+
+    Both matrices are standardized once and placed in shared memory; the workers of the given
+    CorrelationExecutor (a temporary pool if None) correlate chunks of ASVs against all
+    metabolites with a matrix product. method is "pearson" or "spearman"; Spearman ranks both
+    matrices once and reuses the Pearson path, so both produce the same result columns.
+
+    With a memory_budget_mb the run is tiled instead: the results are computed block by block
+    and every finished CorrelationTile is passed to each of the tile_consumers (e.g. a
+    TileWriter), so peak memory depends on the tile size and not on the number of pairs.
+
+    In both modes the workers bin their estimates into ScoreHistograms (score_range, bin_size)
+    for the FDR curve. The BH-Corrected P-Value column is corrected over all pairs in one pass
+    (correction="global", see iter_correlation_tiles for bh_keep_below in the tiled mode), or
+    per ASV with correction="per_asv".
+
+    precision="float32" standardizes, correlates and stores the results in single precision, which
+    halves their memory; check_precision measures the deviation from float64 on a sample of pairs.
+
+    Zero-inflated ASV tables (at least SPARSE_ASV_MIN_ZEROS zeros, or with sparse_asvs=True) are
+    kept as SparseColumns: only their nonzero values are stored and multiplied, and the results
+    equal those of the dense path up to rounding.
+
+    Returns:
+    CorrelationResults: The results of all pairs, with the merged histogram as its histogram
+    attribute; it can be used like a dictionary of one DataFrame per ASV name.
+    In the tiled mode only the ScoreHistogram is returned.
+    """
+    if memory_budget_mb is not None:
+        histogram = ScoreHistogram(score_range, bin_size)
+        for tile in iter_correlation_tiles(df, metabolome_ft, genome_ft, memory_budget_mb, method, executor,
+                                           histogram, correction, bh_keep_below, precision, sparse_asvs):
+            for consumer in tile_consumers or []:
+                consumer(tile)
+        return histogram
+
+    _check_correction(correction)
+    metabolome_names = metabolome_ft.index
+    asv_names = genome_ft.index
+
+    metabolomics, asvs = _split_standardized(df, metabolome_ft, genome_ft, method, precision, sparse_asvs)
+
+    # Use multiprocessing to calculate the ASV chunks in parallel on shared copies of the matrices
+    with SharedArrays() as inputs, _executor_scope(executor) as executor:
+        estimates, p_values, histogram = _correlate_asv_block(executor, inputs.share(metabolomics),
+                                                              inputs.share(asvs), 0, asvs.shape[1],
+                                                              score_range, bin_size)
+
+    # Apply FDR correction to the p-values of all pairs (or of each ASV)
+    fdr_corrected_p_values = benjamini_hochberg(p_values, axis=None if correction == "global" else 0)
+
+    return CorrelationResults.from_arrays(metabolome_names, asv_names, estimates, p_values, fdr_corrected_p_values,
+                                          histogram)
+
+
+def calculate_score_histogram(df, metabolome_ft, genome_ft, method="pearson", executor=None, score_range=(-1, 1),
+                              bin_size=0.001, precision="float64", sparse_asvs=None):
+    """
+    Histogram of all correlation estimates without keeping any of them, e.g. for decoy runs.
+    The workers skip the p-values and return only their chunk histograms, which are merged.
+
+    Returns:
+    ScoreHistogram: Counts of the estimates of all pairs.
+    """
+    metabolomics, asvs = _split_standardized(df, metabolome_ft, genome_ft, method, precision, sparse_asvs)
+
+    with SharedArrays() as inputs, _executor_scope(executor) as executor:
+        refs = (inputs.share(metabolomics), inputs.share(asvs))
+        edges = _chunk_edges(asvs.shape[1], executor.n_workers)
+        tasks = [(_histogram_chunk, refs, (start, stop, score_range, bin_size))
+                 for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+        return ScoreHistogram.merged(executor.map(_run_shared_task, tasks), score_range, bin_size)
+
+
+# Worker memory for the stacked permuted ASV chunk and its estimates in a multi-permutation decoy run
+PERMUTATION_BATCH_MB = 64
+
+
+def sample_permutations(n_samples, n_permutations, seed=42):
+    """
+    n_permutations seeded permutations of the sample order, as an (n_permutations, n_samples) array.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.permuted(np.tile(np.arange(n_samples), (n_permutations, 1)), axis=1)
+
+
+def _permutation_histogram_chunk(metabolomics, asvs, permutations, asv_start, asv_stop, batch_size, score_range,
+                                 bin_size):
+    """
+    Worker task of the multi-permutation decoy: correlate all metabolites against the sample-permuted
+    ASV columns asv_start:asv_stop for every permutation and return only the per-permutation histograms.
+    """
+    n_samples = metabolomics.shape[0]
+    n_asvs = asv_stop - asv_start
+    asv_chunk = asvs[:, asv_start:asv_stop]
+    histograms = PermutationHistograms(len(permutations), score_range, bin_size)
+
+    for start in range(0, len(permutations), batch_size):
+        batch = permutations[start:start + batch_size]
+        # the permuted chunks of a batch side by side, so the whole batch is one matrix product
+        if isinstance(asv_chunk, SparseColumns):
+            stacked = asv_chunk.permuted(batch)
+        else:
+            stacked = asv_chunk[batch].transpose(1, 0, 2).reshape(n_samples, -1)
+        estimates = _chunk_estimates(metabolomics, stacked)
+        batch_histograms = PermutationHistograms(len(batch), score_range, bin_size)
+        batch_histograms.update(estimates.reshape(-1, len(batch), n_asvs).transpose(1, 0, 2))
+        histograms.counts[start:start + len(batch)] += batch_histograms.counts
+
+    return histograms
+
+
+def calculate_permutation_histograms(df, metabolome_ft, genome_ft, n_permutations=100, seed=42, method="pearson",
+                                     executor=None, score_range=(-1, 1), bin_size=0.001, precision="float64",
+                                     sparse_asvs=None):
+    """
+    Multi-permutation decoy: histograms of the correlation estimates after n_permutations seeded
+    permutations of the ASV samples.
+
+    Permuting the samples does not change the mean and standard deviation of a feature (nor its
+    ranks), so the standardized target matrices are computed once and only their rows are reordered.
+    The workers correlate batches of permutations in one matrix product per batch and keep only the
+    histograms, so neither decoy matrices nor decoy estimates are ever stored.
+
+    Returns:
+    PermutationHistograms: One histogram of all estimates per permutation.
+    """
+    metabolomics, asvs = _split_standardized(df, metabolome_ft, genome_ft, method, precision, sparse_asvs)
+    permutations = sample_permutations(metabolomics.shape[0], n_permutations, seed)
+
+    with SharedArrays() as inputs, _executor_scope(executor) as executor:
+        refs = (inputs.share(metabolomics), inputs.share(asvs), inputs.share(permutations))
+        edges = _chunk_edges(asvs.shape[1], executor.n_workers)
+        # per permutation: the permuted chunk plus the estimates and their bin positions
+        permutation_bytes = (metabolomics.itemsize * np.diff(edges).max()
+                             * (metabolomics.shape[0] + 3 * metabolomics.shape[1]))
+        batch_size = max(1, int(PERMUTATION_BATCH_MB * 1024 ** 2 // permutation_bytes))
+        tasks = [(_permutation_histogram_chunk, refs, (start, stop, batch_size, score_range, bin_size))
+                 for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+        return PermutationHistograms.merged(executor.map(_run_shared_task, tasks), n_permutations, score_range,
+                                            bin_size)
+
+
+def _select_hits(estimates, p_values, min_abs_estimate=None, max_p_value=None, top_k=None):
+    """
+    Boolean mask of the pairs to keep: |estimate| >= min_abs_estimate, p-value <= max_p_value
+    and, among those, the top_k strongest partners of every metabolite (row).
+    """
+    keep = ~np.isnan(estimates)
+    if min_abs_estimate is not None:
+        keep &= np.abs(estimates) >= min_abs_estimate
+    if max_p_value is not None:
+        keep &= p_values <= max_p_value
+
+    if top_k is not None and top_k < estimates.shape[1]:
+        strength = np.where(keep, np.abs(estimates), -1)
+        top = np.argpartition(-strength, top_k - 1, axis=1)[:, :top_k]
+        in_top = np.zeros_like(keep)
+        np.put_along_axis(in_top, top, True, axis=1)
+        keep &= in_top
+
+    return keep
+
+
+def _correlate_sparse_chunk(metabolomics, asvs, asv_start, asv_stop, min_abs_estimate, max_p_value, top_k,
+                            score_range, bin_size, bh_keep_below):
+    """
+    Worker task of the sparse mode: correlate the ASV columns asv_start:asv_stop, bin all estimates
+    into a histogram and return only the pairs that pass the filters. For the global correction
+    the sorted p-values up to bh_keep_below are returned as well; otherwise (bh_keep_below None)
+    the hits are corrected per ASV here.
+    """
+    estimates, p_values = calculate_asv_chunk(metabolomics, asvs[:, asv_start:asv_stop])
+    histogram = ScoreHistogram.from_estimates(estimates, score_range, bin_size)
+
+    rows, columns = np.nonzero(_select_hits(estimates, p_values, min_abs_estimate, max_p_value, top_k))
+    if bh_keep_below is None:
+        # the chunk holds complete ASV columns, so the per-ASV correction can be done here
+        fdr_corrected_p_values = benjamini_hochberg(p_values, axis=0)[rows, columns]
+        p_value_run = None
+    else:
+        fdr_corrected_p_values = np.full(len(rows), np.nan, dtype=p_values.dtype)
+        p_value_run = partial_sort(p_values, bh_keep_below)
+    hits = (rows, columns + asv_start, estimates[rows, columns], p_values[rows, columns], fdr_corrected_p_values)
+
+    return hits, histogram, p_value_run
+
+
+def sparse_bh_keep_below(min_abs_estimate, max_p_value, n_samples):
+    """
+    The loosest p-value a hit of a sparse run can have, up to which its global BH correction is exact.
+
+    Returns:
+    float: The p-value of min_abs_estimate for n_samples, or max_p_value if that is smaller (1 if
+    neither is set).
+    """
+    # every hit passes both cutoffs, and the p-value falls with |Estimate|
+    keep_below = 1.0 if max_p_value is None else max_p_value
+    if min_abs_estimate is not None:
+        keep_below = min(keep_below, float(correlation_pvalues(np.float64(min_abs_estimate), n_samples)))
+    return keep_below
+
+
+def calculate_sparse_correlations(df, metabolome_ft, genome_ft, min_abs_estimate=None, max_p_value=None, top_k=None,
+                                  method="pearson", executor=None, score_range=(-1, 1), bin_size=0.001,
+                                  correction="global", precision="float64", sparse_asvs=None):
+    """
+    Correlation run that keeps only the pairs of interest.
+
+    The workers filter their ASV chunks right after computing them and return only the pairs with
+    |Estimate| >= min_abs_estimate and P-value <= max_p_value, plus a histogram of all estimates
+    for the FDR curve. With top_k, only the top_k strongest partners (by |Estimate|) of every
+    metabolite feature are kept. Memory and transfer size therefore scale with the number of hits.
+
+    With correction="global" the hits are BH-corrected over all pairs: the workers also return their
+    sorted p-values up to the loosest p-value a hit can have (sparse_bh_keep_below, see StreamingBH),
+    which is all of them if only top_k is set. BH-Corrected P-Values up to that p-value are exact;
+    larger ones are conservative upper bounds. correction="per_asv" corrects within each ASV.
+
+    Returns:
+    tuple: (hits, histogram): a long-format DataFrame with the columns of melt_correlation_results,
+    and a ScoreHistogram of all estimates.
+    """
+    if min_abs_estimate is None and max_p_value is None and top_k is None:
+        raise ValueError("Set at least one of min_abs_estimate, max_p_value or top_k.")
+
+    _check_correction(correction)
+    metabolome_names = metabolome_ft.index
+    asv_names = genome_ft.index
+    metabolomics, asvs = _split_standardized(df, metabolome_ft, genome_ft, method, precision, sparse_asvs)
+
+    bh_keep_below = None
+    if correction == "global":
+        bh_keep_below = sparse_bh_keep_below(min_abs_estimate, max_p_value, metabolomics.shape[0])
+
+    with SharedArrays() as inputs, _executor_scope(executor) as executor:
+        refs = (inputs.share(metabolomics), inputs.share(asvs))
+        edges = _chunk_edges(asvs.shape[1], executor.n_workers)
+        tasks = [(_correlate_sparse_chunk, refs,
+                  (start, stop, min_abs_estimate, max_p_value, top_k, score_range, bin_size, bh_keep_below))
+                 for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+        chunk_results = executor.map(_run_shared_task, tasks)
+
+    histogram = ScoreHistogram.merged([chunk_histogram for _, chunk_histogram, _ in chunk_results], score_range,
+                                      bin_size)
+    rows, columns, estimates, p_values, fdr_corrected_p_values = [
+        np.concatenate(values) for values in zip(*[hits for hits, _, _ in chunk_results])
+    ]
+    if correction == "global":
+        global_bh = StreamingBH(bh_keep_below)
+        for _, _, p_value_run in chunk_results:
+            global_bh.add_sorted(*p_value_run)
+        fdr_corrected_p_values = global_bh.adjust(p_values)
+
+    if top_k is not None:
+        # every chunk kept its own top_k per metabolite; keep the overall top_k
+        order = np.lexsort((-np.abs(estimates), rows))
+        sorted_rows = rows[order]
+        group_start = np.searchsorted(sorted_rows, sorted_rows, side="left")
+        order = order[np.arange(len(order)) - group_start < top_k]
+        rows, columns, estimates, p_values, fdr_corrected_p_values = [
+            values[order] for values in (rows, columns, estimates, p_values, fdr_corrected_p_values)
+        ]
+
+    # same order as melt_correlation_results: ASV by ASV
+    order = np.lexsort((rows, columns))
+    hits = pd.DataFrame({
+        "Feature": np.asarray(metabolome_names)[rows[order]],
+        "Variable": np.asarray(asv_names)[columns[order]],
+        "Estimate": estimates[order],
+        "P-value": p_values[order],
+        "BH-Corrected P-Value": fdr_corrected_p_values[order],
+        "R2": estimates[order] ** 2,
+    })
+
+    return hits, histogram
+
+
+# level name of the ASVs themselves in calculate_level_correlations
+ASV_LEVEL = "ASV"
+
+
+def aggregation_matrix(row_bins, n_bins, dtype=np.float64):
+    """
+    Sparse ASVs x bins matrix of ones that sums the ASVs of every bin (row_bins as from
+    taxonomic_bins; ASVs with the bin -1 are in no bin).
+    """
+    rows = np.flatnonzero(row_bins >= 0)
+    return csc_matrix((np.ones(len(rows), dtype=dtype), (rows, row_bins[rows])), shape=(len(row_bins), n_bins))
+
+
+def _check_levels(taxonomy, levels):
+    unknown = [level for level in levels if level != ASV_LEVEL and level not in taxonomy.columns]
+    if unknown:
+        raise ValueError(f"Unknown taxonomic levels: {unknown}. Must be columns of the taxonomy or {ASV_LEVEL!r}.")
+
+
+def _level_bins(df, metabolome_ft, genome_ft, taxonomy, levels, level_filters=None):
+    """
+    (bin names, aggregation matrix, bin sums (samples x bins), bin standard deviations) of every
+    taxonomic level in levels, without the bins that do not vary over the samples of df or fail
+    the level_filters (see filter_features).
+    """
+    # the bins of all levels down to the lowest requested one
+    taxonomic_columns = list(taxonomy.columns)
+    depth = max([taxonomic_columns.index(level) + 1 for level in levels if level != ASV_LEVEL], default=0)
+    all_bins = taxonomic_bins(taxonomy.loc[genome_ft.index], taxonomic_columns[:depth]) if depth else {}
+    length_metabolome = metabolome_ft.shape[0]
+    asv_values = df.iloc[length_metabolome:length_metabolome + genome_ft.shape[0]].to_numpy(dtype=np.float64).T
+
+    bins = {}
+    for level in levels:
+        if level != ASV_LEVEL:
+            bin_names, row_bins = all_bins[level]
+            aggregation = aggregation_matrix(row_bins, len(bin_names))
+            bin_values = np.asarray((aggregation.T @ asv_values.T).T)
+            # the feature filters on the binned table; they always remove the bins without variance
+            keep, _ = _feature_mask(bin_values.T, **(level_filters or {}))
+            bin_std = bin_values[:, keep].std(axis=0, ddof=1)
+            bins[level] = bin_names[keep], aggregation[:, keep], bin_values[:, keep], bin_std
+    return bins
+
+
+def _asv_level_mask(df, metabolome_ft, genome_ft, level_filters=None):
+    # the ASVs of genome_ft that pass the level_filters over the samples of df
+    length_metabolome = metabolome_ft.shape[0]
+    asv_values = df.iloc[length_metabolome:length_metabolome + genome_ft.shape[0]].to_numpy(dtype=np.float64)
+    return _feature_mask(asv_values, **(level_filters or {}))[0]
+
+
+def level_feature_tables(df, metabolome_ft, genome_ft, taxonomy, levels, level_filters=None):
+    """
+    The feature table (features x samples of df) of every level as calculate_level_correlations
+    correlates it: the ASVs of genome_ft for ASV_LEVEL, and the bins of the taxonomic levels, each
+    without the features that fail the level_filters. Tables for other runs on the same bins, e.g.
+    the decoy (see calculate_permutation_histograms).
+
+    Returns:
+    dict: The feature table of every level, in the order of levels.
+    """
+    _check_levels(taxonomy, levels)
+    bins = _level_bins(df, metabolome_ft, genome_ft, taxonomy, levels, level_filters)
+
+    tables = {}
+    for level in levels:
+        if level == ASV_LEVEL:
+            tables[level] = genome_ft[df.columns][_asv_level_mask(df, metabolome_ft, genome_ft, level_filters)]
+        else:
+            bin_names, _, bin_values, _ = bins[level]
+            tables[level] = pd.DataFrame(bin_values.T, index=pd.Index(bin_names, name=level), columns=df.columns)
+    return tables
+
+
+def calculate_level_correlations(df, metabolome_ft, genome_ft, taxonomy, levels, method="pearson", executor=None,
+                                 score_range=(-1, 1), bin_size=0.001, correction="global", precision="float64",
+                                 sparse_asvs=None, level_filters=None):
+    """
+    Correlations of the metabolites with the ASVs binned at several taxonomic levels, from one
+    ASV-level run.
+
+    A bin is the sum of its ASVs, so its covariance with a standardized metabolite is the sum of
+    their covariances. With the ASV estimates r (metabolites x ASVs), the ASV standard deviations s
+    and the aggregation matrix A of a level (see aggregation_matrix), the estimates of its bins are
+    (r * s) @ A / s_bins, where s_bins are the standard deviations of the bin sums. After the ASV
+    run, every level costs one sparse product plus its p-values and BH correction.
+
+    The bins and their names are those of bin_by_taxonomic_level on the ASVs of genome_ft, summed
+    over the samples of df. genome_ft should therefore hold all ASVs (those without variance may be
+    left out, they change no covariance): the feature filters (level_filters) are applied to the
+    table of every level after binning, and bins without variance are always left out, as
+    filter_features removes them. The BH correction and the histogram of a level cover the features
+    it keeps. Spearman correlates the ranks of the bin sums,
+    which are no sums of ASV ranks, so with method="spearman" every level is correlated on its
+    binned table instead (one run per level).
+
+    Parameters:
+    df, metabolome_ft, genome_ft: The inputs of the ASV-level run, as for calculate_correlations_parallel.
+    taxonomy (pd.DataFrame): The taxonomic columns of the ASVs (indexed by ASV), ordered from the
+        highest to the lowest level.
+    levels (list): The taxonomic levels to correlate (columns of taxonomy), and ASV_LEVEL for the
+        ASVs themselves.
+    method, executor, score_range, bin_size, correction, precision, sparse_asvs: As for
+        calculate_correlations_parallel; the BH correction is done per level.
+    level_filters (dict): Keyword arguments of filter_features for the table of every level.
+
+    Returns:
+    dict: The CorrelationResults of every level, in the order of levels, each with the
+    ScoreHistogram of its estimates as its histogram attribute.
+    """
+    _check_levels(taxonomy, levels)
+    _check_correction(correction)
+    _check_precision(precision)
+
+    if method == "spearman":
+        results = {}
+        for level, level_ft in level_feature_tables(df, metabolome_ft, genome_ft, taxonomy, levels,
+                                                    level_filters).items():
+            level_df = combine_dataframes(metabolome_ft[df.columns], level_ft)
+            results[level] = calculate_correlations_parallel(level_df, metabolome_ft, level_ft, method=method,
+                                                             executor=executor, score_range=score_range,
+                                                             bin_size=bin_size, correction=correction,
+                                                             precision=precision, sparse_asvs=sparse_asvs)
+        return results
+
+    bins = _level_bins(df, metabolome_ft, genome_ft, taxonomy, levels, level_filters)
+
+    metabolomics, asvs = _split_standardized(df, metabolome_ft, genome_ft, method, precision, sparse_asvs)
+    with SharedArrays() as inputs, _executor_scope(executor) as executor:
+        estimates, p_values, histogram = _correlate_asv_block(executor, inputs.share(metabolomics),
+                                                              inputs.share(asvs), 0, asvs.shape[1],
+                                                              score_range, bin_size)
+    bh_axis = None if correction == "global" else 0
+
+    results = {}
+    if ASV_LEVEL in levels:
+        keep = _asv_level_mask(df, metabolome_ft, genome_ft, level_filters)
+        if keep.all():
+            results[ASV_LEVEL] = CorrelationResults.from_arrays(metabolome_ft.index, genome_ft.index, estimates,
+                                                                p_values, benjamini_hochberg(p_values, axis=bh_axis),
+                                                                histogram)
+        else:
+            asv_estimates, asv_p_values = estimates[:, keep], p_values[:, keep]
+            results[ASV_LEVEL] = CorrelationResults.from_arrays(
+                metabolome_ft.index, genome_ft.index[keep], asv_estimates, asv_p_values,
+                benjamini_hochberg(asv_p_values, axis=bh_axis),
+                ScoreHistogram.from_estimates(asv_estimates, score_range, bin_size)
+            )
+    del p_values
+
+    # covariances of the ASVs with the standardized metabolites (in place, the ASV results are copies);
+    # constant ASVs have NaN estimates but add nothing to the sum of a bin
+    length_metabolome = metabolome_ft.shape[0]
+    asv_values = df.iloc[length_metabolome:length_metabolome + genome_ft.shape[0]].to_numpy(dtype=np.float64)
+    asv_std = asv_values.std(axis=1, ddof=1)
+    covariances = estimates
+    covariances *= asv_std.astype(estimates.dtype)
+    covariances[:, asv_std == 0] = 0
+
+    n_samples = metabolomics.shape[0]
+    for level in levels:
+        if level != ASV_LEVEL:
+            bin_names, aggregation, _, bin_std = bins[level]
+            level_estimates = np.asarray(covariances @ aggregation.astype(estimates.dtype))
+            level_estimates = np.clip(level_estimates / bin_std.astype(estimates.dtype), -1, 1)
+            level_p_values = correlation_pvalues(level_estimates, n_samples)
+            results[level] = CorrelationResults.from_arrays(
+                metabolome_ft.index, pd.Index(bin_names, name=level), level_estimates, level_p_values,
+                benjamini_hochberg(level_p_values, axis=bh_axis),
+                ScoreHistogram.from_estimates(level_estimates, score_range, bin_size)
+            )
+
+    return {level: results[level] for level in levels}
+
+
+# largest |Estimate| deviation from float64 that check_precision accepts
+PRECISION_TOLERANCE = 1e-4
+
+
+def check_precision(df, metabolome_ft, genome_ft, method="pearson", precision="float32", results=None,
+                    n_pairs=10000, seed=0, tolerance=PRECISION_TOLERANCE):
+    """
+    Compare a reduced-precision run against a float64 reference on a random sample of pairs.
+
+    The reference estimates and p-values of the sampled pairs are computed in float64 from their
+    columns alone. They are compared with the stored values of results (the CorrelationResults of
+    the run), or without results with the same pairs recomputed in the given precision.
+
+    Parameters:
+    df, metabolome_ft, genome_ft: The inputs of the run, as for calculate_correlations_parallel.
+    method (str): "pearson" or "spearman".
+    precision (str): Precision of the run (see PRECISIONS).
+    results (CorrelationResults): Results of the run, or None.
+    n_pairs (int): Number of sampled metabolite-ASV pairs (all pairs if there are fewer).
+    seed (int): Seed of the pair sample.
+    tolerance (float): Largest accepted deviation of the estimates.
+
+    Returns:
+    dict: precision, pairs (number of compared pairs), max_estimate_deviation,
+    max_p_value_deviation (both absolute) and passed (max_estimate_deviation <= tolerance).
+    """
+    _check_precision(precision)
+    n_metabolites, n_asvs = metabolome_ft.shape[0], genome_ft.shape[0]
+    rng = np.random.default_rng(seed)
+    pairs = rng.choice(n_metabolites * n_asvs, size=min(n_pairs, n_metabolites * n_asvs), replace=False)
+    metabolite_positions, asv_positions = np.divmod(pairs, n_asvs)
+
+    # only the sampled columns are ranked and standardized, in both precisions
+    metabolite_columns, metabolite_index = np.unique(metabolite_positions, return_inverse=True)
+    asv_columns, asv_index = np.unique(asv_positions, return_inverse=True)
+    metabolomics = df.iloc[metabolite_columns].to_numpy(dtype=np.float64).T
+    asvs = df.iloc[n_metabolites + asv_columns].to_numpy(dtype=np.float64).T
+    if method == "spearman":
+        metabolomics = rank_transform(metabolomics)
+        asvs = rank_transform(asvs)
+    n_samples = metabolomics.shape[0]
+
+    def pair_estimates(dtype):
+        products = standardize(metabolomics, dtype)[:, metabolite_index] * standardize(asvs, dtype)[:, asv_index]
+        return np.clip(products.sum(axis=0) / (n_samples - 1), -1, 1)
+
+    reference = pair_estimates(np.float64)
+    if results is not None:
+        estimates = results.values[asv_positions, metabolite_positions, 0]
+        p_values = results.values[asv_positions, metabolite_positions, 1]
+    else:
+        estimates = pair_estimates(np.dtype(precision))
+        p_values = correlation_pvalues(estimates, n_samples)
+
+    with np.errstate(invalid="ignore"):
+        estimate_deviation = np.abs(estimates.astype(np.float64) - reference)
+        p_value_deviation = np.abs(p_values.astype(np.float64) - correlation_pvalues(reference, n_samples))
+    # pairs with a constant feature are NaN in both
+    max_estimate_deviation = float(np.nanmax(estimate_deviation, initial=0))
+    max_p_value_deviation = float(np.nanmax(p_value_deviation, initial=0))
+
+    return {
+        "precision": precision,
+        "pairs": len(pairs),
+        "max_estimate_deviation": max_estimate_deviation,
+        "max_p_value_deviation": max_p_value_deviation,
+        "passed": max_estimate_deviation <= tolerance,
+    }
+
+
+def estimate_result_size_mb(metabolome_ft, genome_ft, precision="float64"):
+    """
+    Approximate memory needed to hold the full correlation results and their long-format table in MB.
+    """
+    n_pairs = metabolome_ft.shape[0] * genome_ft.shape[0]
+    scale = np.dtype(precision).itemsize / 8
+    return n_pairs * (BLOCK_BYTES_PER_PAIR + TILE_BYTES_PER_PAIR) * scale / 1024 ** 2
+
+def merge_asv_correlation_results(results, target_df, genome_ft):
+    """
+    Merge ASV correlation results into a dictionary with dataframes having the same rows as target_df.
+
+    Parameters:
+    results (CorrelationResults or dict): Correlation results for each ASV.
+    target_df (pd.DataFrame): The combined metabolomics and genomics dataframe.
+    gen_ft (pd.DataFrame): Genomics feature table.
+
+    Returns:
+    dict: A dictionary of merged dataframes for each ASV.
+    """
+    merged_list = {}
+
+    empty_asv_df = pd.DataFrame(
+            0,
+            index=genome_ft.index,
+            columns=RESULT_COLUMNS
+        )
+
+    # Loop through each ASV and merge with target_df
+    for asv_name in genome_ft.index:
+        #get each df in the results (a view, nothing is copied before the merge)
+        df = results[asv_name]
+        
+        #combine the empty_asv_df to that
+        merged_pscores_df = empty_asv_df.combine_first(df)
+        
+        # Merge with target_df to include all sample columns
+        merged_final_df = pd.concat([merged_pscores_df, target_df], axis=1)
+
+        # Add the merged dataframe to the dictionary
+        merged_list[asv_name] = merged_final_df
+
+    return merged_list
+
+
+def melt_correlation_results(results):
+    """
+    Melt a dictionary of correlation dataframes into a single dataframe.
+
+    Parameters:
+    results (CorrelationResults or dict): Correlation results, or a dictionary where keys are
+                    ASV names, and values are dataframes with correlation results.
+
+    Returns:
+    pd.DataFrame: A single dataframe with all correlation results.
+    """
+    if isinstance(results, CorrelationResults):
+        # a view on the result store: only the categorical Feature/Variable codes are allocated
+        return results.to_long()
+
+    melted_results = []
+
+    for asv_name, df in results.items():
+        # Add Feature and Variable columns
+        df = df.copy()
+        df["Feature"] = df.index  # Index as Feature
+        df["Variable"] = asv_name  # ASV name as Variable
+
+        # Rearrange columns so Feature and Variable are first
+        df = df[["Feature", "Variable"] + list(df.columns[:-2])]  # Reorder columns
+
+        # Append to list
+        melted_results.append(df)
+
+    # Concatenate all dataframes
+    final_df = pd.concat(melted_results, axis=0, ignore_index=True)
+
+    return final_df
+
@@ -0,0 +1,321 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from .cache import DEFAULT_CACHE_DIR
+from .correlation import (CHUNKS_PER_WORKER, PERMUTATION_BATCH_MB, _correlate_into, _permutation_histogram_chunk,
+                          benjamini_hochberg, correlation_pvalues, sample_permutations, sparse_bh_keep_below,
+                          standardize)
+from .multiple_testing import target_decoy_qvalues
+from .results import RESULT_COLUMNS, CorrelationResults
+
+# bump when the calibration kernels or the stored coefficients change
+CALIBRATION_VERSION = 1
+
+DEFAULT_CALIBRATION_PATH = os.path.join(DEFAULT_CACHE_DIR, "calibration.json")
+
+# Shared estimate and p-value segments the workers write a dense run into, and the result store
+# (ASVs x metabolites x RESULT_COLUMNS) that stays in memory while the output is built
+SHARED_BYTES_PER_PAIR = 2 * 8
+STORE_BYTES_PER_PAIR = len(RESULT_COLUMNS) * 8
+# Estimates, p-values and selection masks of a worker chunk in the sparse mode, and one kept hit
+SPARSE_CHUNK_BYTES_PER_PAIR = 5 * 8
+HIT_BYTES = 8 * 8
+# A p-value kept for the global BH correction (always float64): the sorted runs, their merge
+# with the buffer of the merge sort, and the adjusted values
+BH_BYTES_PER_P_VALUE = 4 * 8
+
+
+def physical_memory_mb():
+    """
+    Physical memory of this machine in MB, or None where it cannot be determined.
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_memory_limit_mb():
+    """
+    Memory limit for a correlation run: CORROMICS_MEMORY_LIMIT_MB if set, otherwise 80% of the
+    physical memory, or None (no limit) if neither is known.
+    """
+    if os.environ.get("CORROMICS_MEMORY_LIMIT_MB"):
+        return float(os.environ["CORROMICS_MEMORY_LIMIT_MB"])
+    memory = physical_memory_mb()
+    return None if memory is None else 0.8 * memory
+
+
+def machine_key():
+    """
+    What a calibration is only valid for: the machine, its CPU count and the NumPy build.
+    """
+    return {
+        "version": CALIBRATION_VERSION,
+        "node": platform.node(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{max(seconds, 1):.0f} s"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def _best_time(func, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _peak_bytes(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _linear_fit(sample_counts, seconds_per_pair):
+    # seconds per pair = fixed + per_sample * n_samples, through the two calibration points
+    (s1, s2), (t1, t2) = sample_counts, seconds_per_pair
+    per_sample = max((t2 - t1) / (s2 - s1), 0.0)
+    return max(t1 - per_sample * s1, 0.0), per_sample
+
+
+class RunCost:
+    """
+    Predicted wall time (seconds) and peak memory (MB) of the stages of a correlation run.
+    """
+
+    def __init__(self, target_seconds, decoy_seconds, output_seconds, target_peak_mb, decoy_peak_mb,
+                 output_peak_mb):
+        self.target_seconds = target_seconds
+        self.decoy_seconds = decoy_seconds
+        self.output_seconds = output_seconds
+        self.target_peak_mb = target_peak_mb
+        self.decoy_peak_mb = decoy_peak_mb
+        self.output_peak_mb = output_peak_mb
+
+    @property
+    def total_seconds(self):
+        return self.target_seconds + self.decoy_seconds + self.output_seconds
+
+    @property
+    def peak_mb(self):
+        return max(self.target_peak_mb, self.decoy_peak_mb, self.output_peak_mb)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in ("target_seconds", "decoy_seconds", "output_seconds",
+                                                         "total_seconds", "target_peak_mb", "decoy_peak_mb",
+                                                         "output_peak_mb", "peak_mb")}
+
+    def __repr__(self):
+        return f"RunCost(~{format_duration(self.total_seconds)}, peak ~{self.peak_mb:.0f} MB)"
+
+
+class CostModel:
+    """
+    Run time and peak memory of a correlation run, predicted from coefficients measured on this machine.
+
+    calibrate times the kernels the workers and the main process actually run (correlation chunk,
+    permutation batch, BH correction and result store, long-format output with q-values) on small
+    random matrices at two sample counts, and traces the memory the main process allocates per pair.
+    predict scales these per-pair costs to the size of a run: the worker stages are divided over the
+    workers (at most one per CPU), the rest runs in the main process.
+
+    The calibration takes a second or two and is stored as JSON (see load), so it is done once per
+    machine; it is repeated when the machine, its CPU count or the NumPy version change.
+    """
+
+    def __init__(self, coefficients):
+        self.coefficients = coefficients
+
+    @classmethod
+    def calibrate(cls, n_metabolites=256, n_asvs=512, sample_counts=(16, 128), n_permutations=16, seed=0):
+        rng = np.random.default_rng(seed)
+        n_pairs = n_metabolites * n_asvs
+        target_times, decoy_times = [], []
+
+        for n_samples in sample_counts:
+            metabolomics = standardize(rng.standard_normal((n_samples, n_metabolites)))
+            asvs = standardize(rng.standard_normal((n_samples, n_asvs)))
+            estimates = np.empty((n_metabolites, n_asvs))
+            p_values = np.empty((n_metabolites, n_asvs))
+            permutations = sample_permutations(n_samples, n_permutations, seed)
+
+            target_times.append(_best_time(
+                lambda: _correlate_into(metabolomics, asvs, estimates, p_values, 0, n_asvs, 0, (-1, 1), 0.001)
+            ) / n_pairs)
+            decoy_times.append(_best_time(
+                lambda: _permutation_histogram_chunk(metabolomics, asvs, permutations, 0, n_asvs, n_permutations,
+                                                     (-1, 1), 0.001)
+            ) / (n_pairs * n_permutations))
+
+        feature_names = pd.Index([f"feature_{i}" for i in range(n_metabolites)])
+        asv_names = pd.Index([f"ASV_{i}" for i in range(n_asvs)])
+        fdr_table = pd.DataFrame({"Range_min": np.arange(-1, 1, 0.001), "Range_max": np.arange(-0.999, 1.001, 0.001),
+                                  "FDR": rng.random(2000)})
+
+        def store():
+            # main process after the workers: copies of the shared outputs, BH, result store
+            bh_corrected = benjamini_hochberg(p_values.copy(), axis=None)
+            return CorrelationResults.from_arrays(feature_names, asv_names, estimates.copy(), p_values,
+                                                  bh_corrected)
+
+        results = store()
+
+        def output():
+            # the long-format table and its q-values, as the app and the pipeline build them
+            table = results.to_long()
+            return table, target_decoy_qvalues(table["Estimate"], fdr_table)
+
+        table, q_values = output()
+
+        # text export is slow, a slice is enough to time it
+        rows = table.iloc[:16384].assign(**{"Target-Decoy q-value": q_values[:16384]})
+
+        def write():
+            with tempfile.TemporaryFile("w") as file:
+                rows.to_csv(file, index=False)
+
+        coefficients = {
+            "target_seconds_per_pair": _linear_fit(sample_counts, target_times),
+            "decoy_seconds_per_pair": _linear_fit(sample_counts, decoy_times),
+            "store_seconds_per_pair": _best_time(store) / n_pairs,
+            "output_seconds_per_pair": _best_time(output) / n_pairs,
+            "write_seconds_per_pair": _best_time(write, repeats=1) / len(rows),
+            "store_bytes_per_pair": _peak_bytes(store) / n_pairs,
+            "output_bytes_per_pair": _peak_bytes(output) / n_pairs,
+        }
+        return cls(coefficients)
+
+    @classmethod
+    def load(cls, path=DEFAULT_CALIBRATION_PATH, recalibrate=False):
+        """
+        The calibration stored at path if it was made on this machine, otherwise a new one,
+        which is stored at path (if it is writable) for the next time.
+        """
+        key = machine_key()
+        if not recalibrate:
+            try:
+                with open(path) as file:
+                    stored = json.load(file)
+                if stored["machine"] == key:
+                    return cls(stored["coefficients"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+        model = cls.calibrate()
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump({"machine": key, "coefficients": model.coefficients}, file, indent=2)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+        return model
+
+    def predict(self, n_metabolites, n_asvs, n_samples, n_workers=1, n_permutations=0, mode="dense",
+                memory_budget_mb=None, min_abs_estimate=None, max_p_value=None, top_k=None, correction="global",
+                score_range=(-1, 1), bin_size=0.001, precision="float64"):
+        """
+        Predict the run time and peak memory of a target run, its multi-permutation decoy and the
+        output table.
+
+        Parameters:
+        n_metabolites, n_asvs, n_samples (int): Size of the run.
+        n_workers (int): Correlation worker processes.
+        n_permutations (int): Decoy permutations (0 for no decoy).
+        mode (str): "dense" (all pairs in memory, then the long-format table), "sparse" (only pairs
+                    beyond min_abs_estimate / max_p_value / top_k) or "tiled" (written to disk tile
+                    by tile within memory_budget_mb).
+        correction (str): "global" or "per_asv" BH correction.
+        precision (str): "float64" or "float32", the type of the standardized inputs and the results.
+
+        Returns:
+        RunCost: Predicted seconds and peak MB per stage. The peaks include everything that is still
+        held at that point (e.g. the target results during the decoy run). For the sparse mode, the
+        number of hits is estimated as for uncorrelated data. The kernels are calibrated in float64,
+        so float32 run times are predicted conservatively.
+        """
+        if mode not in ("dense", "sparse", "tiled"):
+            raise ValueError(f"Unknown mode {mode!r}, must be 'dense', 'sparse' or 'tiled'.")
+        c = self.coefficients
+        mb = 1024 ** 2
+        n_pairs = n_metabolites * n_asvs
+        workers = max(1, min(n_workers, os.cpu_count() or 1))
+        # float32 halves the standardized inputs, the shared outputs and the result store
+        scale = np.dtype(precision).itemsize / 8
+
+        def worker_seconds(name, n):
+            fixed, per_sample = c[name]
+            return n * (fixed + per_sample * n_samples) / workers
+
+        # raw tables, standardized copies and their shared segments
+        inputs_bytes = n_samples * (n_metabolites + n_asvs) * (8 + 2 * 8 * scale)
+        chunk_pairs = n_metabolites * -(-n_asvs // (workers * CHUNKS_PER_WORKER))
+
+        target_seconds = worker_seconds("target_seconds_per_pair", n_pairs)
+        if mode == "dense":
+            target_seconds += n_pairs * c["store_seconds_per_pair"]
+            target_bytes = inputs_bytes + n_pairs * (SHARED_BYTES_PER_PAIR + c["store_bytes_per_pair"]) * scale
+            output_seconds = n_pairs * c["output_seconds_per_pair"]
+            output_bytes = inputs_bytes + n_pairs * (STORE_BYTES_PER_PAIR * scale + c["output_bytes_per_pair"])
+            resident_bytes = n_pairs * (STORE_BYTES_PER_PAIR * scale + c["output_bytes_per_pair"])
+        elif mode == "sparse":
+            # fraction of the pairs beyond the cutoffs if nothing is correlated
+            kept = sparse_bh_keep_below(min_abs_estimate, max_p_value, n_samples)
+            n_hits = n_pairs * kept
+            if top_k is not None:
+                n_hits = min(n_hits, n_metabolites * top_k)
+            # with the global correction the main process also merges the sorted p-values up to the cutoff
+            p_value_bytes = n_pairs * kept * BH_BYTES_PER_P_VALUE if correction == "global" else 0
+            target_bytes = (inputs_bytes + workers * chunk_pairs * SPARSE_CHUNK_BYTES_PER_PAIR * scale + p_value_bytes
+                            + 2 * n_hits * HIT_BYTES)
+            output_seconds = n_hits * c["output_seconds_per_pair"]
+            output_bytes = inputs_bytes + n_hits * (HIT_BYTES + c["output_bytes_per_pair"])
+            resident_bytes = n_hits * (HIT_BYTES + c["output_bytes_per_pair"])
+        else:
+            if memory_budget_mb is None:
+                raise ValueError("The tiled mode needs a memory_budget_mb.")
+            if correction == "global":
+                # the p-value pass before the tiles are computed and corrected; its p-values are
+                # spilled to disk in runs within the budget
+                target_seconds += worker_seconds("target_seconds_per_pair", n_pairs)
+            target_bytes = inputs_bytes + memory_budget_mb * mb
+            target_seconds += n_pairs * c["store_seconds_per_pair"]
+            # the tiles are written while they are computed
+            output_seconds = n_pairs * c["write_seconds_per_pair"]
+            output_bytes = target_bytes
+            resident_bytes = 0
+
+        decoy_seconds = 0.0
+        decoy_bytes = 0
+        if n_permutations:
+            decoy_seconds = worker_seconds("decoy_seconds_per_pair", n_pairs * n_permutations)
+            n_bins = int(round((score_range[1] - score_range[0]) / bin_size))
+            # every worker fills its permutation batches; every task returns a histogram per permutation
+            decoy_bytes = (inputs_bytes + resident_bytes + workers * PERMUTATION_BATCH_MB * mb
+                           + (workers * CHUNKS_PER_WORKER + 1) * n_permutations * n_bins * 8)
+
+        return RunCost(target_seconds, decoy_seconds, output_seconds, target_bytes / mb, decoy_bytes / mb,
+                       output_bytes / mb)
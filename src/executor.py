@@ -0,0 +1,114 @@
+import atexit
+import os
+import threading
+from multiprocessing import Pool, resource_tracker
+
+from .profiling import is_profiling, profiled_task, record_worker_tasks
+
+
+def default_worker_count():
+    return os.cpu_count() or 1
+
+
+def _ping():
+    return os.getpid()
+
+
+def _run_with_timeout(func, timeout):
+    """
+    Run func in a daemon thread and report whether it finished within timeout seconds.
+    """
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+class CorrelationExecutor:
+    """
+    Long-lived worker pool shared by all correlation runs of a server process.
+
+    The pool is started lazily on first use and reused by later runs (target, decoy and every
+    Streamlit rerun), so process start-up and imports are paid once. Runs submitted from several
+    sessions are serialized, since they would compete for the same workers anyway.
+    """
+
+    def __init__(self, n_workers=None, ping_timeout=10):
+        self.n_workers = n_workers or default_worker_count()
+        self.ping_timeout = ping_timeout
+        self._pool = None
+        self._lock = threading.RLock()
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                # the workers must share the parent's resource tracker, otherwise every worker that
+                # attaches to a shared-memory segment reports it as leaked at shutdown
+                resource_tracker.ensure_running()
+                self._pool = Pool(self.n_workers)
+                atexit.register(self.shutdown)
+        return self
+
+    @property
+    def running(self):
+        return self._pool is not None
+
+    def is_healthy(self):
+        """
+        Check that the pool answers a trivial task in time.
+        """
+        with self._lock:
+            if self._pool is None:
+                return False
+            try:
+                self._pool.apply_async(_ping).get(timeout=self.ping_timeout)
+            except Exception:
+                return False
+            return True
+
+    def ensure_healthy(self):
+        """
+        Start the pool if needed and replace it if the health check fails.
+        """
+        with self._lock:
+            if self._pool is not None and not self.is_healthy():
+                self.shutdown(wait=False)
+            return self.start()
+
+    def map(self, func, tasks, chunksize=1):
+        if is_profiling():
+            # the workers also report their timings, which are added to the running stage
+            with self._lock:
+                results = self.start()._pool.map(profiled_task, [(func, task) for task in tasks],
+                                                 chunksize=chunksize)
+            record_worker_tasks([stats for _, stats in results])
+            return [result for result, _ in results]
+        with self._lock:
+            return self.start()._pool.map(func, tasks, chunksize=chunksize)
+
+    def shutdown(self, wait=True, timeout=30):
+        """
+        Stop the workers. With wait, running tasks are allowed to finish for up to timeout seconds
+        before the workers are terminated.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            if pool is None:
+                return
+            atexit.unregister(self.shutdown)
+            if wait:
+                pool.close()
+                if _run_with_timeout(pool.join, timeout):
+                    return
+
+            # a pool that lost a worker can deadlock in terminate(), so the workers are killed
+            # first and terminate() is not waited on indefinitely
+            for process in pool._pool:
+                process.kill()
+            _run_with_timeout(pool.terminate, timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
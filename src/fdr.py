@@ -1,73 +1,163 @@
-import streamlit as st
-from .common import *  # Importing common functionalities from the 'common' module
-from .correlation import *
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+import warnings
+from .histogram import PermutationHistograms, ScoreHistogram
 
 
-def calculate_fdr(target, decoy, score_range=(-1, 1), bin_size=0.001):
-    
-    # Define bins based on specified range and bin size
-    bins = np.arange(score_range[0], score_range[1] + bin_size, bin_size)
+def _as_histogram(scores, score_range, bin_size):
+    """
+    Accept a melted correlation table, an already filled ScoreHistogram or CorrelationResults
+    that carry the histogram built by the correlation workers.
+    """
+    if isinstance(scores, (ScoreHistogram, PermutationHistograms)):
+        return scores
+    if getattr(scores, 'histogram', None) is not None:
+        return scores.histogram
+    return ScoreHistogram.from_estimates(scores['Estimate'], score_range, bin_size)
 
-    # Calculate target and decoy counts per bin
-    target_counts, _ = np.histogram(target['Estimate'], bins=bins)
-    decoy_counts, _ = np.histogram(decoy['Estimate'], bins=bins)
 
-    # Calculate FDR for each bin
-    fdr_df = pd.DataFrame({'Range_min': bins[:-1], 
-                               'Range_max': bins[1:], 
-                               'Target_counts': target_counts,
-                               'Decoy_counts': decoy_counts
-                               })
-    epsilon = 0
+def _cumulative_fdr(target_counts, decoy_counts, epsilon=0):
+    """
+    FDR of every bin when all bins up to it are accepted, for (permutations, bins) decoy counts.
+    """
+    decoy_cumsum = np.cumsum(decoy_counts, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return decoy_cumsum / (np.cumsum(target_counts) + epsilon + decoy_cumsum)
 
-    # Separate positive and negative bins
-    positive_bins = fdr_df[fdr_df['Range_max'] > 0].reset_index(drop=True)
-    negative_bins = fdr_df[fdr_df['Range_max'] < 0].reset_index(drop=True)
 
-    # Calculate cumulative FDR for positive bins (0 to 1, forward order)
-    positive_bins = positive_bins[::-1].reset_index(drop=True)  # Reverse order for cumulative sum
-    positive_bins['FDR'] = positive_bins['Decoy_counts'].cumsum() / (
-        positive_bins['Target_counts'].cumsum()  + epsilon + positive_bins['Decoy_counts'].cumsum()
-    )
+def calculate_fdr(target, decoy, score_range=(-1, 1), bin_size=0.001, confidence=0.95):
+    """
+    Calculate the target-decoy FDR curve (calculate_fdr_table) and its figures (fdr_figures).
 
-    positive_bins = positive_bins[::-1].reset_index(drop=True)  # Restore original order
+    Returns:
+    tuple: (FDR table, histogram figure, FDR figure)
+    """
+    target = _as_histogram(target, score_range, bin_size)
+    decoy = _as_histogram(decoy, score_range, bin_size)
+    combined_fdr_df = calculate_fdr_table(target, decoy, score_range, bin_size, confidence)
+    return (combined_fdr_df, *fdr_figures(combined_fdr_df, target, decoy, score_range, bin_size, confidence))
+
+
+def calculate_fdr_table(target, decoy, score_range=(-1, 1), bin_size=0.001, confidence=0.95):
+    """
+    Calculate the target-decoy FDR curve from the binned target and decoy scores.
+
+    target and decoy can be melted correlation tables (with an 'Estimate' column),
+    ScoreHistogram objects (merged from the worker histograms of a run) or CorrelationResults.
+    decoy can also be the PermutationHistograms of a multi-permutation decoy run; the FDR curve
+    is then the mean of the per-permutation curves, Decoy_counts the mean decoy counts, and
+    FDR_lower/FDR_upper the central confidence band of the per-permutation curves.
+    """
+    target = _as_histogram(target, score_range, bin_size)
+    decoy = _as_histogram(decoy, score_range, bin_size)
+    if not np.array_equal(target.bins, decoy.bins):
+        raise ValueError("Target and decoy histograms must use the same bins.")
+
+    # Target and decoy counts per bin, one row of decoy counts per permutation
+    bins = target.bins
+    target_counts = target.counts
+    decoy_counts = np.atleast_2d(decoy.counts)
+
+    # Separate positive and negative bins
+    positive = bins[1:] > 0
+    negative = bins[1:] < 0
+
+    # Cumulative FDR: negative bins from -1 towards 0, positive bins from 1 towards 0
+    fdr = np.empty(decoy_counts.shape)
+    fdr[:, negative] = _cumulative_fdr(target_counts[negative], decoy_counts[:, negative])
+    fdr[:, positive] = _cumulative_fdr(target_counts[positive][::-1], decoy_counts[:, positive][:, ::-1])[:, ::-1]
 
-    # Calculate cumulative FDR for negative bins (-1 to 0)
-    negative_bins['FDR'] = negative_bins['Decoy_counts'].cumsum() / (
-        negative_bins['Target_counts'].cumsum() +  epsilon + negative_bins['Decoy_counts'].cumsum()
-    )
-   
     # Combine positive and negative bins
-    combined_fdr_df = pd.concat([negative_bins, positive_bins]).reset_index(drop=True)
+    kept = negative | positive
+    combined_fdr_df = pd.DataFrame({'Range_min': bins[:-1][kept],
+                                    'Range_max': bins[1:][kept],
+                                    'Target_counts': target_counts[kept]})
+    if isinstance(decoy, PermutationHistograms):
+        tail = (1 - confidence) / 2
+        with warnings.catch_warnings():
+            # bins without any scores have no FDR in any permutation
+            warnings.simplefilter('ignore', RuntimeWarning)
+            combined_fdr_df['Decoy_counts'] = decoy_counts[:, kept].mean(axis=0)
+            combined_fdr_df['FDR'] = np.nanmean(fdr[:, kept], axis=0)
+            combined_fdr_df['FDR_lower'] = np.nanquantile(fdr[:, kept], tail, axis=0)
+            combined_fdr_df['FDR_upper'] = np.nanquantile(fdr[:, kept], 1 - tail, axis=0)
+    else:
+        combined_fdr_df['Decoy_counts'] = decoy_counts[0, kept]
+        combined_fdr_df['FDR'] = fdr[0, kept]
+
+    return combined_fdr_df
+
+
+# bin size of the plotted score histograms
+HISTOGRAM_PLOT_BIN_SIZE = 0.1
+
+
+def fdr_figures(fdr_table, target, decoy, score_range=(-1, 1), bin_size=0.001, confidence=0.95):
+    """
+    The figures of an FDR table: the target and decoy score histograms and the FDR curve.
+    Both are built from binned counts, so their size does not depend on the number of pairs.
+
+    Returns:
+    tuple: (histogram figure, FDR figure)
+    """
+    decoy = _as_histogram(decoy, score_range, bin_size)
+    n_permutations = len(decoy) if isinstance(decoy, PermutationHistograms) else None
+    return (plot_score_histograms(target, decoy, score_range, bin_size),
+            plot_fdr(fdr_table, n_permutations, confidence))
+
+
+def plot_fdr(fdr_table, n_permutations=None, confidence=0.95):
+    """
+    FDR curve of an FDR table (calculate_fdr_table), with the confidence band of the permutations
+    if it has one and the bins closest to the 10, 15 and 20% FDR thresholds. The bins are drawn
+    as WebGL traces.
 
-     # Plot FDR results
+    Parameters:
+    fdr_table (pd.DataFrame): The FDR table.
+    n_permutations (int): Decoy permutations, for the label of the band.
+    confidence (float): Confidence of the band, for its label.
+
+    Returns:
+    go.Figure: The FDR figure.
+    """
     fig_fdr = go.Figure()
-    fig_fdr.add_trace(go.Scatter(
-        x=combined_fdr_df['Range_min'],
-        y=combined_fdr_df['FDR']*100,
+    if 'FDR_lower' in fdr_table:
+        fig_fdr.add_trace(go.Scattergl(
+            x=fdr_table['Range_min'],
+            y=fdr_table['FDR_upper']*100,
+            mode='lines',
+            line=dict(width=0),
+            showlegend=False,
+            hoverinfo='skip'
+        ))
+        fig_fdr.add_trace(go.Scattergl(
+            x=fdr_table['Range_min'],
+            y=fdr_table['FDR_lower']*100,
+            mode='lines',
+            line=dict(width=0),
+            fill='tonexty',
+            fillcolor='rgba(99, 110, 250, 0.2)',
+            name=f'{confidence:.0%} band ({n_permutations} permutations)'
+        ))
+    fig_fdr.add_trace(go.Scattergl(
+        x=fdr_table['Range_min'],
+        y=fdr_table['FDR']*100,
         mode='markers',
-        name = 'FDR Score'
+        name = 'FDR Score' if 'FDR_lower' not in fdr_table else 'Mean FDR Score'
     ))
 
     # Define FDR threshold levels and their colors
     fdr_thresholds = [10, 15, 20]
     colors = ['green', 'orange', 'red']
 
-    ########################################
-    # Sort the combined_fdr_df by FDR values
-    combined_fdr_df_sorted = combined_fdr_df.sort_values(by='FDR').reset_index(drop=True)
-    combined_fdr_df_sorted['FDR'] *= 100
-
     # Loop through each threshold to add a horizontal line and highlight the closest point
     for fdr_value, color in zip(fdr_thresholds, colors):
         # Add a horizontal line for the FDR threshold
         fig_fdr.add_shape(
             type="line",
-            x0=combined_fdr_df['Range_min'].min(), 
-            x1=combined_fdr_df['Range_min'].max(),
+            x0=fdr_table['Range_min'].min(), 
+            x1=fdr_table['Range_min'].max(),
             y0=fdr_value, y1=fdr_value,
             line=dict(color=color, width=1, dash="dash"),
             name=f"{fdr_value}% FDR"
@@ -75,11 +165,11 @@ def calculate_fdr(target, decoy, score_range=(-1, 1), bin_size=0.001):
 
         # Identify points that are within a small tolerance of the FDR threshold
         tolerance = 0.8  # Adjust tolerance as needed to capture points near each threshold
-        threshold_points = combined_fdr_df[(combined_fdr_df['FDR'] * 100 >= fdr_value - tolerance) & 
-                                        (combined_fdr_df['FDR'] * 100 <= fdr_value + tolerance)]
+        threshold_points = fdr_table[(fdr_table['FDR'] * 100 >= fdr_value - tolerance) & 
+                                     (fdr_table['FDR'] * 100 <= fdr_value + tolerance)]
 
         # Add a marker at the closest point to the FDR threshold
-        fig_fdr.add_trace(go.Scatter(
+        fig_fdr.add_trace(go.Scattergl(
             x=threshold_points['Range_min'],
             y=threshold_points['FDR'] * 100,
             mode='markers',
@@ -95,24 +185,34 @@ def calculate_fdr(target, decoy, score_range=(-1, 1), bin_size=0.001):
         width=900,
         height=500
     )
+    return fig_fdr
 
-    # Plot histograms for target and decoys
-    fig_histogram = go.Figure()
-    fig_histogram.add_trace(go.Histogram(
-        x=target['Estimate'],
-        name='Target',
-        xbins=dict(start=-1, end=1, size=0.1),
-        opacity=0.7,
-        marker_color='blue'
-    ))
 
-    fig_histogram.add_trace(go.Histogram(
-        x=decoy['Estimate'],
-        name='Decoy',
-        xbins=dict(start=-1, end=1, size=0.1),
-        opacity=0.3,
-        marker_color='red'
-    ))
+def plot_score_histograms(target, decoy, score_range=(-1, 1), bin_size=0.001):
+    """
+    Histograms of the target and decoy scores in HISTOGRAM_PLOT_BIN_SIZE bins, drawn as bars from
+    the binned counts (the mean counts for several decoy permutations).
+
+    Returns:
+    go.Figure: The histogram figure.
+    """
+    target = _as_histogram(target, score_range, bin_size)
+    decoy = _as_histogram(decoy, score_range, bin_size)
+
+    fig_histogram = go.Figure()
+    decoy_name = 'Decoy' if not isinstance(decoy, PermutationHistograms) else f'Decoy (mean of {len(decoy)} permutations)'
+    for scores, name, opacity, color in [(target, 'Target', 0.7, 'blue'), (decoy, decoy_name, 0.3, 'red')]:
+        edges, counts = scores.rebin(HISTOGRAM_PLOT_BIN_SIZE)
+        if counts.ndim > 1:
+            counts = counts.mean(axis=0)
+        fig_histogram.add_trace(go.Bar(
+            x=(edges[:-1] + edges[1:]) / 2,
+            y=counts,
+            width=np.diff(edges),
+            name=name,
+            opacity=opacity,
+            marker_color=color
+        ))
 
     fig_histogram.update_layout(
         title="Histogram of Target vs. Decoy Scores",
@@ -123,36 +223,4 @@ def calculate_fdr(target, decoy, score_range=(-1, 1), bin_size=0.001):
         width=900,
         height=500
     )
-
-    # Display in Streamlit
-    # st.plotly_chart(fig_histogram)
-    # st.plotly_chart(fig_fdr)
-    
-    return combined_fdr_df, fig_histogram, fig_fdr
-
-def estimate_run_time(metabolome_df, genome_df):
-    """
-    Estimate the time to complete the correlation run based on the number of correlations.
-    
-    Parameters:
-    correlations (int): Number of correlations to estimate the runtime for.
-    
-    Returns:
-    str: Estimated time message.
-    """
-    correlations = metabolome_df.shape[0] * genome_df.shape[0]
-
-    if correlations <= 50000:
-        return st.info("It will take around 30s to complete the run")
-    elif correlations <= 100000:
-        return st.info("It will take around 1 min to complete the run")
-    elif correlations <= 500000:
-        return st.info("It will take around 2 mins to complete the run")
-    elif correlations <= 1000000:
-        return st.info("It will take around 4 mins to complete the run")
-    elif correlations <= 5000000:
-        return st.warning("It will take around 12 mins to complete the run")
-    elif correlations <= 10000000:
-        return st.warning("It will take around 20 mins to complete the run. Go get a coffee.")
-    else:
-        return st.warning("The run time might exceed 20 mins for correlations")
+    return fig_histogram
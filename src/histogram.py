@@ -0,0 +1,181 @@
+import numpy as np
+
+
+class ScoreHistogram:
+    """
+    Fixed-bin counts of correlation estimates.
+
+    Building the FDR curve only needs these counts, so the correlation workers fill one histogram
+    per chunk and the chunks, tiles or separate runs are merged afterwards (merge, merged, +),
+    without ever holding all pair estimates in memory.
+    """
+
+    def __init__(self, score_range=(-1, 1), bin_size=0.001):
+        self.score_range = score_range
+        self.bin_size = bin_size
+        # same bins as calculate_fdr has always used
+        self.bins = np.arange(score_range[0], score_range[1] + bin_size, bin_size)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+
+    @classmethod
+    def from_estimates(cls, estimates, score_range=(-1, 1), bin_size=0.001):
+        histogram = cls(score_range, bin_size)
+        histogram.update(estimates)
+        return histogram
+
+    @classmethod
+    def from_counts(cls, counts, score_range=(-1, 1), bin_size=0.001):
+        histogram = cls(score_range, bin_size)
+        if len(counts) != len(histogram.counts):
+            raise ValueError(f"Expected {len(histogram.counts)} counts, got {len(counts)}.")
+        histogram.counts[:] = counts
+        return histogram
+
+    @classmethod
+    def merged(cls, histograms, score_range=(-1, 1), bin_size=0.001):
+        """
+        Sum of several histograms, e.g. of the chunks of one run or of separate runs.
+        """
+        total = cls(score_range, bin_size)
+        for histogram in histograms:
+            total.merge(histogram)
+        return total
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bins (in place).
+        """
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError("Only histograms with the same bins can be merged.")
+        self.counts += other.counts
+        return self
+
+    def __add__(self, other):
+        return ScoreHistogram.from_counts(self.counts, self.score_range, self.bin_size).merge(other)
+
+    def update(self, estimates):
+        """
+        Add estimates to the counts. NaN estimates (e.g. from constant features) and estimates
+        outside score_range are skipped.
+        """
+        positions = _bin_positions(self.bins, self.bin_size, np.asarray(estimates, dtype=np.float64).ravel())
+        self.counts += np.bincount(positions, minlength=len(self.counts) + 1)[:-1]
+
+    def add_tile(self, tile):
+        """
+        Tile consumer for the tiled mode of calculate_correlations_parallel.
+        """
+        self.update(tile.estimates)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def rebin(self, bin_size):
+        """
+        Sum the counts into coarser bins of the given size (a multiple of the histogram bin size).
+
+        Returns:
+        tuple: (bin edges, counts)
+        """
+        return _rebin(self.bins, self.counts, self.bin_size, bin_size)
+
+
+def _bin_positions(bins, bin_size, estimates):
+    """
+    Bin index of every estimate, as np.histogram assigns it: searchsorted(bins, estimates,
+    side="right") - 1, with the last bin closed. The index is computed arithmetically and then
+    corrected against the edges themselves (searching the edges dominated the cost of decoy runs),
+    so estimates on an edge, e.g. Spearman scores of few samples, land in the same bin as before.
+    NaN and out-of-range estimates get the index len(bins) - 1, one past the last bin, so callers
+    can drop that count.
+    """
+    n_bins = len(bins) - 1
+    outside = ~((estimates >= bins[0]) & (estimates <= bins[-1]))
+    with np.errstate(invalid="ignore"):
+        positions = ((estimates - bins[0]) * (1 / bin_size)).astype(np.intp)
+        np.clip(positions, 0, n_bins - 1, out=positions)
+        # the arithmetic index is off by at most one bin within rounding error of an edge
+        positions -= (estimates < bins[positions]) & (positions > 0)
+        positions += (estimates >= bins[positions + 1]) & (positions < n_bins - 1)
+    positions[outside] = n_bins
+    return positions
+
+
+def _rebin(bins, counts, base_bin_size, bin_size):
+    # sums along the last axis, so per-permutation counts are rebinned in one go
+    factor = max(1, int(round(bin_size / base_bin_size)))
+    starts = np.arange(0, counts.shape[-1], factor)
+    edges = np.append(bins[starts], bins[-1])
+    return edges, np.add.reduceat(counts, starts, axis=-1)
+
+
+class PermutationHistograms:
+    """
+    One ScoreHistogram per decoy permutation, stored as a (permutations, bins) count array.
+
+    Multi-permutation decoy runs keep only these counts; calculate_fdr turns them into a mean
+    FDR curve with confidence bands. Indexing gives the ScoreHistogram of one permutation.
+    """
+
+    def __init__(self, n_permutations, score_range=(-1, 1), bin_size=0.001):
+        self.score_range = score_range
+        self.bin_size = bin_size
+        self.bins = ScoreHistogram(score_range, bin_size).bins
+        self.counts = np.zeros((n_permutations, len(self.bins) - 1), dtype=np.int64)
+
+    @classmethod
+    def from_counts(cls, counts, score_range=(-1, 1), bin_size=0.001):
+        histograms = cls(len(counts), score_range, bin_size)
+        if np.shape(counts) != histograms.counts.shape:
+            raise ValueError(f"Expected counts of shape {histograms.counts.shape}, got {np.shape(counts)}.")
+        histograms.counts[:] = counts
+        return histograms
+
+    @classmethod
+    def merged(cls, histograms, n_permutations, score_range=(-1, 1), bin_size=0.001):
+        total = cls(n_permutations, score_range, bin_size)
+        for histogram in histograms:
+            total.merge(histogram)
+        return total
+
+    def merge(self, other):
+        """
+        Add the counts of other histograms of the same permutations and bins (in place).
+        """
+        if not np.array_equal(self.bins, other.bins) or self.counts.shape != other.counts.shape:
+            raise ValueError("Only histograms with the same permutations and bins can be merged.")
+        self.counts += other.counts
+        return self
+
+    def update(self, estimates):
+        """
+        Add estimates of shape (permutations, ...) to the counts, estimates[i] to permutation i.
+        Same binning as ScoreHistogram.update.
+        """
+        n_permutations, n_bins = self.counts.shape
+        estimates = np.asarray(estimates, dtype=np.float64).reshape(n_permutations, -1)
+
+        # one bincount over all permutations: every permutation gets its own bins plus a spill bin
+        positions = _bin_positions(self.bins, self.bin_size, estimates)
+        positions += np.arange(n_permutations, dtype=positions.dtype)[:, None] * (n_bins + 1)
+        counts = np.bincount(positions.ravel(), minlength=n_permutations * (n_bins + 1))
+        self.counts += counts.reshape(n_permutations, n_bins + 1)[:, :-1]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, permutation):
+        return ScoreHistogram.from_counts(self.counts[permutation], self.score_range, self.bin_size)
+
+    def __iter__(self):
+        return (self[permutation] for permutation in range(len(self)))
+
+    def rebin(self, bin_size):
+        """
+        Sum the counts of every permutation into coarser bins.
+
+        Returns:
+        tuple: (bin edges, counts of shape (permutations, bins))
+        """
+        return _rebin(self.bins, self.counts, self.bin_size, bin_size)
@@ -0,0 +1,191 @@
+import os
+
+import numpy as np
+
+# values per slice of the step-up pass over the sorted p-values
+STEP_UP_CHUNK = 1 << 20
+
+
+def partial_sort(p_values, keep_below=1.0):
+    """
+    Sorted p-values up to keep_below and the number of tests (non-NaN p-values) of a chunk.
+    Workers return this instead of their full p-value arrays.
+
+    Returns:
+    tuple: (sorted p-values <= keep_below, number of tests)
+    """
+    p_values = np.asarray(p_values, dtype=np.float64).ravel()
+    n_tests = int(np.count_nonzero(~np.isnan(p_values)))
+    kept = p_values[p_values <= keep_below]  # also drops NaN
+    kept.sort()
+    return kept, n_tests
+
+
+class StreamingBH:
+    """
+    Global Benjamini-Hochberg correction over p-values that arrive in chunks, tiles or files.
+
+    The first pass collects the sorted p-values of every chunk (add, add_sorted, add_tile); the
+    sorted runs are merged once and the step-up adjustment is computed over all tests in a single
+    O(n log n) pass. The second pass looks up the adjusted value of any p-value of the same run
+    (adjust, adjust_tile). With keep_below = 1 the result equals benjamini_hochberg over all pairs.
+
+    With keep_below < 1, only the p-values up to keep_below are kept, so memory scales with the
+    number of candidate pairs. Adjusted values up to keep_below are then exact; larger ones are
+    conservative upper bounds, and p-values above keep_below are not resolved and become NaN.
+
+    With a spill_dir, the runs are merged into a sorted file whenever more than buffer_mb of them
+    are held, and the final merge and the adjusted values are memory-mapped files in spill_dir, so
+    the correction stays exact for all tests while memory stays within a few buffers.
+    """
+
+    def __init__(self, keep_below=1.0, spill_dir=None, buffer_mb=64):
+        self.keep_below = keep_below
+        self.n_tests = 0
+        self.spill_dir = spill_dir
+        self.buffer_bytes = buffer_mb * 1024 ** 2
+        self._runs = []
+        self._buffered_bytes = 0
+        self._spilled = []
+        self._sorted_p = None
+        self._adjusted = None
+
+    def add(self, p_values):
+        self.add_sorted(*partial_sort(p_values, self.keep_below))
+
+    def add_sorted(self, sorted_p_values, n_tests):
+        """
+        Add a chunk that was already reduced with partial_sort (e.g. by a worker).
+        """
+        if self._sorted_p is not None:
+            raise RuntimeError("No p-values can be added after the correction has been computed.")
+        self._runs.append(sorted_p_values)
+        self._buffered_bytes += sorted_p_values.nbytes
+        self.n_tests += n_tests
+        if self.spill_dir is not None and self._buffered_bytes > self.buffer_bytes:
+            self._spill()
+
+    def _merge_runs(self):
+        # the runs are sorted already, which the merge sort (timsort) takes advantage of
+        sorted_p = np.concatenate(self._runs) if self._runs else np.empty(0)
+        self._runs = []
+        self._buffered_bytes = 0
+        sorted_p.sort(kind="stable")
+        return sorted_p
+
+    def _spill(self):
+        path = os.path.join(self.spill_dir, f"bh-run-{len(self._spilled)}.npy")
+        np.save(path, self._merge_runs())
+        self._spilled.append(path)
+
+    def _merge_spilled(self):
+        """
+        k-way merge of the spilled runs into a memory-mapped file, a slice of every run at a time.
+        """
+        runs = [np.load(path, mmap_mode="r") for path in self._spilled]
+        merged = np.lib.format.open_memmap(os.path.join(self.spill_dir, "bh-sorted.npy"), mode="w+",
+                                           dtype=np.float64, shape=(sum(len(run) for run in runs),))
+        step = max(1, int(self.buffer_bytes // (3 * 8 * len(runs))))
+        positions = [0] * len(runs)
+        written = 0
+        while written < len(merged):
+            slices = [run[position:position + step] for run, position in zip(runs, positions)]
+            # values up to the smallest last value of an unfinished slice cannot be preceded by later ones
+            bound = min((values[-1] for values, run, position in zip(slices, runs, positions)
+                         if position + step < len(run)), default=np.inf)
+            taken = [values[:np.searchsorted(values, bound, side="right")] for values in slices]
+            chunk = np.concatenate(taken)
+            chunk.sort(kind="stable")
+            merged[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            positions = [position + len(values) for position, values in zip(positions, taken)]
+        merged.flush()
+        return merged
+
+    def add_tile(self, tile):
+        """
+        Tile consumer for the first pass over a tiled correlation run.
+        """
+        self.add(tile.p_values)
+
+    def finalize(self):
+        if self._sorted_p is not None:
+            return self
+
+        if self._spilled:
+            if self._runs:
+                self._spill()
+            sorted_p = self._merge_spilled()
+            adjusted = np.lib.format.open_memmap(os.path.join(self.spill_dir, "bh-adjusted.npy"), mode="w+",
+                                                 dtype=np.float64, shape=sorted_p.shape)
+        else:
+            sorted_p = self._merge_runs()
+            adjusted = np.empty_like(sorted_p)
+
+        # step-up pass from the largest p-value down, one slice at a time
+        running_min = 1.0
+        for stop in range(len(sorted_p), 0, -STEP_UP_CHUNK):
+            start = max(stop - STEP_UP_CHUNK, 0)
+            chunk = sorted_p[start:stop] * self.n_tests / np.arange(start + 1, stop + 1)
+            chunk = np.minimum.accumulate(chunk[::-1])[::-1]
+            np.minimum(chunk, running_min, out=chunk)
+            adjusted[start:stop] = chunk
+            running_min = chunk[0]
+
+        self._sorted_p, self._adjusted = sorted_p, adjusted
+        return self
+
+    def adjust(self, p_values):
+        """
+        BH-adjusted p-values for p-values of the collected run, with the same shape as the input.
+        """
+        self.finalize()
+        p_values = np.asarray(p_values, dtype=np.float64)
+
+        # tied p-values share the adjusted value of the last of them
+        positions = np.searchsorted(self._sorted_p, p_values, side="right") - 1
+        resolved = (positions >= 0) & (p_values <= self.keep_below)
+        adjusted = np.full(p_values.shape, np.nan)
+        adjusted[resolved] = self._adjusted[positions[resolved]]
+        return adjusted
+
+    def adjust_tile(self, tile):
+        """
+        Replace the BH-corrected p-values of a tile by the global ones (in place).
+        """
+        tile.bh_corrected_p_values = self.adjust(tile.p_values)
+        return tile
+
+
+def target_decoy_qvalues(estimates, fdr_table):
+    """
+    Target-decoy q-value of every correlation estimate from the table returned by calculate_fdr_table.
+
+    The FDR of a bin is the FDR of accepting all scores at least as extreme as the bin, so the
+    q-value of a score is the lowest FDR of any cutoff that still accepts it: the running minimum
+    of the FDR from 0 outwards, on the positive and the negative side separately.
+
+    Parameters:
+    estimates (array-like): Correlation estimates (e.g. the 'Estimate' column of a result table).
+    fdr_table (pd.DataFrame): FDR table with 'Range_min', 'Range_max' and 'FDR' columns.
+
+    Returns:
+    np.ndarray: q-values; NaN for NaN estimates and estimates outside the table.
+    """
+    table = fdr_table.sort_values('Range_min')
+    range_min = table['Range_min'].to_numpy()
+    range_max = table['Range_max'].to_numpy()
+    fdr = table['FDR'].to_numpy(dtype=np.float64)
+
+    positive = range_max > 0
+    q_values = np.empty_like(fdr)
+    q_values[positive] = np.fmin.accumulate(fdr[positive])
+    q_values[~positive] = np.fmin.accumulate(fdr[~positive][::-1])[::-1]
+
+    estimates = np.asarray(estimates, dtype=np.float64)
+    positions = np.searchsorted(range_min, estimates, side='right') - 1
+    inside = (positions >= 0) & (estimates <= range_max[-1])
+    positions = np.clip(positions, 0, len(range_min) - 1)
+    inside &= estimates <= range_max[positions]
+
+    return np.where(inside, q_values[positions], np.nan)
@@ -0,0 +1,697 @@
+"""
+Headless batch pipeline: load -> clean -> filter -> bin -> correlate -> FDR -> export, for one or
+many datasets described in a TOML or JSON config file. Nothing here imports Streamlit.
+
+    python -m src.pipeline config.toml [--workers N] [--dataset NAME ...] [--profile]
+
+Top-level sections hold the defaults; every [[datasets]] entry needs a name and overrides them
+section by section. Without [[datasets]] the file describes a single dataset.
+
+    output_dir = "results"
+    cache_dir = "/scratch/corromics-cache"    # optional, reuses earlier runs
+    n_workers = 16
+
+    [metabolomics]
+    feature_table = "data/quant_table.csv"    # csv, tsv, txt, xlsx, parquet or feather
+    metadata = "data/metadata.csv"
+    feature_index = "row ID"                  # index column of the feature table
+    sample_index = "filename"                 # index column of the metadata
+    filter_column = "ATTRIBUTE_Sample_Type"   # optional, keep only these samples
+    filter_categories = ["Cycle"]
+
+    [omics]
+    feature_table = "data/asv_table.csv"
+    metadata = "data/asv_metadata.csv"
+    feature_index = "feature_ID"
+    taxonomic_order = ["Domain16S", "Phylum16S", "Class16S"]   # optional, bin the ASVs
+    taxonomic_level = "Class16S"              # default: the last level
+    # taxonomic_levels = ["Phylum16S", "Class16S", "ASV"]   # or several levels from one ASV-level run
+    min_prevalence = 0.1                      # optional feature filters, also in [metabolomics]:
+    top_n_variable = 5000                     # min_prevalence, min_mean, min_variance, min_cv, top_n_variable
+
+    [correlation]
+    method = "pearson"                        # or "spearman"
+    correction = "global"                     # or "per_asv"
+    precision = "float64"                     # or "float32": half the memory, checked against float64
+    min_abs_estimate = 0.5                    # optional: keep only pairs beyond a cutoff
+    top_k = 10                                # optional
+    memory_budget_mb = 4096                   # larger runs are tiled and written to disk
+    memory_limit_mb = 32000                   # optional, refuse larger runs (default: 80% of RAM)
+
+    [decoy]
+    n_permutations = 100
+    seed = 42
+
+    [export]
+    format = "csv"                            # or "tsv"
+    figures = false                           # also write the FDR figures as HTML
+
+    [[datasets]]
+    name = "cruise_1"
+    metabolomics = { feature_table = "data/cruise_1_quant.csv" }
+"""
+import argparse
+import contextlib
+import copy
+import json
+import logging
+import os
+import sys
+import time
+
+import pandas as pd
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    import tomli as tomllib
+
+from .cache import ResultCache, cached_correlations, cached_permutation_histograms, cached_sparse_correlations
+from .correlation import (ASV_LEVEL, TileWriter, calculate_correlations_parallel, calculate_level_correlations,
+                          calculate_permutation_histograms, calculate_sparse_correlations, check_precision,
+                          combine_dataframes, estimate_result_size_mb, level_feature_tables,
+                          melt_correlation_results, sparse_bh_keep_below)
+from .cost_model import CostModel, default_memory_limit_mb, format_duration
+from .executor import CorrelationExecutor
+from .fdr import calculate_fdr_table, fdr_figures
+from .multiple_testing import target_decoy_qvalues
+from .preprocessing import (FEATURE_FILTERS, align_samples, bin_by_taxonomic_level, clean_up_ft, clean_up_md,
+                            clean_up_omics_ft, clean_up_omics_md, filter_feature_tables, load_annotation, load_ft,
+                            load_md, load_nw)
+from .profiling import Profiler
+
+logger = logging.getLogger("corromics.pipeline")
+
+SECTIONS = ("metabolomics", "omics", "correlation", "decoy", "export")
+
+DEFAULTS = {
+    "metabolomics": {"feature_index": "row ID", "sample_index": "filename"},
+    "omics": {"feature_index": "feature_ID", "sample_index": "filename", "taxonomic_order": []},
+    "correlation": {"method": "pearson", "correction": "global", "precision": "float64", "memory_budget_mb": 4096},
+    "decoy": {"n_permutations": 100, "seed": 42},
+    "export": {"format": "csv", "figures": False},
+}
+
+SEPARATORS = {"csv": ",", "tsv": "\t"}
+# rows of the target scores written at once
+EXPORT_CHUNK_ROWS = 1 << 20
+
+
+def load_config(path):
+    """
+    Read a TOML (.toml) or JSON config file.
+    """
+    if path.endswith(".toml"):
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+    with open(path) as file:
+        return json.load(file)
+
+
+def dataset_configs(config):
+    """
+    One config per dataset: the defaults, then the top-level sections, then the dataset's own
+    sections, merged section by section.
+
+    Returns:
+    list: (name, config) tuples in the order of the config file.
+    """
+    base = copy.deepcopy(DEFAULTS)
+    for section in SECTIONS:
+        base[section].update(config.get(section, {}))
+
+    datasets = config.get("datasets") or [{"name": config.get("name", "dataset")}]
+    configs = []
+    for dataset in datasets:
+        if "name" not in dataset:
+            raise ValueError("Every entry of [[datasets]] needs a name.")
+        merged = copy.deepcopy(base)
+        for section in SECTIONS:
+            merged[section].update(dataset.get(section, {}))
+        configs.append((dataset["name"], merged))
+
+    names = [name for name, _ in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("Dataset names must be unique, they name the output directories.")
+    return configs
+
+
+class StageTimer(Profiler):
+    """
+    Profiler that also logs the start and the wall time of every pipeline stage.
+    """
+
+    def __init__(self, dataset, cprofile=False):
+        super().__init__(dataset, cprofile)
+        self.dataset = dataset
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        logger.info("[%s] %s ...", self.dataset, name)
+        with super().stage(name, rows) as record:
+            yield record
+        logger.info("[%s] %s done in %.2f s", self.dataset, name, record["wall_s"])
+
+    @property
+    def timings(self):
+        return {record["stage"]: record["wall_s"] for record in self.stages}
+
+
+def _read_table(loader, path, index, **options):
+    table = loader(path, **options)
+    if table.empty:
+        raise ValueError(f"Could not read {path}.")
+    if index not in table.columns:
+        raise ValueError(f"{path} has no column '{index}'.")
+    return table.set_index(index)
+
+
+def load_inputs(config):
+    """
+    Load stage: the four input tables, indexed like on the Load Input Data page. Of the feature
+    tables only the index, the sample columns and the taxonomic columns are read.
+    """
+    metabolomics, omics = config["metabolomics"], config["omics"]
+    return {
+        "ft": _read_table(load_ft, metabolomics["feature_table"], metabolomics["feature_index"],
+                          index_column=metabolomics["feature_index"]),
+        "md": _read_table(load_md, metabolomics["metadata"], metabolomics["sample_index"]),
+        "omics_ft": _read_table(load_nw, omics["feature_table"], omics["feature_index"],
+                                index_column=omics["feature_index"], taxonomic_columns=omics["taxonomic_order"]),
+        "omics_md": _read_table(load_annotation, omics["metadata"], omics["sample_index"]),
+    }
+
+
+def _log_messages(dataset, messages):
+    for message in messages:
+        logger.warning("[%s] %s", dataset, message)
+
+
+def clean_metabolomics(dataset, tables):
+    """
+    Clean stage for the metabolomics tables: sample names cleaned and aligned between the tables.
+    """
+    md, ft, report = align_samples(clean_up_md(tables["md"]), clean_up_ft(tables["ft"]))
+    _log_messages(dataset, report["messages"])
+    return ft, md
+
+
+def filter_samples(ft, md, section):
+    """
+    Filter stage: keep the samples whose metadata filter_column is one of filter_categories.
+    """
+    column = section.get("filter_column")
+    categories = section.get("filter_categories")
+    if not column or not categories:
+        return ft, md
+    if column not in md.columns:
+        raise ValueError(f"The metadata has no column '{column}'.")
+
+    categories = list(map(str, categories))  # matched as strings, like on the page
+    indices = md[md[column].astype(str).isin(categories)].index
+    if len(indices) == 0:
+        raise ValueError(f"No samples with {column} in {categories}.")
+    return ft.loc[:, indices], md.loc[indices]
+
+
+def bin_omics(omics_ft, section):
+    """
+    Bin stage: sum the ASVs at the configured taxonomic level (the last one of taxonomic_order by
+    default) and drop the empty bins. Without a taxonomic_order the table is used as it is.
+    """
+    taxonomic_order = list(section.get("taxonomic_order") or [])
+    if not taxonomic_order:
+        return omics_ft
+
+    missing = [column for column in taxonomic_order if column not in omics_ft.columns]
+    if missing:
+        raise ValueError(f"The omics feature table has no taxonomic columns {missing}.")
+
+    relevant_columns = [col for col in omics_ft.columns if not col.lower().endswith((".mzml", ".mzxml"))]
+    rearranged_table = omics_ft[taxonomic_order + [col for col in omics_ft.columns if col not in relevant_columns]]
+    binned = bin_by_taxonomic_level(rearranged_table, section.get("taxonomic_level") or taxonomic_order[-1],
+                                    taxonomic_order)
+    return binned[binned["Overall_sum"] > 0]
+
+
+def split_taxonomy(omics_ft, section):
+    """
+    Bin stage of a multi-level run (taxonomic_levels): the ASVs are not binned here, their taxonomic
+    columns are split off and every level is binned in the correlate stage.
+
+    Returns:
+    tuple: (omics_ft without the taxonomic columns, taxonomy)
+    """
+    taxonomic_order = list(section.get("taxonomic_order") or [])
+    if not taxonomic_order:
+        raise ValueError("taxonomic_levels needs a taxonomic_order.")
+    missing = [column for column in taxonomic_order if column not in omics_ft.columns]
+    if missing:
+        raise ValueError(f"The omics feature table has no taxonomic columns {missing}.")
+    unknown = [level for level in section["taxonomic_levels"] if level != ASV_LEVEL and level not in taxonomic_order]
+    if unknown:
+        raise ValueError(f"The taxonomic levels {unknown} are not in the taxonomic_order (or {ASV_LEVEL!r}).")
+
+    return omics_ft.drop(columns=taxonomic_order), omics_ft[taxonomic_order]
+
+
+def clean_omics(dataset, binned_ft, omics_md, section):
+    """
+    Clean stage for the omics tables, after binning as on the Load Input Data page.
+    """
+    omics_ft = clean_up_omics_ft(binned_ft, section.get("taxonomic_order") or ())
+    omics_md, omics_ft, report = align_samples(clean_up_omics_md(omics_md), omics_ft)
+    _log_messages(dataset, report["messages"])
+    return omics_ft, omics_md
+
+
+def filter_features(dataset, met_ft, gen_ft, config):
+    """
+    Feature filter stage: remove constant features and those failing the filters configured in the
+    metabolomics and omics sections (see FEATURE_FILTERS), before any pair is correlated. In a
+    multi-level run the bins are sums of all ASVs, so the omics filters are applied to every level
+    after binning in the correlate stage instead (see correlate_levels).
+
+    Returns:
+    tuple: (met_ft, gen_ft, report) as from filter_feature_tables.
+    """
+    metabolome_filters, genome_filters = _feature_filters(config, "metabolomics"), _feature_filters(config, "omics")
+    if config["omics"].get("taxonomic_levels"):
+        genome_filters = {}
+    met_ft, gen_ft, report = filter_feature_tables(met_ft, gen_ft, metabolome_filters, genome_filters)
+    logger.info("[%s] Feature filters kept %d of %d features and %d of %d %s, %d of %d pairs removed", dataset,
+                report["metabolome"]["kept"], report["metabolome"]["features"], report["genome"]["kept"],
+                report["genome"]["features"], _genome_features(config), report["pairs_removed"],
+                report["pairs_before"])
+    if met_ft.empty or gen_ft.empty:
+        raise ValueError("No features are left to correlate after the feature filters.")
+    return met_ft, gen_ft, report
+
+
+def _feature_filters(config, section):
+    return {name: config[section][name] for name in FEATURE_FILTERS if config[section].get(name) is not None}
+
+
+def _genome_features(config):
+    # in a multi-level run the omics table holds the ASVs until the correlate stage
+    omics = config["omics"]
+    return "bins" if omics.get("taxonomic_order") and not omics.get("taxonomic_levels") else "ASVs"
+
+
+def _predict_cost(met_ft, gen_ft, config, executor, mode, **mode_options):
+    """
+    Predict the run with the cost model and refuse it before any work is done if it would not fit
+    into memory.
+    """
+    options = config["correlation"]
+    cost = CostModel.load().predict(met_ft.shape[0], gen_ft.shape[0], met_ft.shape[1], executor.n_workers,
+                                    config["decoy"]["n_permutations"], mode, correction=options["correction"],
+                                    precision=options["precision"], **mode_options)
+    memory_limit_mb = options.get("memory_limit_mb") or default_memory_limit_mb()
+    logger.info("Predicted %s run: %s, peak %.0f MB", mode, format_duration(cost.total_seconds), cost.peak_mb)
+    if memory_limit_mb is not None and cost.peak_mb > memory_limit_mb:
+        raise MemoryError(f"The {mode} run needs about {cost.peak_mb:.0f} MB, more than the memory limit of "
+                          f"{memory_limit_mb:.0f} MB; lower memory_budget_mb or set a cutoff.")
+    return cost
+
+
+def _check_precision(target_df, met_ft, gen_ft, method, precision, results):
+    # the given results are checked as stored; without them the sampled pairs are recomputed
+    check = check_precision(target_df, met_ft, gen_ft, method, precision, results)
+    log = logger.info if check["passed"] else logger.warning
+    log("%s check on %d pairs: max deviation from float64 %.1e (Estimate), %.1e (P-value)", precision,
+        check["pairs"], check["max_estimate_deviation"], check["max_p_value_deviation"])
+    return check
+
+
+def correlate(met_ft, gen_ft, config, executor, cache, output_dir):
+    """
+    Correlate stage: target correlations in the mode chosen by the config (all pairs, only pairs
+    beyond a cutoff, or tiled to disk if the results exceed the memory budget) and the
+    multi-permutation decoy histograms.
+
+    Returns:
+    dict: target_histogram, decoy_histograms, target_table (None in the tiled mode), mode, the
+    predicted cost, tile_path (tiled mode only), precision_check (float32 runs only) and
+    bh_exact_up_to (sparse runs with the global correction only, see sparse_bh_keep_below).
+    """
+    options = config["correlation"]
+    method, correction, precision = options["method"], options["correction"], options["precision"]
+    sparse_options = {name: options[name] for name in ("min_abs_estimate", "max_p_value", "top_k")
+                      if options.get(name) is not None}
+    target_df = combine_dataframes(met_ft, gen_ft)
+
+    def run(function, cached_function, *args, **kwargs):
+        if cache is None:
+            return function(*args, **kwargs)
+        return cached_function(cache, *args, **kwargs)
+
+    if sparse_options:
+        mode, mode_options = "sparse", sparse_options
+    elif estimate_result_size_mb(met_ft, gen_ft, precision) <= options["memory_budget_mb"]:
+        mode, mode_options = "dense", {}
+    else:
+        mode, mode_options = "tiled", {"memory_budget_mb": options["memory_budget_mb"]}
+
+    cost = _predict_cost(met_ft, gen_ft, config, executor, mode, **mode_options)
+
+    result = {"target_table": None, "mode": mode, "predicted": cost.to_dict()}
+    target_results = None
+    if mode == "sparse":
+        result["target_table"], result["target_histogram"] = run(
+            calculate_sparse_correlations, cached_sparse_correlations, target_df, met_ft, gen_ft,
+            method=method, correction=correction, executor=executor, precision=precision, **sparse_options
+        )
+        if correction == "global":
+            # larger BH-corrected p-values of the hits are conservative upper bounds
+            result["bh_exact_up_to"] = sparse_bh_keep_below(options.get("min_abs_estimate"),
+                                                            options.get("max_p_value"), len(target_df.columns))
+    elif mode == "dense":
+        target_results = run(calculate_correlations_parallel, cached_correlations, target_df, met_ft, gen_ft,
+                             method=method, correction=correction, executor=executor, precision=precision)
+        result["target_table"] = melt_correlation_results(target_results)
+        result["target_histogram"] = target_results.histogram
+    else:
+        result["tile_path"] = os.path.join(output_dir, f"target_scores.{config['export']['format']}")
+        result["target_histogram"] = calculate_correlations_parallel(
+            target_df, met_ft, gen_ft, memory_budget_mb=options["memory_budget_mb"],
+            tile_consumers=[TileWriter(result["tile_path"], config["export"]["format"])],
+            method=method, correction=correction, executor=executor, precision=precision
+        )
+
+    if precision != "float64":
+        result["precision_check"] = _check_precision(target_df, met_ft, gen_ft, method, precision, target_results)
+
+    decoy = config["decoy"]
+    result["decoy_histograms"] = run(calculate_permutation_histograms, cached_permutation_histograms, target_df,
+                                     met_ft, gen_ft, n_permutations=decoy["n_permutations"], seed=decoy["seed"],
+                                     method=method, executor=executor, precision=precision)
+    return result
+
+
+def correlate_levels(met_ft, gen_ft, taxonomy, config, executor):
+    """
+    Correlate stage of a multi-level run: the target correlations of every level of taxonomic_levels
+    from one ASV-level run (see calculate_level_correlations), and the decoy histograms of every
+    level on its binned table. The omics feature filters are applied to every level after binning.
+    All pairs are kept in memory, so cutoffs and tiling do not apply.
+
+    Returns:
+    dict: levels (per level: target_table, target_histogram and decoy_histograms, as from
+    correlate), mode ("levels"), the predicted cost of the ASV-level run and precision_check
+    (float32 runs only, on the ASV level).
+    """
+    options = config["correlation"]
+    method, correction, precision = options["method"], options["correction"], options["precision"]
+    cutoffs = [name for name in ("min_abs_estimate", "max_p_value", "top_k") if options.get(name) is not None]
+    if cutoffs:
+        raise ValueError(f"taxonomic_levels keeps all pairs and cannot be combined with {', '.join(cutoffs)}.")
+    levels = list(config["omics"]["taxonomic_levels"])
+    level_filters = _feature_filters(config, "omics")
+    target_df = combine_dataframes(met_ft, gen_ft)
+
+    # the bins are fewer than the ASVs, so the ASV-level run bounds the cost
+    cost = _predict_cost(met_ft, gen_ft, config, executor, "dense")
+    level_results = calculate_level_correlations(target_df, met_ft, gen_ft, taxonomy, levels, method=method,
+                                                 executor=executor, correction=correction, precision=precision,
+                                                 level_filters=level_filters)
+    result = {"mode": "levels", "predicted": cost.to_dict(), "levels": {}}
+    if precision != "float64":
+        # the pairs are sampled from gen_ft, so an ASV level without some of its ASVs is recomputed
+        asv_results = level_results.get(ASV_LEVEL)
+        if asv_results is not None and len(asv_results.asv_names) != len(gen_ft):
+            asv_results = None
+        result["precision_check"] = _check_precision(target_df, met_ft, gen_ft, method, precision, asv_results)
+
+    decoy = config["decoy"]
+    for level, level_ft in level_feature_tables(target_df, met_ft, gen_ft, taxonomy, levels,
+                                                level_filters).items():
+        logger.info("Level %s: %d features x %d %s", level, met_ft.shape[0], level_ft.shape[0],
+                    "ASVs" if level == ASV_LEVEL else "bins")
+        result["levels"][level] = {
+            "target_table": melt_correlation_results(level_results[level]),
+            "target_histogram": level_results[level].histogram,
+            "decoy_histograms": calculate_permutation_histograms(
+                combine_dataframes(met_ft, level_ft), met_ft, level_ft, n_permutations=decoy["n_permutations"],
+                seed=decoy["seed"], method=method, executor=executor, precision=precision
+            ),
+        }
+    return result
+
+
+def _write_scores(path, table, q_values, separator, level=None, append=False):
+    """
+    Write a long result table with its target-decoy q-values (and a first Level column) chunk by
+    chunk, so the table itself is never copied to add them.
+    """
+    # an empty table still gets its header
+    for start in range(0, max(len(table), 1), EXPORT_CHUNK_ROWS):
+        stop = start + EXPORT_CHUNK_ROWS
+        chunk = table.iloc[start:stop].assign(**{"Target-Decoy q-value": q_values[start:stop]})
+        if level is not None:
+            chunk.insert(0, "Level", level)
+        first = start == 0 and not append
+        chunk.to_csv(path, sep=separator, index=False, mode="w" if first else "a", header=first)
+
+
+def export_results(output_dir, correlation, fdr_table, figures, export):
+    """
+    Export stage: the target scores with their target-decoy q-values, the FDR table and optionally
+    the figures. In the tiled mode the scores were already written tile by tile.
+
+    Returns:
+    list: Paths of the written files.
+    """
+    separator = SEPARATORS[export["format"]]
+    paths = []
+
+    target_table = correlation["target_table"]
+    if target_table is not None:
+        paths.append(os.path.join(output_dir, f"target_scores.{export['format']}"))
+        _write_scores(paths[-1], target_table, target_decoy_qvalues(target_table["Estimate"], fdr_table), separator)
+    else:
+        paths.append(correlation["tile_path"])
+
+    paths.append(os.path.join(output_dir, f"fdr_table.{export['format']}"))
+    fdr_table.to_csv(paths[-1], sep=separator, index=False)
+
+    if export["figures"]:
+        for name, fig in zip(("score_histogram", "fdr_curve"), figures):
+            paths.append(os.path.join(output_dir, f"{name}.html"))
+            fig.write_html(paths[-1])
+
+    return paths
+
+
+def export_level_results(output_dir, level_results, export):
+    """
+    Export stage of a multi-level run: the target scores and FDR tables of all levels in one file
+    each, with the level in a first Level column, and optionally the figures of every level.
+
+    Parameters:
+    level_results (dict): Per level, the correlation (as from correlate_levels), FDR table and figures.
+
+    Returns:
+    list: Paths of the written files.
+    """
+    separator = SEPARATORS[export["format"]]
+    paths = [os.path.join(output_dir, f"target_scores.{export['format']}")]
+    for i, (level, (correlation, fdr_table, _)) in enumerate(level_results.items()):
+        target_table = correlation["target_table"]
+        _write_scores(paths[-1], target_table, target_decoy_qvalues(target_table["Estimate"], fdr_table),
+                      separator, level=level, append=i > 0)
+
+    fdr_table = pd.concat([fdr_table.assign(Level=level) for level, (_, fdr_table, _) in level_results.items()],
+                          ignore_index=True)
+    fdr_table = fdr_table[["Level"] + [column for column in fdr_table.columns if column != "Level"]]
+    paths.append(os.path.join(output_dir, f"fdr_table.{export['format']}"))
+    fdr_table.to_csv(paths[-1], sep=separator, index=False)
+
+    if export["figures"]:
+        for level, (_, _, figures) in level_results.items():
+            for name, fig in zip(("score_histogram", "fdr_curve"), figures):
+                paths.append(os.path.join(output_dir, f"{name}_{level}.html"))
+                fig.write_html(paths[-1])
+
+    return paths
+
+
+def run_dataset(name, config, output_dir, executor, cache=None, profile=False):
+    """
+    Run all stages for one dataset and write its outputs and a summary.json to output_dir.
+    With profile, the run is also captured with cProfile and written to profile.prof.
+
+    Returns:
+    dict: The summary: stage timings in seconds, the per-stage profile, table shapes and written files.
+    """
+    if config["export"]["format"] not in SEPARATORS:
+        raise ValueError(f"Invalid export format: {config['export']['format']}. Must be one of {tuple(SEPARATORS)}.")
+    os.makedirs(output_dir, exist_ok=True)
+    timer = StageTimer(name, cprofile=profile)
+    summary = {"dataset": name, "config": config}
+
+    with timer.stage("load") as record:
+        tables = load_inputs(config)
+        record["rows"] = sum(len(table) for table in tables.values())
+
+    with timer.stage("clean") as record:
+        met_ft, met_md = clean_metabolomics(name, tables)
+        record["rows"] = len(met_ft)
+
+    with timer.stage("filter") as record:
+        met_ft, met_md = filter_samples(met_ft, met_md, config["metabolomics"])
+        record["rows"] = len(met_md)
+
+    levels = config["omics"].get("taxonomic_levels")
+    with timer.stage("bin") as record:
+        if levels:
+            binned_ft, taxonomy = split_taxonomy(tables["omics_ft"], config["omics"])
+        else:
+            binned_ft = bin_omics(tables["omics_ft"], config["omics"])
+        gen_ft, gen_md = clean_omics(name, binned_ft, tables["omics_md"], config["omics"])
+        gen_ft, gen_md = filter_samples(gen_ft, gen_md, config["omics"])
+        record["rows"] = len(gen_ft)
+
+    with timer.stage("feature filter") as record:
+        met_ft, gen_ft, summary["feature_filter"] = filter_features(name, met_ft, gen_ft, config)
+        record["rows"] = len(met_ft) + len(gen_ft)
+
+    n_samples = len(met_ft.columns.intersection(gen_ft.columns))
+    summary["shapes"] = {"metabolomics": list(met_ft.shape), "omics": list(gen_ft.shape),
+                         "shared_samples": n_samples}
+    if n_samples < 3:
+        raise ValueError(f"Only {n_samples} samples are shared by the metabolomics and omics tables.")
+    logger.info("[%s] %d features x %d %s, %d shared samples", name, met_ft.shape[0], gen_ft.shape[0],
+                _genome_features(config), n_samples)
+
+    if levels:
+        return _run_levels(name, config, output_dir, executor, timer, summary, met_ft, gen_ft, taxonomy, profile)
+
+    with timer.stage("correlate") as record:
+        correlation = correlate(met_ft, gen_ft, config, executor, cache, output_dir)
+        record["rows"] = correlation["target_histogram"].total
+    summary["mode"] = correlation["mode"]
+    summary["predicted"] = correlation["predicted"]
+    if "precision_check" in correlation:
+        summary["precision_check"] = correlation["precision_check"]
+    if "bh_exact_up_to" in correlation:
+        summary["bh_exact_up_to"] = correlation["bh_exact_up_to"]
+        logger.info("[%s] BH-corrected p-values of the hits are exact up to %.3g and conservative above", name,
+                    correlation["bh_exact_up_to"])
+    summary["pairs"] = correlation["target_histogram"].total
+
+    with timer.stage("fdr") as record:
+        fdr_table = calculate_fdr_table(correlation["target_histogram"], correlation["decoy_histograms"])
+        record["rows"] = len(fdr_table)
+
+    with timer.stage("export"):
+        # the figures are only built if they are exported
+        figures = (fdr_figures(fdr_table, correlation["target_histogram"], correlation["decoy_histograms"])
+                   if config["export"]["figures"] else None)
+        summary["outputs"] = export_results(output_dir, correlation, fdr_table, figures, config["export"])
+
+    return _write_summary(output_dir, timer, summary, profile)
+
+
+def _run_levels(name, config, output_dir, executor, timer, summary, met_ft, gen_ft, taxonomy, profile):
+    """
+    Correlate, FDR and export stages of a multi-level run (taxonomic_levels).
+    """
+    with timer.stage("correlate") as record:
+        correlation = correlate_levels(met_ft, gen_ft, taxonomy, config, executor)
+        record["rows"] = sum(level["target_histogram"].total for level in correlation["levels"].values())
+    summary["mode"] = correlation["mode"]
+    summary["predicted"] = correlation["predicted"]
+    if "precision_check" in correlation:
+        summary["precision_check"] = correlation["precision_check"]
+    summary["levels"] = {level: {"features": len(level_correlation["target_table"]["Variable"].cat.categories),
+                                 "pairs": level_correlation["target_histogram"].total}
+                         for level, level_correlation in correlation["levels"].items()}
+    summary["pairs"] = record["rows"]
+
+    with timer.stage("fdr") as record:
+        level_results = {}
+        for level, level_correlation in correlation["levels"].items():
+            fdr_table = calculate_fdr_table(level_correlation["target_histogram"],
+                                            level_correlation["decoy_histograms"])
+            figures = (fdr_figures(fdr_table, level_correlation["target_histogram"],
+                                   level_correlation["decoy_histograms"])
+                       if config["export"]["figures"] else None)
+            level_results[level] = level_correlation, fdr_table, figures
+        record["rows"] = sum(len(fdr_table) for _, fdr_table, _ in level_results.values())
+
+    with timer.stage("export"):
+        summary["outputs"] = export_level_results(output_dir, level_results, config["export"])
+
+    return _write_summary(output_dir, timer, summary, profile)
+
+
+def _write_summary(output_dir, timer, summary, profile):
+    summary["timings"] = timer.timings
+    summary["profile"] = timer.to_dict()
+    if profile:
+        timer.dump_cprofile(os.path.join(output_dir, "profile.prof"))
+        summary["outputs"].append(os.path.join(output_dir, "profile.prof"))
+    with open(os.path.join(output_dir, "summary.json"), "w") as file:
+        json.dump(summary, file, indent=2, default=str)
+    return summary
+
+
+def run_pipeline(config, output_dir=None, n_workers=None, datasets=None, profile=False):
+    """
+    Run every dataset of a config (or only the named datasets) on one shared worker pool.
+    A failing dataset is logged and reported in the batch summary; the others still run.
+
+    Returns:
+    list: One summary per dataset, with an "error" entry for the failed ones.
+    """
+    output_dir = output_dir or config.get("output_dir", "results")
+    configs = dataset_configs(config)
+    if datasets:
+        unknown = set(datasets) - {name for name, _ in configs}
+        if unknown:
+            raise ValueError(f"Unknown datasets: {sorted(unknown)}")
+        configs = [(name, dataset_config) for name, dataset_config in configs if name in datasets]
+
+    cache = ResultCache(config["cache_dir"]) if config.get("cache_dir") else None
+    summaries = []
+    start = time.perf_counter()
+
+    with CorrelationExecutor(n_workers or config.get("n_workers")) as executor:
+        for position, (name, dataset_config) in enumerate(configs, start=1):
+            logger.info("Dataset %d/%d: %s", position, len(configs), name)
+            try:
+                summaries.append(run_dataset(name, dataset_config, os.path.join(output_dir, name), executor, cache,
+                                             profile))
+            except Exception as error:
+                logger.exception("[%s] failed", name)
+                summaries.append({"dataset": name, "error": f"{type(error).__name__}: {error}"})
+
+    failed = [summary["dataset"] for summary in summaries if "error" in summary]
+    logger.info("Finished %d datasets in %.1f s, %d failed%s", len(summaries), time.perf_counter() - start,
+                len(failed), f": {', '.join(failed)}" if failed else "")
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "batch_summary.json"), "w") as file:
+        json.dump(summaries, file, indent=2, default=str)
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.pipeline",
+                                     description="Run the Corromics correlation pipeline without the web app.")
+    parser.add_argument("config", help="TOML or JSON config file")
+    parser.add_argument("--output-dir", help="overrides output_dir of the config")
+    parser.add_argument("--workers", type=int, help="correlation worker processes (default: all CPUs)")
+    parser.add_argument("--dataset", action="append", help="run only this dataset (repeatable)")
+    parser.add_argument("--profile", action="store_true",
+                        help="also capture every dataset with cProfile (profile.prof in its output directory)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    summaries = run_pipeline(load_config(args.config), args.output_dir, args.workers, args.dataset, args.profile)
+    return 1 if any("error" in summary for summary in summaries) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,604 @@
+import hashlib
+import io
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+
+# text formats and their separators; the other formats are read with pyarrow or openpyxl
+SEPARATORS = {"txt": "\t", "tsv": "\t", "csv": ","}
+PARQUET_FORMATS = ("parquet", "pq")
+FEATHER_FORMATS = ("feather", "arrow", "ipc")
+TABLE_FORMATS = tuple(SEPARATORS) + ("xlsx",) + PARQUET_FORMATS + FEATHER_FORMATS
+
+# Excel workbooks are converted to Parquet once and read from there on later loads
+TABLE_CACHE_DIR = os.environ.get("CORROMICS_TABLE_CACHE_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".cache", "corromics-tables"))
+
+SAMPLE_COLUMN = re.compile(r"\.mzml|\.mzxml", flags=re.IGNORECASE)
+
+
+def is_sample_column(column):
+    """
+    Sample columns are named after the mzML/mzXML files of the samples.
+    """
+    return bool(SAMPLE_COLUMN.search(str(column)))
+
+
+def _file_name(file):
+    return file if isinstance(file, str) else file.name
+
+
+def _rewind(file):
+    if not isinstance(file, str):
+        file.seek(0)
+
+
+def _select(columns, usecols):
+    # usecols as in pandas: a list of names or a callable that is True for the columns to keep
+    if usecols is None:
+        return None
+    if callable(usecols):
+        return [column for column in columns if usecols(column)]
+    return [column for column in columns if column in set(usecols)]
+
+
+def _read_text(file, sep, usecols, engine):
+    if usecols is not None:
+        # the header is parsed once to resolve the columns, so the parser skips all others
+        header = pd.read_csv(file, sep=sep, nrows=0).columns
+        _rewind(file)
+        usecols = _select(header, usecols)
+    if engine == "pyarrow":
+        try:
+            return pd.read_csv(file, sep=sep, usecols=usecols, engine="pyarrow")
+        except (ImportError, ValueError):
+            # pyarrow missing, or a file it cannot parse (e.g. ragged rows): use the C parser
+            _rewind(file)
+    return pd.read_csv(file, sep=sep, usecols=usecols)
+
+
+def _read_columnar(file, ext, usecols):
+    import pyarrow.parquet as pq
+    from pyarrow import feather, ipc
+
+    if ext in PARQUET_FORMATS:
+        columns = _select(pq.ParquetFile(file).schema_arrow.names, usecols)
+        _rewind(file)
+        return pq.read_table(file, columns=columns).to_pandas()
+
+    columns = _select(ipc.open_file(file).schema.names, usecols)
+    _rewind(file)
+    return feather.read_table(file, columns=columns).to_pandas()
+
+
+def _read_excel(file, usecols):
+    """
+    Read an Excel workbook through a Parquet copy in TABLE_CACHE_DIR, keyed by the content of the
+    workbook, so openpyxl parses every workbook only once.
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as workbook:
+            content = workbook.read()
+    else:
+        content = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    cached_path = os.path.join(TABLE_CACHE_DIR, f"{hashlib.blake2b(content, digest_size=20).hexdigest()}.parquet")
+
+    if os.path.exists(cached_path):
+        try:
+            return _read_columnar(cached_path, "parquet", usecols)
+        except (ImportError, OSError, ValueError):
+            pass
+
+    df = pd.read_excel(io.BytesIO(content))
+    try:
+        os.makedirs(TABLE_CACHE_DIR, exist_ok=True)
+        temp_path = f"{cached_path}.{os.getpid()}.tmp"
+        df.to_parquet(temp_path, index=False)
+        os.replace(temp_path, cached_path)
+    except (ImportError, OSError, ValueError, TypeError):
+        # no pyarrow, a read-only cache or columns Parquet cannot store (e.g. mixed types)
+        pass
+
+    columns = _select(df.columns, usecols)
+    return df if columns is None else df[columns]
+
+
+def downcast_float32(df, columns=None):
+    """
+    Store the numeric columns (or the numeric ones among columns) as float32, which halves the
+    memory of large feature tables. The correlations are still computed in float64 unless
+    precision="float32" is chosen for the run.
+    """
+    columns = df.columns if columns is None else columns
+    numeric = [column for column in columns if pd.api.types.is_numeric_dtype(df[column])
+               and not pd.api.types.is_bool_dtype(df[column])]
+    if numeric:
+        df = df.astype({column: np.float32 for column in numeric})
+    return df
+
+
+def open_df(file, usecols=None, float32_columns=None, engine="c"):
+    """
+    Read a table from a path or an uploaded file.
+
+    Parameters:
+    file (str or file): csv, tsv/txt (tab separated), xlsx, Parquet (parquet, pq) or Feather/Arrow
+                        IPC (feather, arrow, ipc) file; the format is taken from the extension.
+    usecols (list or callable): Columns to read, or a callable that is True for them; only these
+                                are parsed and kept.
+    float32_columns (list or callable): Numeric columns to store as float32 (see downcast_float32).
+    engine (str): Text parser, "c" or "pyarrow" (multithreaded; falls back to "c" if it fails).
+
+    Returns:
+    DataFrame: The table, or an empty DataFrame if the file cannot be read.
+    """
+    try:
+        ext = _file_name(file).split(".")[-1].lower()
+        if ext in SEPARATORS:
+            df = _read_text(file, SEPARATORS[ext], usecols, engine)
+        elif ext == "xlsx":
+            df = _read_excel(file, usecols)
+        else:
+            df = _read_columnar(file, ext, usecols)
+
+        # sometimes dataframes get saved with unnamed index, that needs to be removed
+        # (the pyarrow parser names that column "")
+        for column in ("Unnamed: 0", ""):
+            if column in df.columns:
+                df.drop(column, inplace=True, axis=1)
+
+        if float32_columns is not None:
+            df = downcast_float32(df, _select(df.columns, float32_columns))
+        return df
+    except:
+        return pd.DataFrame()
+
+def load_ft(ft_file, index_column=None):
+    """
+    Load and process the feature table.
+
+    Parameters:
+    ft_file (file): The feature table file.
+    index_column (str): The feature ID column (e.g. "row ID"). If given, only this column and the
+                        sample columns are read; the others are dropped by clean_up_ft anyway.
+
+    Returns:
+    DataFrame: Processed feature table, with float32 sample columns.
+    """
+    usecols = None
+    if index_column is not None:
+        usecols = lambda column: column == index_column or is_sample_column(column)
+    ft = open_df(ft_file, usecols=usecols, float32_columns=is_sample_column, engine="pyarrow")
+    ft = ft.dropna(axis=1)  # Drop columns with missing values
+    return ft
+
+def load_md(md_file):
+    """
+    Load and process metadata. Set 'filename' as the index if present.
+
+    Parameters:
+    md_file (file): The metadata file.
+
+    Returns:
+    DataFrame: Processed metadata.
+    """
+    md = open_df(md_file)
+    return md
+
+def load_nw(omics_ft_file, index_column=None, taxonomic_columns=None):
+    """
+    Load and process the quantification table from proteomics/genomics study.
+    With an index_column and the taxonomic_columns, only these and the sample columns are read.
+    The sample columns are stored as float32.
+    """
+    usecols = None
+    if index_column is not None and taxonomic_columns is not None:
+        keep = {index_column, *taxonomic_columns}
+        usecols = lambda column: column in keep or is_sample_column(column)
+    omics_ft = open_df(omics_ft_file, usecols=usecols, float32_columns=is_sample_column, engine="pyarrow")
+    return omics_ft
+
+def load_annotation(omics_md_file):
+    """
+    Load and process the metadata from proteomics/genomics study.
+    """
+    omics_md = open_df(omics_md_file)
+    return omics_md
+
+
+##### Cleanup functions
+# Plain functions without Streamlit, shared by the app (src/fileselection.py wraps them with
+# st.cache_data) and by the batch pipeline (src/pipeline.py).
+
+def normalize_sample_names(names):
+    """
+    Sample names as they are matched between the tables: without surrounding spaces, the
+    mzML/mzXML extension and the " Peak area" suffix of mzmine. Vectorized over all names.
+
+    Parameters:
+    names (pd.Index): Sample names (the metadata index or the feature table columns).
+
+    Returns:
+    pd.Index: The normalized names.
+    """
+    names = pd.Index(names).str.strip()
+    return names.str.replace(SAMPLE_COLUMN, "", regex=True).str.replace(" Peak area", "", regex=False).str.strip()
+
+
+def _clean_up_metadata(md):
+    md = md.dropna(how="all")
+    # unnamed, as it always was after the cleanup (the filtered feature tables take it as columns)
+    md.index = normalize_sample_names(md.index).rename(None)
+    # text columns: surrounding spaces removed, inner spaces as underscores, upper case
+    for col in md.columns:
+        if md[col].dtype == str:
+            md[col] = md[col].str.strip().str.replace(" ", "_", regex=False).str.upper()
+    return md
+
+
+def _clean_up_feature_table(ft, keep_columns=()):
+    ft = ft.dropna(how="all")
+    # only the sample columns (mzML/mzXML file names) and keep_columns are kept
+    keep = ft.columns.str.contains(SAMPLE_COLUMN, na=False) | ft.columns.isin(list(keep_columns))
+    ft = ft.loc[:, keep]
+    ft.columns = normalize_sample_names(ft.columns)
+    return ft
+
+
+def clean_up_md(md):
+    """
+    Cleans up a metabolomics metadata table: empty rows are removed, the sample names normalized
+    (see normalize_sample_names) and the text columns upper-cased with underscores for spaces.
+    """
+    return _clean_up_metadata(md)
+
+
+def clean_up_ft(ft):
+    """
+    Cleans up a metabolomics feature table: empty rows are removed, and only the sample columns
+    are kept, with normalized names (see normalize_sample_names).
+    """
+    return _clean_up_feature_table(ft)
+
+
+def clean_up_omics_md(md):
+    """
+    Cleans up the metadata of the other omics table, as clean_up_md does.
+    """
+    return _clean_up_metadata(md)
+
+
+def clean_up_omics_ft(ft, taxonomic_columns=()):
+    """
+    Cleans up an omics quantification table by:
+    - Keeping mzML or mzXML file names and the given taxonomic columns.
+    - Removing unwanted substrings from column names (case-insensitive).
+    """
+    return _clean_up_feature_table(ft, taxonomic_columns)
+
+
+def align_samples(md, ft):
+    """
+    Keep only the samples that are present in both the metadata (index) and the feature table (columns).
+    The names are matched as sets, and both tables keep their order.
+
+    Returns:
+    tuple: (md, ft, report). The report holds samples, the index of the shared samples in the order
+    of the feature table columns; feature_table_only and metadata_only, the names of the removed
+    samples; and messages, one per kind of removed samples, to be shown as warnings.
+    """
+    # hash lookups in sets of the names as Python objects (Index.isin and iterating are much slower
+    # on Arrow-backed string indexes)
+    md_names, ft_names = md.index.to_numpy(dtype=object), ft.columns.to_numpy(dtype=object)
+    md_samples, ft_samples = set(md_names), set(ft_names)
+    in_md = np.fromiter((name in md_samples for name in ft_names), dtype=bool, count=len(ft_names))
+    in_ft = np.fromiter((name in ft_samples for name in md_names), dtype=bool, count=len(md_names))
+    report = {
+        "samples": ft.columns[in_md],
+        "feature_table_only": list(ft.columns[~in_md]),
+        "metadata_only": list(md.index[~in_ft]),
+        "messages": [],
+    }
+    messages = report["messages"]
+
+    if report["feature_table_only"] or report["metadata_only"]:
+        messages.append("Not all files are present in both meta data & feature table.")
+
+        if report["feature_table_only"]:
+            messages.append(
+                f"These {len(report['feature_table_only'])} columns of feature table are not present in metadata table and will be removed:\n{', '.join(report['feature_table_only'])}"
+            )
+            ft = ft.loc[:, in_md]
+
+        if report["metadata_only"]:
+            messages.append(
+                f"These {len(report['metadata_only'])} rows of metadata table are not present in feature table and will be removed:\n{', '.join(report['metadata_only'])}"
+            )
+            md = md[in_ft]
+    return md, ft, report
+
+
+# Pre-correlation feature filters, in the order they are applied; None switches a filter off.
+# Features without a positive variance (constant or all zero) are always removed: their
+# correlations are undefined.
+FEATURE_FILTERS = ("min_prevalence", "min_mean", "min_variance", "min_cv", "top_n_variable")
+
+
+def filter_features(ft, min_prevalence=None, min_mean=None, min_variance=None, min_cv=None, top_n_variable=None):
+    """
+    Remove the features (rows) of a feature table that cannot give informative correlations.
+    All statistics are computed for the whole table at once.
+
+    Parameters:
+    ft (pd.DataFrame): Feature table with features as rows and samples as columns.
+    min_prevalence (float): Minimum fraction of samples (0 to 1) with a nonzero value.
+    min_mean (float): Minimum mean abundance.
+    min_variance (float): Minimum sample variance.
+    min_cv (float): Minimum coefficient of variation (sample standard deviation / mean).
+    top_n_variable (int): Keep only the top_n_variable features with the highest variance
+                          among those that pass the other filters.
+
+    Returns:
+    tuple: (filtered table, removed) where removed maps "constant" and every filter to the number of
+    features it removed; a feature is counted for the first filter it fails.
+    """
+    keep, removed = _feature_mask(ft.to_numpy(dtype=np.float64), min_prevalence, min_mean, min_variance, min_cv,
+                                  top_n_variable)
+    return ft[keep], removed
+
+
+def _feature_mask(values, min_prevalence=None, min_mean=None, min_variance=None, min_cv=None, top_n_variable=None):
+    n_samples = values.shape[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = values.mean(axis=1)
+        variance = ((values - mean[:, None]) ** 2).sum(axis=1) / (n_samples - 1)
+
+        # NaN statistics (missing values, a single sample) fail the filters
+        tests = {"constant": variance > 0}
+        if min_prevalence is not None:
+            tests["min_prevalence"] = np.count_nonzero(values, axis=1) / n_samples >= min_prevalence
+        if min_mean is not None:
+            tests["min_mean"] = mean >= min_mean
+        if min_variance is not None:
+            tests["min_variance"] = variance >= min_variance
+        if min_cv is not None:
+            tests["min_cv"] = np.sqrt(variance) / mean >= min_cv
+
+    keep = np.ones(len(values), dtype=bool)
+    removed = {}
+    for name, passed in tests.items():
+        removed[name] = int(np.count_nonzero(keep & ~passed))
+        keep &= passed
+
+    if top_n_variable is not None:
+        if top_n_variable < 1:
+            raise ValueError(f"top_n_variable must be at least 1, got {top_n_variable}.")
+        n_kept = int(np.count_nonzero(keep))
+        if top_n_variable < n_kept:
+            # the n highest variances among the kept features
+            candidates = np.flatnonzero(keep)
+            top = candidates[np.argpartition(-variance[candidates], top_n_variable - 1)[:top_n_variable]]
+            keep[:] = False
+            keep[top] = True
+        removed["top_n_variable"] = n_kept - int(np.count_nonzero(keep))
+
+    return keep, removed
+
+
+def filter_feature_tables(metabolome_ft, genome_ft, metabolome_filters=None, genome_filters=None):
+    """
+    Apply filter_features to the metabolomics and the omics feature table and report how much of the
+    correlation workload (metabolite x ASV pairs) is removed. The statistics are computed over the
+    samples the tables share, which are the ones that are correlated.
+
+    Parameters:
+    metabolome_ft, genome_ft (pd.DataFrame): Feature tables (features x samples).
+    metabolome_filters, genome_filters (dict): Keyword arguments of filter_features for each table.
+
+    Returns:
+    tuple: (metabolome_ft, genome_ft, report) with the report holding the removed features per filter
+    of both tables and the number of pairs before and after filtering.
+    """
+    samples = metabolome_ft.columns.intersection(genome_ft.columns)
+    metabolome_keep, metabolome_removed = _feature_mask(metabolome_ft[samples].to_numpy(dtype=np.float64),
+                                                        **(metabolome_filters or {}))
+    genome_keep, genome_removed = _feature_mask(genome_ft[samples].to_numpy(dtype=np.float64),
+                                                **(genome_filters or {}))
+    filtered_metabolome, filtered_genome = metabolome_ft[metabolome_keep], genome_ft[genome_keep]
+
+    pairs_before = len(metabolome_ft) * len(genome_ft)
+    pairs_after = len(filtered_metabolome) * len(filtered_genome)
+    report = {
+        "metabolome": {"features": len(metabolome_ft), "kept": len(filtered_metabolome),
+                       "removed": metabolome_removed},
+        "genome": {"features": len(genome_ft), "kept": len(filtered_genome), "removed": genome_removed},
+        "pairs_before": pairs_before,
+        "pairs_after": pairs_after,
+        "pairs_removed": pairs_before - pairs_after,
+    }
+    return filtered_metabolome, filtered_genome, report
+
+
+def filter_report_table(report):
+    """
+    The removed features of a filter_feature_tables report, one row per filter and one column per table.
+    """
+    names = ["constant", *FEATURE_FILTERS]
+    return pd.DataFrame({
+        "Metabolomics features removed": [report["metabolome"]["removed"].get(name, 0) for name in names],
+        "Omics features removed": [report["genome"]["removed"].get(name, 0) for name in names],
+    }, index=pd.Index(names, name="Filter"))
+
+
+def inside_levels(df):
+
+    result = []
+
+    for col in df.columns:
+        # Convert all values to string (including NaN as 'NaN') for uniformity
+        values = df[col].astype(str)
+
+        # Create a dictionary of levels and counts (including NaN)
+        level_count_dict = values.value_counts(dropna=False).to_dict()
+
+        # Sort levels alphabetically/numerically, keeping 'NaN' visible
+        sorted_levels = sorted(level_count_dict.keys(), key=lambda x: (x != "nan", x))
+
+        # Extract counts corresponding to the sorted levels
+        sorted_counts = [level_count_dict[level] for level in sorted_levels]
+
+        # Append to result
+        result.append({
+            "ATTRIBUTES": col,
+            "LEVELS": sorted_levels,
+            "COUNTS": sorted_counts,
+        })
+
+    # Convert to DataFrame
+    df = pd.DataFrame(result)
+    return df
+
+
+def order_taxonomic_columns(relevant_columns):
+    """
+    Orders the relevant columns based on a predefined taxonomic hierarchy.
+
+    Parameters:
+    relevant_columns (list): List of column names to be ordered.
+
+    Returns:
+    list: Ordered list of column names.
+    """
+    # Predefined taxonomic hierarchy
+    hierarchy = [
+        "domain", "domains",
+        "kingdom", "kingdoms",
+        "phylum", "phyla",
+        "class", "classes",
+        "order", "orders",
+        "family", "families",
+        "genus", "genera",
+        "species"
+    ]
+
+    # Function to determine the hierarchy position of a column
+    def get_order(column):
+        column_lower = column.lower()  # Convert to lowercase for comparison
+        for i, term in enumerate(hierarchy):
+            if term in column_lower:
+                return i
+        return len(hierarchy)  # Place unmatched columns at the end
+
+    # Sort relevant columns based on the hierarchy
+    ordered_columns = sorted(relevant_columns, key=get_order)
+    return ordered_columns
+
+
+
+def bin_by_taxonomic_level(df, taxonomic_level, taxonomic_columns):
+    """
+    Bins the DataFrame based on a selected taxonomic level and sums the remaining columns.
+
+    Parameters:
+    df (pd.DataFrame): The input DataFrame with taxonomic columns and numeric columns to sum.
+    taxonomic_level (str): The taxonomic level to bin by (e.g., "Domain", "Phylum", "Genus").
+    taxonomic_columns (list): The taxonomic columns, ordered from the highest to the lowest level.
+
+    Returns:
+    pd.DataFrame: The binned DataFrame, indexed by the taxon names of all levels down to the
+    selected one joined with "_" (index name: the joined column names). Rows without a taxon at
+    any of these levels are dropped. The columns are "index" (the bin number), the summed
+    numeric columns and their row sum "Overall_sum".
+    """
+    taxonomic_columns = list(taxonomic_columns)
+
+    # Ensure the taxonomic level is valid
+    if taxonomic_level not in taxonomic_columns:
+        raise ValueError(f"Invalid taxonomic level: {taxonomic_level}. Must be one of {taxonomic_columns}.")
+
+    # the levels below the selected one are not needed
+    level_index = taxonomic_columns.index(taxonomic_level)
+    return bin_all_taxonomic_levels(df, taxonomic_columns[:level_index + 1])[taxonomic_level]
+
+
+def taxonomic_bins(df, taxonomic_columns):
+    """
+    The bins of every taxonomic level and the bin of every row, as bin_by_taxonomic_level forms them.
+
+    The taxa are replaced by integer codes, so no names are joined row by row: the rows are coded
+    by their lineage (their combination of taxa over all levels), and the names of the lineages are
+    extended by one level at a time with vectorized string concatenation.
+
+    Parameters:
+    df (pd.DataFrame): DataFrame with the taxonomic columns.
+    taxonomic_columns (list): The taxonomic columns, ordered from the highest to the lowest level.
+
+    Returns:
+    dict: (bin_names, row_bins) per taxonomic level: the sorted joined names of the bins, and the
+    position of the bin of every row in bin_names, or -1 for rows without a taxon at the level or
+    above. Every bin has rows.
+    """
+    taxonomic_columns = list(taxonomic_columns)
+
+    # the lineage of every row, with missing taxa as a code of their own
+    level_codes = np.column_stack([pd.factorize(df[column], use_na_sentinel=False)[0]
+                                   for column in taxonomic_columns])
+    _, first_rows, row_lineages = np.unique(level_codes, axis=0, return_index=True, return_inverse=True)
+    row_lineages = row_lineages.ravel()
+    lineage_taxa = df[taxonomic_columns].iloc[first_rows]
+
+    bins = {}
+    assigned = np.ones(len(lineage_taxa), dtype=bool)
+    names = None
+    for level in taxonomic_columns:
+        taxa = lineage_taxa[level]
+        # lineages with a taxon at every level down to this one
+        assigned &= taxa.notna().to_numpy()
+        # the taxa down to this level joined with "_" (as strings, like astype(str) does)
+        taxa_names = taxa.astype(str).fillna("").to_numpy(dtype=object)
+        names = taxa_names if names is None else names + "_" + taxa_names
+        # the bins are the distinct joined names, sorted like the groups of a groupby on them
+        bin_names, assigned_bins = np.unique(names[assigned], return_inverse=True)
+        lineage_bins = np.full(len(lineage_taxa), -1)
+        lineage_bins[assigned] = assigned_bins.ravel()
+        bins[level] = bin_names, lineage_bins[row_lineages]
+
+    return bins
+
+
+def bin_all_taxonomic_levels(df, taxonomic_columns):
+    """
+    Bin the DataFrame at every taxonomic level at once, as bin_by_taxonomic_level does for one level.
+    The bins are formed once for all levels (see taxonomic_bins), and every level is a groupby on
+    the integer bin number of the rows.
+
+    Parameters:
+    df (pd.DataFrame): The input DataFrame with taxonomic columns and numeric columns to sum.
+    taxonomic_columns (list): The taxonomic columns, ordered from the highest to the lowest level.
+
+    Returns:
+    dict: The binned DataFrame of every taxonomic level.
+    """
+    taxonomic_columns = list(taxonomic_columns)
+    numeric_columns = df.select_dtypes(include="number").columns
+
+    binned = {}
+    for level_index, (level, (bin_names, row_bins)) in enumerate(taxonomic_bins(df, taxonomic_columns).items()):
+        columns = taxonomic_columns[:level_index + 1]
+        # every bin has rows, so the sorted bin numbers line up with the names; the rows and
+        # the steps are those of a groupby on the joined names, so the sums (and their
+        # rounding) are the same as they have always been
+        group_column = "_".join(columns)
+        level_df = df.dropna(subset=columns)
+        binned_df = level_df.groupby(row_bins[row_bins >= 0])[numeric_columns].sum()
+        binned_df.index = pd.Index(bin_names, name=group_column)
+        binned_df = binned_df.reset_index()
+        binned_df["Overall_sum"] = binned_df[numeric_columns].sum(axis=1)
+        binned_df.reset_index(inplace=True)
+        binned_df.set_index(group_column, inplace=True)
+        binned[level] = binned_df
+
+    return binned
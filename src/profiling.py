@@ -0,0 +1,275 @@
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# the stage record of the innermost running stage; worker tasks submitted meanwhile are attributed to it
+_current_stage = contextvars.ContextVar("corromics_profiling_stage", default=None)
+
+RSS_SAMPLE_INTERVAL = 0.02
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB (Linux), or None where it cannot be read.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def max_rss_mb():
+    """
+    Peak resident set size of this process since it started, in MB, or None where it cannot be read.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+class _RSSSampler:
+    """
+    Samples the RSS of this process in a background thread while a stage runs (Linux only, where
+    it can be read from /proc).
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss_mb() if sys.platform.startswith("linux") else None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss_mb()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def __enter__(self):
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+            rss = current_rss_mb()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process to its current RSS (Linux 4.0+), so peak_rss_mb measures
+    from here on. max_rss_mb is not affected.
+
+    Returns:
+    bool: Whether the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process since the last reset_peak_rss (or since it started)
+    in MB (Linux), or None where it cannot be read.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def is_profiling():
+    return _current_stage.get() is not None
+
+
+def profiled_task(item):
+    """
+    Worker entry point while a stage is profiled: run func(task) and return its result together
+    with the wall time, CPU time, peak RSS and RSS growth of the worker during the task.
+
+    The workers are long-lived, so their lifetime peak (max_rss_mb) would repeat the largest
+    earlier task; the peak is reset before the task instead. Where that is not supported, the
+    larger of the RSS before and after the task is reported.
+    """
+    func, task = item
+    reset = reset_peak_rss()
+    start_rss = current_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(task)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    end_rss = current_rss_mb()
+    peak = peak_rss_mb() if reset else None
+    if peak is None and start_rss is not None:
+        peak = max(start_rss, end_rss)
+    return result, {
+        "pid": os.getpid(),
+        "wall_s": wall,
+        "cpu_s": cpu,
+        "peak_rss_mb": peak,
+        "rss_delta_mb": None if peak is None else peak - start_rss,
+    }
+
+
+def record_worker_tasks(stats):
+    """
+    Add the statistics returned by profiled_task to the running stage, aggregated per worker process
+    (the peak RSS and RSS growth are the largest of its tasks in the stage).
+    """
+    stage = _current_stage.get()
+    if stage is None:
+        return
+    for task in stats:
+        worker = stage["workers"].setdefault(task["pid"], {"pid": task["pid"], "tasks": 0, "wall_s": 0.0,
+                                                           "cpu_s": 0.0, "peak_rss_mb": None,
+                                                           "rss_delta_mb": None})
+        worker["tasks"] += 1
+        worker["wall_s"] += task["wall_s"]
+        worker["cpu_s"] += task["cpu_s"]
+        for name in ("peak_rss_mb", "rss_delta_mb"):
+            if task[name] is not None:
+                worker[name] = task[name] if worker[name] is None else max(worker[name], task[name])
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, peak RSS and output rows of the stages of a run.
+
+    Every stage is a with block (see stage); tasks that a CorrelationExecutor runs during a stage
+    report their wall time, CPU time and peak RSS per worker process. The CPU time and RSS of a
+    stage are those of this process; the peak RSS is sampled every RSS_SAMPLE_INTERVAL seconds.
+    With cprofile, the whole run is also captured with cProfile (this process only).
+    """
+
+    def __init__(self, name="run", cprofile=False):
+        self.name = name
+        self.started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.stages = []
+        self._cprofile = cProfile.Profile() if cprofile else None
+        self._cprofile_running = False
+        self._cprofile_owner = None
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        """
+        Profile the enclosed block as a stage. The record dictionary is yielded, so the number of
+        output rows can be set inside the block (record["rows"] = len(table)).
+        """
+        record = {"stage": name, "wall_s": None, "cpu_s": None, "peak_rss_mb": None, "rows": rows, "workers": {}}
+        token = _current_stage.set(record)
+        start_max_rss = max_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        self._start_cprofile()
+        try:
+            with _RSSSampler() as sampler:
+                yield record
+        finally:
+            self._stop_cprofile()
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.process_time() - cpu
+            # a new lifetime peak set during the stage is exact; otherwise the sampled one is used
+            end_max_rss = max_rss_mb()
+            record["peak_rss_mb"] = (end_max_rss if end_max_rss is not None and end_max_rss > start_max_rss
+                                     else sampler.peak)
+            _current_stage.reset(token)
+            self.stages.append(record)
+
+    def _start_cprofile(self):
+        if self._cprofile is not None and not self._cprofile_running:
+            try:
+                self._cprofile.enable()
+            except ValueError:
+                # another profiler is active (Python 3.12+ allows only one)
+                return
+            self._cprofile_running = True
+            self._cprofile_owner = _current_stage.get()
+
+    def _stop_cprofile(self):
+        # nested stages keep the outermost capture running
+        if self._cprofile_running and self._cprofile_owner is _current_stage.get():
+            self._cprofile.disable()
+            self._cprofile_running = False
+
+    @property
+    def total_seconds(self):
+        return sum(record["wall_s"] for record in self.stages)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "max_rss_mb": max_rss_mb(),
+            "stages": [dict(record, workers=list(record["workers"].values())) for record in self.stages],
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def table(self):
+        """
+        One row per stage: wall and CPU time of this process, peak RSS, rows, and the summed CPU
+        time and highest peak RSS of the workers.
+        """
+        return pd.DataFrame([{
+            "Stage": record["stage"],
+            "Wall time (s)": record["wall_s"],
+            "CPU time (s)": record["cpu_s"],
+            "Peak RSS (MB)": record["peak_rss_mb"],
+            "Rows": record["rows"],
+            "Worker tasks": sum(worker["tasks"] for worker in record["workers"].values()),
+            "Worker CPU time (s)": sum(worker["cpu_s"] for worker in record["workers"].values()),
+            "Worker peak RSS (MB)": max((worker["peak_rss_mb"] for worker in record["workers"].values()
+                                         if worker["peak_rss_mb"] is not None), default=None),
+            "Worker RSS growth (MB)": max((worker["rss_delta_mb"] for worker in record["workers"].values()
+                                           if worker["rss_delta_mb"] is not None), default=None),
+        } for record in self.stages])
+
+    def cprofile_stats(self, sort="cumulative", limit=40):
+        """
+        The cProfile capture as text (the limit slowest functions), or None without cprofile.
+        """
+        if self._cprofile is None:
+            return None
+        stream = io.StringIO()
+        try:
+            pstats.Stats(self._cprofile, stream=stream).sort_stats(sort).print_stats(limit)
+        except TypeError:
+            # nothing was captured yet
+            return None
+        return stream.getvalue()
+
+    def dump_cprofile(self, path):
+        """
+        Write the cProfile capture in the pstats format (for snakeviz, pstats or gprof2dot).
+        """
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(path)
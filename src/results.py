@@ -0,0 +1,226 @@
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+RESULT_COLUMNS = ["Estimate", "P-value", "BH-Corrected P-Value", "R2"]
+
+
+def _frame_view(values, index):
+    # copy=False keeps the frame a view on the store (pandas copies arrays by default)
+    return pd.DataFrame(values, index=index, columns=RESULT_COLUMNS, copy=False)
+
+
+class CorrelationResults(Mapping):
+    """
+    Correlation results of a full metabolite x ASV run in one contiguous array.
+
+    The statistics are stored as a (ASVs, metabolites, 4) float array with the columns of
+    RESULT_COLUMNS, so the results of one ASV are a contiguous block. The store behaves like the
+    former {ASV name: DataFrame} dictionary: results[asv_name] is a zero-copy DataFrame view with
+    the metabolites as index. feature() gives the (strided) view for one metabolite and to_long()
+    the melted table without copying the statistics. histogram holds the ScoreHistogram of the
+    estimates built by the correlation workers, if available.
+    """
+
+    def __init__(self, feature_names, asv_names, values, histogram=None):
+        self.feature_names = pd.Index(feature_names)
+        self.asv_names = pd.Index(asv_names)
+        self.values = values
+        self.histogram = histogram
+        self._asv_positions = {name: i for i, name in enumerate(self.asv_names)}
+
+    @classmethod
+    def from_arrays(cls, feature_names, asv_names, estimates, p_values, bh_corrected_p_values, histogram=None):
+        """
+        Build the store from (metabolites, ASVs) arrays as produced by the correlation engine.
+        """
+        values = np.empty((len(asv_names), len(feature_names), len(RESULT_COLUMNS)), dtype=estimates.dtype)
+        values[..., 0] = estimates.T
+        values[..., 1] = p_values.T
+        values[..., 2] = bh_corrected_p_values.T
+        np.square(values[..., 0], out=values[..., 3])
+        return cls(feature_names, asv_names, values, histogram)
+
+    @property
+    def shape(self):
+        """
+        (number of metabolite features, number of ASVs)
+        """
+        return len(self.feature_names), len(self.asv_names)
+
+    def __getitem__(self, asv_name):
+        return _frame_view(self.values[self._asv_positions[asv_name]], self.feature_names)
+
+    def __iter__(self):
+        return iter(self.asv_names)
+
+    def __len__(self):
+        return len(self.asv_names)
+
+    def __contains__(self, asv_name):
+        return asv_name in self._asv_positions
+
+    def feature(self, feature_name):
+        """
+        Results of one metabolite feature against all ASVs, as a DataFrame view indexed by ASV.
+        """
+        return _frame_view(self.values[:, self.feature_names.get_loc(feature_name)], self.asv_names)
+
+    def column(self, column):
+        """
+        One statistic as a (ASVs, metabolites) array view.
+        """
+        return self.values[..., RESULT_COLUMNS.index(column)]
+
+    def to_long(self):
+        """
+        Long-format table with the columns of melt_correlation_results (ASV by ASV).
+
+        The statistic columns are a view on the store; Feature and Variable are categoricals
+        built from integer codes, so no names are repeated per pair.
+        """
+        n_features, n_asvs = self.shape
+        long_df = _frame_view(self.values.reshape(-1, len(RESULT_COLUMNS)), None)
+
+        feature_codes = np.tile(np.arange(n_features, dtype=_code_dtype(n_features)), n_asvs)
+        asv_codes = np.repeat(np.arange(n_asvs, dtype=_code_dtype(n_asvs)), n_features)
+        long_df.insert(0, "Feature", pd.Categorical.from_codes(feature_codes, categories=self.feature_names))
+        long_df.insert(1, "Variable", pd.Categorical.from_codes(asv_codes, categories=self.asv_names))
+
+        return long_df
+
+
+def _code_dtype(n_categories):
+    # smallest signed integer type that holds all category codes
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+# rows of a result table that are scanned at once when a page is selected from a sorted column
+QUERY_CHUNK_ROWS = 1 << 22
+
+
+def _name_matches(column, text):
+    # case-insensitive substring match on the distinct names, looked up per row by integer code
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes, names = column.cat.codes.to_numpy(), column.cat.categories
+    else:
+        codes, names = pd.factorize(column, use_na_sentinel=True)
+    matches = pd.Index(names).astype(str).str.contains(text, case=False, regex=False)
+    # code -1 (missing name) picks the trailing False
+    return np.append(np.asarray(matches, dtype=bool), False)[codes]
+
+
+def query_results(table, feature=None, variable=None, min_estimate=None, max_estimate=None,
+                  min_abs_estimate=None, max_p_value=None, p_value_column="P-value"):
+    """
+    Rows of a long result table (see melt_correlation_results) that match all given predicates.
+    Predicates left at None are off; rows with a NaN in a filtered column do not match.
+
+    Parameters:
+    table (pd.DataFrame): Long result table with Feature, Variable, Estimate and p-value columns.
+    feature, variable (str): Case-insensitive substring of the Feature or Variable name.
+    min_estimate, max_estimate (float): Range of the Estimate.
+    min_abs_estimate (float): Lowest absolute Estimate.
+    max_p_value (float): Highest value of p_value_column.
+    p_value_column (str): The p-value column max_p_value applies to.
+
+    Returns:
+    np.ndarray or None: Positions of the matching rows, or None if no predicate is set (all rows).
+    """
+    mask = None
+
+    def narrow(matches):
+        nonlocal mask
+        mask = matches if mask is None else mask & matches
+
+    if feature:
+        narrow(_name_matches(table["Feature"], feature))
+    if variable:
+        narrow(_name_matches(table["Variable"], variable))
+    if min_estimate is not None or max_estimate is not None or min_abs_estimate is not None:
+        estimates = table["Estimate"].to_numpy()
+        if min_estimate is not None:
+            narrow(estimates >= min_estimate)
+        if max_estimate is not None:
+            narrow(estimates <= max_estimate)
+        if min_abs_estimate is not None:
+            narrow(np.abs(estimates) >= min_abs_estimate)
+    if max_p_value is not None:
+        narrow(table[p_value_column].to_numpy() <= max_p_value)
+
+    return None if mask is None else np.flatnonzero(mask)
+
+
+def _smallest(keys, k):
+    # positions of the k smallest keys, ties broken by position
+    if k >= len(keys):
+        return np.arange(len(keys))
+    threshold = np.partition(keys, k - 1)[k - 1]
+    below = np.flatnonzero(keys < threshold)
+    ties = np.flatnonzero(keys == threshold)[:k - len(below)]
+    return np.concatenate([below, ties])
+
+
+def _sort_keys(values, descending, absolute):
+    keys = np.abs(values) if absolute else np.array(values, dtype=np.float64)
+    if descending:
+        np.negative(keys, out=keys)
+    # NaN sorts last in both directions
+    keys[np.isnan(keys)] = np.inf
+    return keys
+
+
+def result_page(table, rows=None, start=0, stop=50, sort_by=None, descending=False, absolute=False,
+                extra_columns=None):
+    """
+    One page of a result table: rows start to stop of the selected rows in the sort order.
+
+    A sorted page is selected chunk by chunk (QUERY_CHUNK_ROWS rows) with a partial sort of each
+    chunk, so neither the table nor the selection is sorted or copied as a whole; ties keep the
+    table order, so the pages of one query do not overlap. Categorical columns are returned as
+    plain values, so only the names on the page are sent to the browser.
+
+    Parameters:
+    table (pd.DataFrame): The table.
+    rows (np.ndarray): Positions of the selected rows (query_results), or None for all rows.
+    start, stop (int): Range of the page within the selected rows.
+    sort_by (str): Numeric column to sort by, or None for the table order.
+    descending (bool): Sort from the largest value.
+    absolute (bool): Sort by the absolute value.
+    extra_columns (dict): Columns kept outside the table, as {name: array with one value per table
+                    row}; they are added to the page and can be sorted by.
+
+    Returns:
+    pd.DataFrame: The rows of the page, with their index labels.
+    """
+    extra_columns = extra_columns or {}
+    n_rows = len(table) if rows is None else len(rows)
+    stop = min(stop, n_rows)
+    start = min(start, stop)
+
+    if sort_by is None:
+        positions = np.arange(start, stop) if rows is None else rows[start:stop]
+    else:
+        values = extra_columns[sort_by] if sort_by in extra_columns else table[sort_by].to_numpy()
+        candidates, candidate_keys = [], []
+        for offset in range(0, n_rows, QUERY_CHUNK_ROWS):
+            chunk = slice(offset, offset + QUERY_CHUNK_ROWS)
+            keys = _sort_keys(values[chunk] if rows is None else values[rows[chunk]], descending, absolute)
+            smallest = _smallest(keys, stop)
+            candidates.append(smallest + offset)
+            candidate_keys.append(keys[smallest])
+        candidates, candidate_keys = np.concatenate(candidates), np.concatenate(candidate_keys)
+        order = np.lexsort((candidates, candidate_keys))[start:stop]
+        positions = candidates[order] if rows is None else rows[candidates[order]]
+
+    page = table.iloc[positions]
+    categoricals = [name for name, dtype in page.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    if categoricals:
+        page = page.astype({name: object for name in categoricals})
+    if extra_columns:
+        page = page.assign(**{name: np.asarray(values)[positions] for name, values in extra_columns.items()})
+    return page
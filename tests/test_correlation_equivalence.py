@@ -0,0 +1,90 @@
+"""
+The sparse, tiled and streaming paths against the dense reference on seeded synthetic data.
+
+    python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import false_discovery_control
+
+from benchmarks.synthetic import sample_names, synthetic_asv_table, synthetic_metabolome
+from src.correlation import (calculate_correlations_parallel, combine_dataframes, iter_correlation_tiles,
+                             melt_correlation_results)
+from src.executor import CorrelationExecutor
+from src.multiple_testing import StreamingBH
+from src.results import RESULT_COLUMNS
+
+
+@pytest.fixture(scope="module")
+def executor():
+    with CorrelationExecutor(2) as executor:
+        yield executor
+
+
+@pytest.fixture(scope="module")
+def tables():
+    n_samples = 30
+    met_ft = synthetic_metabolome(120, n_samples, seed=1)
+    gen_ft = synthetic_asv_table(250, n_samples, sparsity=0.8, seed=2)[sample_names(n_samples)]
+    return combine_dataframes(met_ft, gen_ft), met_ft, gen_ft
+
+
+def _p_values(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # rounded, so there are ties as with the discrete scores of Spearman
+    return np.round(rng.random(n) ** 3, 5)
+
+
+@pytest.mark.parametrize("method", ["pearson", "spearman"])
+def test_sparse_asvs_match_dense(tables, executor, method):
+    df, met_ft, gen_ft = tables
+    dense = calculate_correlations_parallel(df, met_ft, gen_ft, method=method, executor=executor, sparse_asvs=False)
+    sparse = calculate_correlations_parallel(df, met_ft, gen_ft, method=method, executor=executor, sparse_asvs=True)
+
+    np.testing.assert_allclose(sparse.values, dense.values, rtol=1e-9, atol=1e-12)
+    np.testing.assert_array_equal(sparse.histogram.counts, dense.histogram.counts)
+
+
+@pytest.mark.parametrize("correction", ["global", "per_asv"])
+def test_tiled_matches_dense(tables, executor, correction):
+    df, met_ft, gen_ft = tables
+    dense = melt_correlation_results(calculate_correlations_parallel(df, met_ft, gen_ft, executor=executor,
+                                                                     correction=correction))
+    # a budget this small takes several ASV blocks and spills the p-values of the global correction
+    tiles = [tile.to_frame() for tile in iter_correlation_tiles(df, met_ft, gen_ft, 0.3, executor=executor,
+                                                                correction=correction)]
+    assert len(tiles) > 1
+    tiled = (dense[["Feature", "Variable"]]
+             .merge(pd.concat(tiles), on=["Feature", "Variable"], how="left"))
+
+    for column in RESULT_COLUMNS:
+        np.testing.assert_array_equal(tiled[column].to_numpy(), dense[column].to_numpy())
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_streaming_bh_matches_scipy(tmp_path, spill):
+    p_values = _p_values(200_000)
+    bh = StreamingBH(spill_dir=tmp_path if spill else None, buffer_mb=0.1)
+    for chunk in np.array_split(p_values, 37):
+        bh.add(chunk)
+
+    np.testing.assert_allclose(bh.adjust(p_values), false_discovery_control(p_values), rtol=1e-12)
+    if spill:
+        assert len(bh._spilled) > 1
+
+
+def test_streaming_bh_keep_below(tmp_path):
+    p_values = _p_values(50_000, seed=1)
+    keep_below = 0.01
+    bh = StreamingBH(keep_below, spill_dir=tmp_path, buffer_mb=0.01)
+    for chunk in np.array_split(p_values, 13):
+        bh.add(chunk)
+    adjusted = bh.adjust(p_values)
+    expected = false_discovery_control(p_values)
+
+    # p-values above keep_below are not resolved, adjusted values up to it are exact
+    assert np.isnan(adjusted[p_values > keep_below]).all()
+    exact = expected <= keep_below
+    np.testing.assert_allclose(adjusted[exact], expected[exact], rtol=1e-12)
+    assert (adjusted[p_values <= keep_below] >= expected[p_values <= keep_below] * (1 - 1e-12)).all()